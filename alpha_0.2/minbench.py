@@ -0,0 +1,847 @@
+# MinChat - minbench - Alpha 0.2
+
+# MODULES ----------------------------------------------------------------------
+
+import asyncio
+import urllib.request
+import os, re, ast, sys, time, json, shlex, argparse, tempfile, subprocess
+import socket as skt
+from datetime import datetime
+from collections import deque
+from minproto import HELLO, CHAT, CONTROL, ERROR, POST, FrameDecoder, encode_text, decode_post
+
+# GLOBAL CONSTANTS -------------------------------------------------------------
+
+ENCODING = 'ascii'
+VERSION = 'Alpha 0.2' # Recorded in --json results, with the git revision if known.
+DEFAULT_PORT = 1061 # Kept off the chatroom default so a live server is never hit.
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'minserver.py')
+ENGINES = ('thread', 'asyncio')
+SCENARIOS = { # Scenario -> what it measures (see the run_ functions).
+    'fanout': 'idle memory per connection, and broadcast latency (run_benchmark)',
+    'load': 'bots posting at a steady rate: latency, throughput, memory (run_load)',
+    'storm': 'connections all opened at once (run_storm)',
+    'history': 'clients all joining and fetching history at once (run_history_storm)',
+    'slow': 'steady load with some clients reading slowly (run_slow_readers)',
+    'churn': 'broadcasts while connections come and go (run_churn)',
+    'throughput': 'a few clients posting as fast as they can (run_throughput)',
+    'replay': 'a recorded session replayed from its admin logs (run_replay)',
+}
+CHURN_WORKERS = 8 # Connections opened and closed at once by the churn scenario.
+CHURN_RATE = 200 # Default broadcasts per second sent during the churn scenario.
+HIST = '!HIST!'
+HIST_RET = '!HIST_RETURN!'
+HIST_END = '!HIST_END!'
+SENDERS = 4 # Default clients posting in the throughput scenario.
+MESSAGES = 2000 # Default messages each of them posts.
+QUIET_SECONDS = 3 # The throughput scenario ends once nothing arrives for this long.
+POST_RATE = 1 # Default messages per second each bot posts.
+MESSAGE_SIZE = 64 # Default bytes in each bot message.
+SLOW_READERS = 10 # Default clients reading slowly in the slow scenario...
+SLOW_READ_BYTES = 256 # ... which read this many bytes at a time...
+SLOW_READ_DELAY = 0.1 # ... this many seconds apart.
+MONITOR_INTERVAL = 0.25 # Seconds between samples of the server's memory and threads.
+STATS_OFFSET = 1000 # The server serves its metrics (--stats-port) this far above its port.
+POSTED = '!POSTED!'
+PEER = '!PEER!'
+COMMANDS = (HIST, '!JOIN!', '!LEAVE!', '!ROOMS!', '!NAME!') # Replayed as control frames.
+
+# Admin log records replayed by the replay scenario (see minserver's LogWriter):
+ADMIN_RECORD = re.compile(r'\[([0-9 :.-]+)\] (.*)\Z') # [time logged] record
+CONNECTED = re.compile(r'NEW CONNECTION: Client (\(.*?\)) -> ')
+RECEIVED = re.compile(r'MESSAGE RECEIVED: (\(.*?\)) says\.\.\.\Z') # Message on the next line.
+CLOSED = re.compile(r'CONNECTION CLOSED: (\(.*?\)) has closed their connection\.\Z')
+CONNECT, MESSAGE, CLOSE = 'connect', 'message', 'close' # Replayed events.
+
+
+# SERVER PROCESS ---------------------------------------------------------------
+
+class ServerProcess:
+    '''Runs minserver.py in a child process, in a scratch directory for its logs.'''
+
+    def __init__(self, port, engine, extra_args=(), workers=1):
+        self.port = port
+        self.engine = engine
+        self.extra_args = list(extra_args)
+        self.stats_port = port + STATS_OFFSET
+        self.workers = workers # Processes serving metrics: the hub and each worker, if more than 1.
+        self.log_dir = tempfile.TemporaryDirectory(prefix='minbench_')
+        self.proc = None
+        self.stderr = None # The server's stderr, kept to look for exceptions.
+
+    def __enter__(self):
+        self.stderr = open(os.path.join(self.log_dir.name, 'stderr.txt'), 'w+')
+        self.proc = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, '127.0.0.1', '-p', str(self.port),
+             '--engine', self.engine, '--stats-port', str(self.stats_port), *self.extra_args],
+            cwd=self.log_dir.name,
+            stdin=subprocess.PIPE, # Keeps the admin console waiting for input.
+            stdout=subprocess.DEVNULL,
+            stderr=self.stderr,
+        )
+        # Wait for the listening socket to come up:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                skt.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError(f'minserver did not start on port {self.port}')
+
+    def __exit__(self, *exc):
+        self.proc.kill()
+        self.proc.wait()
+        self.stderr.close()
+        self.log_dir.cleanup()
+
+    def status(self):
+        '''
+        Returns the resident memory (KiB) and thread count of the server,
+        including its worker processes if it has any (see --workers).
+        '''
+        with open(f'/proc/{self.proc.pid}/task/{self.proc.pid}/children') as children:
+            pids = [self.proc.pid] + [int(pid) for pid in children.read().split()]
+        rss = threads = 0
+        for pid in pids:
+            fields = {}
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    key, _, value = line.partition(':')
+                    fields[key] = value.split()
+            rss += int(fields['VmRSS'][0])
+            threads += int(fields['Threads'][0])
+        return rss, threads
+
+    def counters(self, *names):
+        '''Returns the named counters of the server's metrics, summed over its workers.'''
+        ports = [self.stats_port]
+        if self.workers > 1:
+            ports += [self.stats_port + 1 + worker for worker in range(self.workers)]
+        totals = dict.fromkeys(names, 0)
+        for port in ports:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/json', timeout=10) as reply:
+                stats = json.load(reply)
+            for name in names:
+                totals[name] += stats[name]
+        return totals
+
+    def exceptions(self):
+        '''Returns the number of uncaught exceptions the server has reported.'''
+        self.stderr.seek(0)
+        return sum(line.startswith('Traceback') for line in self.stderr)
+
+
+# BENCHMARKS -------------------------------------------------------------------
+
+async def open_client(port, framed=False):
+    '''
+    Opens one connection, and waits for the server to answer a history request
+    so the connection is known to be registered, not just queued in the backlog.
+    A framed client negotiates framing first; otherwise the raw protocol is used.
+    '''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    if framed:
+        writer.write(HELLO)
+        await reader.readexactly(len(HELLO))
+        writer.write(encode_text(CONTROL, HIST))
+        await receive(reader, HIST_END.encode(ENCODING))
+    else:
+        writer.write(HIST.encode(ENCODING))
+        await receive(reader, HIST_RET.encode(ENCODING))
+    return reader, writer
+
+
+async def open_clients(port, count, framed=False):
+    '''Opens count idle connections to the server, a few hundred at a time.'''
+    clients = []
+    for start in range(0, count, 250):
+        batch = [open_client(port, framed) for _ in range(start, min(count, start + 250))]
+        clients.extend(await asyncio.gather(*batch))
+    return clients
+
+
+async def discard(reader):
+    '''Reads and ignores everything the server sends one client.'''
+    while await reader.read(65536):
+        pass
+
+
+async def receive(reader, token):
+    '''Reads from one client until token arrives; returns the arrival time.'''
+    data = b''
+    while token not in data:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ConnectionError('server closed a benchmark connection')
+        data = data[-len(token):] + chunk # Only the end can hold part of the token.
+    return time.perf_counter()
+
+
+def percentile(samples, pct):
+    '''Returns the pct-th percentile of a list of numbers.'''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def latency_ms(name, samples):
+    '''Returns the p50, p99 and p999 of a list of times in seconds, in ms, keyed for a result.'''
+    if not samples:
+        return {f'{name}_ms_p50': None, f'{name}_ms_p99': None, f'{name}_ms_p999': None}
+    ordered = sorted(samples)
+    return {
+        f'{name}_ms_{label}': ordered[min(len(ordered) - 1, int(len(ordered) * pct))] * 1000
+        for label, pct in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+    }
+
+
+class Monitor:
+    '''Samples the server's memory and thread count in the background, keeping the peaks.'''
+
+    def __init__(self, server):
+        self.server = server
+        self.peak_rss = self.peak_threads = 0
+        self.task = None
+
+    def __enter__(self):
+        self.task = asyncio.ensure_future(self.sample())
+        return self
+
+    def __exit__(self, *exc):
+        self.task.cancel()
+        self.take_sample() # However short the run, the end is sampled.
+
+    def take_sample(self):
+        rss, threads = self.server.status()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_threads = max(self.peak_threads, threads)
+
+    async def sample(self):
+        while True:
+            self.take_sample()
+            await asyncio.sleep(MONITOR_INTERVAL)
+
+    def result(self):
+        return {'server_rss_kib_peak': self.peak_rss, 'server_threads_peak': self.peak_threads}
+
+
+async def run_benchmark(server, connections, rounds):
+    '''Measures idle memory per connection, then fan-out latency.'''
+    rss_before, _ = server.status()
+    clients = await open_clients(server.port, connections)
+    rss_after, threads = server.status()
+
+    sender_reader, sender_writer = clients[0]
+    receivers = clients[1:]
+    last_arrivals, all_arrivals = [], []
+    for n in range(rounds):
+        token = f'minbench-{n}'.encode(ENCODING)
+        waiting = [asyncio.ensure_future(receive(r, token)) for r, _ in receivers]
+        sent = time.perf_counter()
+        sender_writer.write(token)
+        arrivals = [t - sent for t in await asyncio.gather(*waiting)]
+        last_arrivals.append(max(arrivals))
+        all_arrivals.extend(arrivals)
+
+    for _, writer in clients:
+        writer.close()
+
+    return {
+        'engine': server.engine,
+        'connections': connections,
+        'server_threads': threads,
+        'rss_kib_per_idle_connection': (rss_after - rss_before) / connections,
+        **latency_ms('fanout', all_arrivals),
+        'fanout_ms_last_receiver_p50': percentile(last_arrivals, 50) * 1000,
+    }
+
+
+async def run_churn(server, connections, seconds, rate=CHURN_RATE):
+    '''
+    Stress test for the server's connection registry: broadcasts rate messages
+    a second to connections clients while CHURN_WORKERS others connect, announce
+    themselves and disconnect, over and over. Afterwards a new client must
+    still receive broadcasts, and the server must not have raised.
+    '''
+    _, threads_before = server.status()
+    clients = await open_clients(server.port, connections)
+    sender_reader, sender_writer = clients[0]
+    readers = [asyncio.ensure_future(discard(reader)) for reader, _ in clients]
+    deadline = time.monotonic() + seconds
+    churned = 0
+
+    async def churn(worker):
+        nonlocal churned
+        while time.monotonic() < deadline:
+            _, writer = await open_client(server.port)
+            writer.write(f'SERVER: churn{worker}-{churned} has entered the chatroom.'.encode(ENCODING))
+            writer.close()
+            churned += 1
+
+    workers = [asyncio.ensure_future(churn(worker)) for worker in range(CHURN_WORKERS)]
+    broadcasts = 0
+    while time.monotonic() < deadline:
+        sender_writer.write(f'minbench: broadcast {broadcasts}\n'.encode(ENCODING))
+        broadcasts += 1
+        await sender_writer.drain()
+        await asyncio.sleep(1 / rate) # Readers never push back, so the pace is set here.
+    await asyncio.gather(*workers)
+
+    # The registry must still deliver to a client that arrives afterwards.
+    # (Resent until it arrives: while the server works through the backlog,
+    # it may read the token split across two messages.)
+    late_reader, late_writer = await open_client(server.port)
+    token = b'minbench-after-churn'
+    arrival = asyncio.ensure_future(receive(late_reader, token))
+    for _ in range(20):
+        sender_writer.write(token)
+        await asyncio.wait([arrival], timeout=0.5)
+        if arrival.done():
+            break
+    else:
+        raise RuntimeError('a client that connected after the churn received nothing')
+    arrival.result()
+
+    for task in readers:
+        task.cancel()
+    for _, writer in clients + [(late_reader, late_writer)]:
+        writer.close()
+    await asyncio.sleep(1) # Let the server reap the connections.
+    _, threads_after = server.status()
+
+    return {
+        'engine': server.engine,
+        'scenario': 'churn',
+        'connections': connections,
+        'seconds': seconds,
+        'broadcasts_per_second': broadcasts / seconds,
+        'connections_churned': churned,
+        'churned_per_second': churned / seconds,
+        'server_threads_before': threads_before,
+        'server_threads_after': threads_after,
+        'server_exceptions': server.exceptions(),
+    }
+
+
+async def run_throughput(server, connections, senders=SENDERS, messages=MESSAGES):
+    '''
+    Measures how many messages a second the server delivers: senders of
+    connections framed clients each post messages as fast as the server reads
+    them, and every client counts the posts it receives, until all have
+    arrived or nothing has for QUIET_SECONDS. Messages shed by the slow policy
+    are reported as lost. The server's socket writes are counted too, to show
+    how many messages each write carries (see minserver --coalesce-ms).
+    '''
+    clients = await open_clients(server.port, connections, framed=True)
+    received = [0] * connections
+
+    async def count(n, reader):
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            received[n] += sum(kind == POST for kind, _ in decoder.feed(data))
+
+    async def post(writer):
+        for n in range(messages):
+            writer.write(encode_text(CHAT, f'minbench: message {n}'))
+            if n % 64 == 63:
+                await writer.drain()
+        await writer.drain()
+
+    counters = [asyncio.ensure_future(count(n, reader)) for n, (reader, _) in enumerate(clients)]
+    expected = senders * messages * (connections - 1) # Everyone but the sender gets each.
+    started = time.perf_counter()
+    await asyncio.gather(*(post(writer) for _, writer in clients[:senders]))
+    finished = last_total = 0
+    quiet_since = time.perf_counter()
+    while sum(received) < expected and time.perf_counter() - quiet_since < QUIET_SECONDS:
+        await asyncio.sleep(0.05)
+        total = sum(received)
+        if total != last_total:
+            last_total, quiet_since, finished = total, time.perf_counter(), time.perf_counter()
+    delivered = sum(received)
+    elapsed = (finished or time.perf_counter()) - started
+    _, threads = server.status()
+    writes = server.counters('socket_writes')['socket_writes']
+
+    for task in counters:
+        task.cancel()
+    for _, writer in clients:
+        writer.close()
+
+    return {
+        'engine': server.engine,
+        'scenario': 'throughput',
+        'connections': connections,
+        'senders': senders,
+        'messages_posted': senders * messages,
+        'messages_delivered': delivered,
+        'messages_lost': expected - delivered,
+        'seconds': elapsed,
+        'posted_per_second': senders * messages / elapsed,
+        'delivered_per_second': delivered / elapsed,
+        'socket_writes': writes,
+        'writes_per_delivered': writes / max(delivered, 1),
+        'server_threads': threads,
+    }
+
+
+# BOTS -------------------------------------------------------------------------
+
+class Bot:
+    '''
+    A headless client for load tests. It speaks framing, posts messages stamped
+    with the time they were sent, and times every message it receives from
+    the other bots, which run in this process and so share the clock.
+    '''
+
+    def __init__(self, name, reader, writer):
+        self.name = name # Username the bot posts under.
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.posted = 0 # Messages posted.
+        self.received = 0 # Messages received from other bots.
+        self.latencies = [] # Seconds from posting to arrival, of each message received.
+
+    async def post(self, rate, size, deadline):
+        '''Posts rate messages a second, each padded to size bytes, until deadline.'''
+        interval = 1 / rate
+        due = time.monotonic()
+        while due < deadline:
+            text = f'{self.name}: {time.perf_counter():.6f} '
+            self.writer.write(encode_text(CHAT, text.ljust(size, 'x')))
+            self.posted += 1
+            await self.writer.drain()
+            due += interval
+            await asyncio.sleep(max(0, due - time.monotonic()))
+
+    async def read(self, chunk=65536, delay=0):
+        '''Reads until the connection closes, chunk bytes at a time, delay seconds apart.'''
+        while True:
+            data = await self.reader.read(chunk)
+            if not data:
+                return
+            arrived = time.perf_counter()
+            for kind, payload in self.decoder.feed(data):
+                if kind == POST:
+                    _, text = decode_post(payload)
+                    self.received += 1
+                    self.latencies.append(arrived - float(text.split(' ', 2)[1]))
+            if delay:
+                await asyncio.sleep(delay)
+
+    def close(self):
+        self.writer.close()
+
+
+async def open_bots(port, count):
+    '''Opens count bots, registered with the server.'''
+    clients = await open_clients(port, count, framed=True)
+    return [Bot(f'bot{n}', reader, writer) for n, (reader, writer) in enumerate(clients)]
+
+
+async def run_load(server, bots, seconds, rate=POST_RATE, size=MESSAGE_SIZE, slow=0):
+    '''
+    Steady load: bots post rate messages a second of size bytes each, for
+    seconds, and time every message they receive end to end, until all have
+    arrived or nothing has for QUIET_SECONDS; what never arrived is reported
+    as lost. Reports latency, throughput, socket writes per delivered message,
+    and the server's peak memory and threads. The last
+    slow of the bots read only SLOW_READ_BYTES every SLOW_READ_DELAY seconds,
+    and post nothing; latency is reported for the others.
+    '''
+    crowd = await open_bots(server.port, bots + slow)
+    fast, slow_bots = crowd[:bots], crowd[bots:]
+    readers = [asyncio.ensure_future(bot.read()) for bot in fast]
+    readers += [asyncio.ensure_future(bot.read(SLOW_READ_BYTES, SLOW_READ_DELAY)) for bot in slow_bots]
+    with Monitor(server) as monitor:
+        started = time.monotonic()
+        await asyncio.gather(*(bot.post(rate, size, started + seconds) for bot in fast))
+        # Let what is still on its way arrive, until nothing has for a while:
+        expected = sum(bot.posted for bot in fast) * (bots - 1)
+        last_total, quiet_since = -1, time.monotonic()
+        while time.monotonic() - quiet_since < QUIET_SECONDS:
+            total = sum(bot.received for bot in fast)
+            if total >= expected:
+                break
+            if total != last_total:
+                last_total, quiet_since = total, time.monotonic()
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+    for task in readers:
+        task.cancel()
+    for bot in crowd:
+        bot.close()
+
+    posted = sum(bot.posted for bot in fast)
+    delivered = sum(bot.received for bot in fast)
+    writes = server.counters('socket_writes')['socket_writes']
+    result = {
+        'engine': server.engine,
+        'bots': bots,
+        'post_rate': rate,
+        'message_size': size,
+        'seconds': elapsed,
+        'messages_posted': posted,
+        'messages_delivered': delivered,
+        'messages_lost': posted * (bots - 1) - delivered,
+        'posted_per_second': posted / seconds,
+        'delivered_per_second': delivered / elapsed,
+        'socket_writes': writes,
+        'writes_per_delivered': writes / max(delivered, 1),
+        **latency_ms('latency', [t for bot in fast for t in bot.latencies]),
+        **monitor.result(),
+    }
+    if slow:
+        result['slow_readers'] = slow
+        result['slow_reader_messages_received'] = sum(bot.received for bot in slow_bots) / slow
+    return result
+
+
+async def run_slow_readers(server, bots, seconds, rate=POST_RATE, size=MESSAGE_SIZE,
+                           slow=SLOW_READERS):
+    '''
+    The load scenario with slow readers among the bots: shows whether they hold
+    up everyone else, and what they cost the server while their queues fill.
+    '''
+    return await run_load(server, bots, seconds, rate, size, slow)
+
+
+async def run_storm(server, connections):
+    '''
+    Connection storm: opens connections all at once, each waiting until the
+    server has registered it, and times how long each one took.
+    '''
+    rss_before, threads_before = server.status()
+    with Monitor(server) as monitor:
+        started = time.perf_counter()
+
+        async def connect():
+            client = await open_client(server.port, framed=True)
+            return client, time.perf_counter() - started
+
+        results = await asyncio.gather(*(connect() for _ in range(connections)))
+        elapsed = time.perf_counter() - started
+        rss_after, threads_after = server.status()
+    for (_, writer), _ in results:
+        writer.close()
+
+    return {
+        'engine': server.engine,
+        'connections': connections,
+        'seconds': elapsed,
+        'connections_per_second': connections / elapsed,
+        **latency_ms('connect', [took for _, took in results]),
+        'rss_kib_per_connection': (rss_after - rss_before) / connections,
+        'server_threads_before': threads_before,
+        'server_threads_after': threads_after,
+        **monitor.result(),
+    }
+
+
+async def run_history_storm(server, connections, messages=MESSAGES, size=MESSAGE_SIZE):
+    '''
+    History-on-join storm: posts messages of size bytes, then has connections
+    clients all connect at once and ask for history, as a room full of
+    clients does when the server comes back. Times each until its history is in.
+    '''
+    (poster,) = await open_bots(server.port, 1)
+    for n in range(messages):
+        poster.writer.write(encode_text(CHAT, f'{poster.name}: {n} '.ljust(size, 'x')))
+    await receive(poster.reader, f'{POSTED} {messages - 1}'.encode(ENCODING))
+
+    with Monitor(server) as monitor:
+        started = time.perf_counter()
+
+        async def join():
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(HELLO + encode_text(CONTROL, HIST))
+            await receive(reader, HIST_END.encode(ENCODING))
+            return writer, time.perf_counter() - started
+
+        results = await asyncio.gather(*(join() for _ in range(connections)))
+        elapsed = time.perf_counter() - started
+    poster.close()
+    for writer, _ in results:
+        writer.close()
+
+    return {
+        'engine': server.engine,
+        'connections': connections,
+        'history_messages': messages,
+        'message_size': size,
+        'seconds': elapsed,
+        'joins_per_second': connections / elapsed,
+        **latency_ms('join', [took for _, took in results]),
+        **monitor.result(),
+    }
+
+
+# REPLAY -----------------------------------------------------------------------
+
+def read_trace(paths):
+    '''
+    Reads a recorded session from its admin logs (one, or one per worker)
+    into the connections it saw, in the order they opened: each a list of
+    (time, event, message) for its CONNECT, each MESSAGE and its CLOSE.
+    Links from federated servers are left out; they are not clients. Logs
+    from servers that did not yet time their records are read in the order
+    they were written, every record at time 0, so they replay at max speed.
+    '''
+    records = [] # (time, record, continuation lines)
+    for path in paths:
+        with open(path) as log:
+            for line in log:
+                line = line.rstrip('\n')
+                if line.startswith('\t') and records:
+                    records[-1][2].append(line[1:])
+                    continue
+                record = ADMIN_RECORD.match(line)
+                if record:
+                    records.append((datetime.fromisoformat(record[1]).timestamp(), record[2], []))
+                elif line: # An untimed record, from an older server.
+                    records.append((0.0, line, []))
+    records.sort(key=lambda record: record[0])
+
+    sessions, open_sessions, peers = [], {}, set()
+    for logged, text, lines in records:
+        connected, received, closed = (
+            pattern.match(text) for pattern in (CONNECTED, RECEIVED, CLOSED)
+        )
+        address = (connected or received or closed or [None, None])[1]
+        if address in peers: # Ignored until it closes.
+            if closed:
+                peers.discard(address)
+            continue
+        if connected or received and address not in open_sessions: # Opened before the log began.
+            open_sessions[address] = [(logged, CONNECT, None)]
+            sessions.append(open_sessions[address])
+        if received and lines:
+            msg = ast.literal_eval(lines[0])
+            if msg.startswith(PEER):
+                peers.add(address)
+                sessions.remove(open_sessions.pop(address))
+            else:
+                open_sessions[address].append((logged, MESSAGE, msg))
+        elif closed and address in open_sessions:
+            open_sessions.pop(address).append((logged, CLOSE, None))
+    return sessions
+
+
+class ReplayClient:
+    '''
+    One recorded connection, replayed as a framing client: it connects, sends
+    each message and closes when the recording says to, scaled by the replay's
+    speed, and times how far behind schedule it fell, how long connecting took,
+    and how long each of its chat messages took the server to number.
+    '''
+
+    def __init__(self, events):
+        self.events = events # (time, event, message), from read_trace.
+        self.decoder = FrameDecoder()
+        self.sent = deque() # When each chat message not yet numbered was sent.
+        self.lags = [] # Seconds each event happened after it was due.
+        self.connect_time = None # Seconds taken to connect and negotiate framing.
+        self.posted = [] # Seconds from sending each chat message to its !POSTED!.
+        self.received = 0 # Public messages received from other clients.
+        self.errors = 0 # Errors the server reported.
+
+    async def run(self, port, started, origin, speed):
+        '''Replays this connection; started is when the replay began, origin when the recording did.'''
+        writer = reader = None
+        try:
+            for logged, event, msg in self.events:
+                due = started + ((logged - origin) / speed if speed else 0)
+                await asyncio.sleep(due - time.perf_counter())
+                self.lags.append(max(0, time.perf_counter() - due))
+                if event == CONNECT:
+                    opened = time.perf_counter()
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(HELLO)
+                    await reader.readexactly(len(HELLO))
+                    self.connect_time = time.perf_counter() - opened
+                    reader = asyncio.ensure_future(self.read(reader))
+                elif event == MESSAGE:
+                    if msg.split(' ', 1)[0] in COMMANDS:
+                        writer.write(encode_text(CONTROL, msg))
+                    else:
+                        self.sent.append(time.perf_counter())
+                        writer.write(encode_text(CHAT, msg))
+                    await writer.drain()
+                else:
+                    break
+        finally:
+            if writer:
+                writer.close()
+                reader.cancel()
+
+    async def read(self, reader):
+        '''Reads everything the server sends this client, timing its !POSTED! replies.'''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            arrived = time.perf_counter()
+            for kind, payload in self.decoder.feed(data):
+                if kind == POST:
+                    self.received += 1
+                elif kind == ERROR:
+                    self.errors += 1
+                elif kind == CONTROL and payload.startswith(POSTED.encode(ENCODING)) and self.sent:
+                    self.posted.append(arrived - self.sent.popleft())
+
+
+async def run_replay(server, paths, speed=1):
+    '''
+    Replays a recorded session against the server: every connection the admin
+    logs at paths saw connects, sends what it sent and closes, on the recorded
+    schedule sped up speed times, or as fast as possible if speed is 0.
+    Reports how well the server kept up: how far behind schedule the replay
+    fell, connect and posting latency, and the server's peak memory and threads.
+    '''
+    sessions = read_trace(paths)
+    if not sessions:
+        raise RuntimeError(f'no connections found in {", ".join(paths)}')
+    origin = min(events[0][0] for events in sessions)
+    recorded = max(events[-1][0] for events in sessions) - origin
+    if not recorded: # An untimed log (see read_trace); there is no pace to keep.
+        speed = 0
+    clients = [ReplayClient(events) for events in sessions]
+    with Monitor(server) as monitor:
+        started = time.perf_counter()
+        await asyncio.gather(*(client.run(server.port, started, origin, speed) for client in clients))
+        elapsed = time.perf_counter() - started
+
+    lags = [lag for client in clients for lag in client.lags]
+    return {
+        'engine': server.engine,
+        'speed': speed or 'max',
+        'trace_connections': len(sessions),
+        'trace_messages': sum(event == MESSAGE for events in sessions for _, event, _ in events),
+        'trace_seconds': recorded,
+        'seconds': elapsed,
+        'speed_achieved': recorded / elapsed if elapsed and recorded else None,
+        **latency_ms('behind_schedule', lags),
+        'behind_schedule_ms_max': max(lags) * 1000,
+        **latency_ms('connect', [c.connect_time for c in clients if c.connect_time is not None]),
+        **latency_ms('posted', [took for client in clients for took in client.posted]),
+        'messages_delivered': sum(client.received for client in clients),
+        'server_errors_reported': sum(client.errors for client in clients),
+        'server_exceptions': server.exceptions(),
+        **monitor.result(),
+    }
+
+
+def replay_speed(text):
+    '''Parses --speed: a multiple of the recorded pace, or max for as fast as possible (0).'''
+    if text == 'max':
+        return 0
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive, or max')
+    return speed
+
+
+# MAIN -------------------------------------------------------------------------
+
+def revision():
+    '''Returns the git revision of this tree, or None if it cannot be found.'''
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+            cwd=os.path.dirname(SERVER_SCRIPT), check=True
+        ).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    '''Runs the scenario chosen on the command line; prints, and optionally saves, its result.'''
+    server_args = ['--workers', str(args.workers), *shlex.split(args.server_args)]
+    with ServerProcess(args.p, args.engine, server_args, args.workers) as server:
+        if args.scenario == 'load':
+            run = run_load(server, args.n, args.seconds, args.post_rate, args.size)
+        elif args.scenario == 'slow':
+            run = run_slow_readers(server, args.n, args.seconds, args.post_rate, args.size,
+                                   args.slow)
+        elif args.scenario == 'storm':
+            run = run_storm(server, args.n)
+        elif args.scenario == 'history':
+            run = run_history_storm(server, args.n, args.messages, args.size)
+        elif args.scenario == 'churn':
+            run = run_churn(server, args.n, args.seconds, args.rate)
+        elif args.scenario == 'throughput':
+            run = run_throughput(server, args.n, args.senders, args.messages)
+        elif args.scenario == 'replay':
+            run = run_replay(server, args.trace, args.speed)
+        else:
+            run = run_benchmark(server, args.n, args.rounds)
+        result = asyncio.run(run)
+    result['server_workers'] = args.workers
+    for key, value in result.items():
+        print(f'{key:32} {value:.3f}' if isinstance(value, float) else f'{key:32} {value}')
+
+    if args.json:
+        record = {
+            'minchat': VERSION,
+            'revision': revision(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'scenario': args.scenario,
+            'options': {key: value for key, value in vars(args).items() if key != 'json'},
+            'result': result,
+        }
+        with open(args.json, 'w') as out:
+            json.dump(record, out, indent=2)
+            out.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MinChat Server Benchmark')
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help='Server engine to benchmark (default thread)')
+    parser.add_argument('-p', metavar='PORT', type=int, default=DEFAULT_PORT,
+                        help=f'TCP port for the benchmark server (default {DEFAULT_PORT})')
+    parser.add_argument('-n', metavar='CLIENTS', type=int, default=1000,
+                        help='Number of clients, or bots, to connect (default 1000)')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='Number of broadcasts timed for fan-out latency (default 20)')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='fanout',
+                        help='; '.join(f'{name}: {what}' for name, what in SCENARIOS.items()) +
+                        ' (default fanout)')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='How long the load, slow and churn scenarios run (default 10)')
+    parser.add_argument('--post-rate', type=float, default=POST_RATE,
+                        help=f'Messages per second each bot posts (default {POST_RATE})')
+    parser.add_argument('--size', type=int, default=MESSAGE_SIZE,
+                        help=f'Bytes in each bot message (default {MESSAGE_SIZE})')
+    parser.add_argument('--slow', type=int, default=SLOW_READERS,
+                        help=f'Slow readers added in the slow scenario (default {SLOW_READERS})')
+    parser.add_argument('--rate', type=float, default=CHURN_RATE,
+                        help=f'Broadcasts per second during the churn scenario (default {CHURN_RATE})')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Worker processes the server runs (default 1; see minserver --workers)')
+    parser.add_argument('--senders', type=int, default=SENDERS,
+                        help=f'Clients posting in the throughput scenario (default {SENDERS})')
+    parser.add_argument('--messages', type=int, default=MESSAGES,
+                        help='Messages each sender posts in the throughput scenario ' +
+                        f'(default {MESSAGES}), or posted before the history storm')
+    parser.add_argument('--trace', metavar='ADMIN_LOG', nargs='+',
+                        help='Admin logs of the session the replay scenario replays ' +
+                        '(with --workers, every session_..._admin_worker{n}.txt); ' +
+                        'logs without timestamps, from older servers, replay at max speed')
+    parser.add_argument('--speed', type=replay_speed, default=1,
+                        help='Replay at this multiple of the recorded pace, e.g. 10, ' +
+                        'or max for as fast as possible (default 1)')
+    parser.add_argument('--server-args', metavar='ARGS', default='',
+                        help="Extra minserver options, e.g. '--slow-policy summarize'")
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write the result, and how it was produced, to FILE as JSON')
+    args = parser.parse_args()
+    if args.scenario == 'replay' and not args.trace:
+        parser.error('the replay scenario needs --trace')
+
+    main(args)
@@ -0,0 +1,463 @@
+# MinChat - minchatlib - Alpha 0.2
+# A headless client library, for bots and integrations: no GUI, no prompts.
+
+# MODULES ----------------------------------------------------------------------
+
+import asyncio, threading
+import socket as skt
+from collections import deque, namedtuple
+from minproto import (
+    HELLO, CHAT, HIST as HIST_FRAME, CONTROL, ERROR, POST, CODECS,
+    FrameDecoder, encode_text, decode_post, unpack_records
+)
+
+# GLOBAL CONSTANTS -------------------------------------------------------------
+
+ENCODING = 'ascii'
+DEFAULT_PORT = 1060
+DEFAULT_ROOM = 'lobby' # Room every client starts in.
+HIST = '!HIST!'
+HIST_END = '!HIST_END!' # !HIST_END! <first seq>: ends a page of history.
+HIST_SINCE = 'since'
+SEARCH = '!SEARCH!'
+SEARCH_END = '!SEARCH_END!' # !SEARCH_END! <seq>: ends search results; -1 if there are no more.
+SEARCH_BEFORE = 'before'
+POSTED = '!POSTED!' # !POSTED! <seq>: the number our own message was given.
+JOIN = '!JOIN!'
+JOINED = '!JOINED!' # !JOINED! <room>: the room's history follows.
+LEAVE = '!LEAVE!'
+NAME = '!NAME!'
+COMPRESS = '!COMPRESS!' # !COMPRESS! <codec>...: offers the server codecs; it answers with one.
+HEARTBEAT = '!HEARTBEAT!' # Tells the server we answer PING, so it can tell when we are gone.
+PING = '!PING!' # !PING! <token>: answered with !PONG! <token>.
+PONG = '!PONG!'
+HELLO_TIMEOUT = 2 # Seconds to wait for the server to accept framing.
+RECV_SIZE = 65536
+INBOX_SIZE = 1000 # Default messages held for the reader; the oldest are dropped past this.
+
+# What a client receives. kind is one of:
+#   'post'    - a public message in the client's room; seq is its number.
+#   'history' - a message from the room's history, sent on joining it; seq as above.
+#   'search'  - a message of the room's found by search(); seq as above.
+#   'chat'    - a message from the server to this client alone; seq is None.
+#   'control' - a reply to a command, e.g. '!JOINED! dev' or '!ROOMS! lobby:3'.
+#   'error'   - an error the server reported.
+Message = namedtuple('Message', 'kind text seq')
+
+
+# SESSION ----------------------------------------------------------------------
+
+class Session:
+    '''
+    Protocol handling shared by Client and AsyncClient. This class turns the
+    frames a server sends into Messages, and keeps track of the client's room
+    and the last sequence number it has seen there, which a client that
+    reconnects can pass to history(since=...) for what it missed.
+    Subclasses provide the I/O, wake(), to rouse a waiting reader, and
+    answer(), to send a frame from the reader, e.g. to answer a PING.
+
+    Requires a server that speaks framing (Alpha 0.2 or later).
+    '''
+
+    def __init__(self, host, port, name, inbox_size, compress):
+        self.host = host # Address of the server.
+        self.port = port # Port the server listens at.
+        self.name = name # Username posted under, and given to the server; None to post raw text.
+        self.room = DEFAULT_ROOM # Room the client is in.
+        self.last_seq = None # Highest sequence number seen in this room.
+        self.decoder = FrameDecoder() # Reassembles frames from received bytes.
+        self.inbox = deque(maxlen=inbox_size) # Messages not yet read.
+        self.dropped = 0 # Messages dropped because the inbox was full.
+        self.page = [] # Records of the history page being received.
+        self.replays = 0 # History pages due for rooms joined, not asked for by history().
+        self.pages = deque() # Pending history() and search() calls, oldest first; each is told its page.
+        self.closed = False # Set once the connection is gone.
+        self.compress = compress # Whether to offer the server compression (see CODECS).
+        self.codec = None # Codec the server chose, once it has answered.
+
+    def greeting(self):
+        '''Returns the commands sent on connecting: heartbeats, compression, and the client's name.'''
+        frames = encode_text(CONTROL, HEARTBEAT)
+        if self.compress:
+            frames += encode_text(CONTROL, f"{COMPRESS} {' '.join(CODECS)}")
+        if self.name:
+            frames += encode_text(CONTROL, f'{NAME} {self.name}')
+        return frames
+
+    def post_frame(self, text):
+        '''Returns the frame posting text, under the client's name if it has one.'''
+        return encode_text(CHAT, f'{self.name}: {text}' if self.name else text)
+
+    def history_frame(self, count=None, before=None, since=None):
+        '''Returns the frame asking for history (see history()).'''
+        if since is not None:
+            return encode_text(CONTROL, f'{HIST} {HIST_SINCE} {since}')
+        words = [HIST]
+        if count is not None or before is not None:
+            words += [str(-1 if count is None else count), str(-1 if before is None else before)]
+        return encode_text(CONTROL, ' '.join(words))
+
+    def search_frame(self, words, before=None):
+        '''Returns the frame asking for a search (see search()).'''
+        if not words.split():
+            raise ValueError('nothing to search for')
+        # Always bounded, -1 for none, so a first word "before" is not taken for the keyword:
+        before = -1 if before is None else before
+        return encode_text(CONTROL, f'{SEARCH} {SEARCH_BEFORE} {before} {words}')
+
+    def seen(self, seq):
+        '''Records that the message numbered seq, in the current room, has been seen.'''
+        self.last_seq = seq if self.last_seq is None else max(self.last_seq, seq)
+
+    def receive(self, data):
+        '''
+        Handles bytes received from the server: new Messages go to the inbox,
+        and each history page or search result to the call waiting for it;
+        a page no call waits for, e.g. one asked for with command(), goes to
+        the inbox too. Returns the list of pages completed, for the subclass
+        to hand out.
+        '''
+        messages, completed = [], []
+        for kind, payload in self.decoder.feed(data):
+            if kind == POST:
+                seq, text = decode_post(payload)
+                self.seen(seq)
+                messages.append(Message('post', text, seq))
+            elif kind == HIST_FRAME:
+                self.page.extend(unpack_records(payload))
+            elif kind == CHAT:
+                messages.append(Message('chat', payload.decode(ENCODING), None))
+            elif kind == ERROR:
+                messages.append(Message('error', payload.decode(ENCODING), None))
+            elif kind == CONTROL:
+                text = payload.decode(ENCODING)
+                words = text.split()
+                if words[:1] == [HIST_END]:
+                    first = int(words[1])
+                    page = [Message('history', line, first + n) for n, line in enumerate(self.page)]
+                    self.page = []
+                    if page:
+                        self.seen(page[-1].seq)
+                    if self.replays: # Sent on joining a room; part of the stream.
+                        self.replays -= 1
+                        messages.extend(page)
+                    elif len(completed) < len(self.pages):
+                        completed.append(page)
+                    else:
+                        messages.extend(page)
+                elif words[:1] == [SEARCH_END]:
+                    lines = (line.partition(' ') for line in self.page)
+                    page = [Message('search', msg, int(seq)) for seq, _, msg in lines]
+                    self.page = []
+                    if len(completed) < len(self.pages):
+                        completed.append(page)
+                    else:
+                        messages.extend(page)
+                elif words[:1] == [PING]:
+                    self.answer(encode_text(CONTROL, ' '.join([PONG, *words[1:]])))
+                elif words[:1] == [POSTED]:
+                    self.seen(int(words[1]))
+                elif words[:1] == [COMPRESS]:
+                    self.codec = words[1] if words[1:2] != ['none'] else None
+                else:
+                    if words[:1] == [JOINED]:
+                        self.room, self.last_seq = words[1], None
+                        self.replays += 1
+                    messages.append(Message('control', text, None))
+
+        for message in messages:
+            if len(self.inbox) == self.inbox.maxlen:
+                self.dropped += 1
+            self.inbox.append(message)
+        if messages:
+            self.wake()
+        return completed
+
+
+# CLIENT -----------------------------------------------------------------------
+
+class Client(Session):
+    '''
+    The threaded flavour: each client reads from the server on a thread of
+    its own, and every method blocks the caller until it is done. Safe to use
+    from several threads at once.
+
+        with Client('127.0.0.1', name='bot').connect() as client:
+            client.send('hello')
+            for message in client:
+                print(message.text)
+    '''
+
+    def __init__(self, host, port=DEFAULT_PORT, name=None, inbox_size=INBOX_SIZE, compress=True):
+        super().__init__(host, port, name, inbox_size, compress)
+        self.socket = None # Connection to the server; set by connect().
+        self.lock = threading.Lock() # Keeps frames sent from different threads whole.
+        self.ready = threading.Condition() # Notified when the inbox fills, or the connection closes.
+        self.reader = threading.Thread(target=self.read, daemon=True) # Reads from the server.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        '''Yields each Message as it arrives, until the connection closes.'''
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def connect(self):
+        '''Connects to the server and negotiates framing; returns the client.'''
+        self.socket = skt.create_connection((self.host, self.port))
+        self.socket.sendall(HELLO)
+        self.socket.settimeout(HELLO_TIMEOUT)
+        reply = b''
+        try:
+            while len(reply) < len(HELLO):
+                data = self.socket.recv(len(HELLO) - len(reply))
+                if not data:
+                    break
+                reply += data
+        except skt.timeout:
+            pass
+        if reply != HELLO:
+            self.socket.close()
+            raise ConnectionError(f'{self.host}:{self.port} does not speak MinChat framing')
+        self.socket.settimeout(None)
+        self.reader.start()
+        self.write(self.greeting())
+        return self
+
+    def write(self, frame):
+        with self.lock:
+            self.socket.sendall(frame)
+
+    def send(self, text):
+        '''Posts text to the client's room, as 'name: text' if the client has a name.'''
+        self.write(self.post_frame(text))
+
+    def command(self, text):
+        '''Sends the server a command, e.g. '!ROOMS!'; any reply arrives as a 'control' Message.'''
+        self.write(encode_text(CONTROL, text))
+
+    def join(self, room):
+        '''Moves to room; a 'control' Message and the room's history follow.'''
+        self.command(f'{JOIN} {room}')
+
+    def leave(self):
+        '''Goes back to the lobby.'''
+        self.command(LEAVE)
+
+    def history(self, count=None, before=None, since=None):
+        '''
+        Returns a page of the room's history, as 'history' Messages: the last
+        count messages before seq before, or every message after seq since,
+        or by default every message the server holds in memory.
+        '''
+        request = [threading.Event(), None]
+        with self.ready:
+            self.pages.append(request)
+        self.write(self.history_frame(count, before, since))
+        request[0].wait()
+        if request[1] is None:
+            raise ConnectionError('connection closed before history arrived')
+        return request[1]
+
+    def search(self, words, before=None):
+        '''
+        Returns the newest messages in the room holding every one of words
+        (a string), as 'search' Messages, newest first; a page at a time, so
+        pass the last one's seq as before for the page ahead of it.
+        '''
+        frame = self.search_frame(words, before)
+        request = [threading.Event(), None]
+        with self.ready:
+            self.pages.append(request)
+        self.write(frame)
+        request[0].wait()
+        if request[1] is None:
+            raise ConnectionError('connection closed before search results arrived')
+        return request[1]
+
+    def next_message(self, timeout=None):
+        '''Returns the next Message; None once the connection has closed, or after timeout.'''
+        with self.ready:
+            self.ready.wait_for(lambda: self.inbox or self.closed, timeout)
+            return self.inbox.popleft() if self.inbox else None
+
+    def read(self):
+        '''Runs on the reader thread: reads from the server until the connection closes.'''
+        try:
+            while True:
+                try:
+                    data = self.socket.recv(RECV_SIZE)
+                except OSError:
+                    data = b'' # Closed from this side.
+                if not data:
+                    break
+                with self.ready:
+                    for page in self.receive(data):
+                        request = self.pages.popleft()
+                        request[1] = page
+                        request[0].set()
+        finally: # However the reader stops, nothing waits on it forever.
+            with self.ready:
+                self.closed = True
+                self.ready.notify_all()
+                for request in self.pages: # Their replies will never come.
+                    request[0].set()
+
+    def wake(self):
+        '''Rouses a thread waiting in next_message (call with ready held).'''
+        self.ready.notify_all()
+
+    def answer(self, frame):
+        '''Sends a frame from the reader thread.'''
+        self.write(frame)
+
+    def close(self):
+        '''Closes the connection; iteration ends once the inbox is read.'''
+        if self.socket is None:
+            return
+        try:
+            self.socket.shutdown(skt.SHUT_RDWR) # Wakes the reader from recv.
+        except OSError:
+            pass # Already closed.
+        self.socket.close()
+
+
+# ASYNC CLIENT -----------------------------------------------------------------
+
+class AsyncClient(Session):
+    '''
+    The asyncio flavour: each client is read by a task, so one process can
+    run hundreds of them on one event loop.
+
+        async with await AsyncClient('127.0.0.1', name='bot').connect() as client:
+            await client.send('hello')
+            async for message in client:
+                print(message.text)
+    '''
+
+    def __init__(self, host, port=DEFAULT_PORT, name=None, inbox_size=INBOX_SIZE, compress=True):
+        super().__init__(host, port, name, inbox_size, compress)
+        self.reader = None # Streams to and from the server; set by connect().
+        self.writer = None
+        self.ready = asyncio.Event() # Set when the inbox fills, or the connection closes.
+        self.task = None # Reads from the server.
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.next_message()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        '''Connects to the server and negotiates framing; returns the client.'''
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(HELLO)
+        try:
+            reply = await asyncio.wait_for(self.reader.readexactly(len(HELLO)), HELLO_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            reply = b''
+        if reply != HELLO:
+            self.writer.close()
+            raise ConnectionError(f'{self.host}:{self.port} does not speak MinChat framing')
+        self.task = asyncio.create_task(self.read())
+        await self.write(self.greeting())
+        return self
+
+    async def write(self, frame):
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def send(self, text):
+        '''Posts text to the client's room, as 'name: text' if the client has a name.'''
+        await self.write(self.post_frame(text))
+
+    async def command(self, text):
+        '''Sends the server a command, e.g. '!ROOMS!'; any reply arrives as a 'control' Message.'''
+        await self.write(encode_text(CONTROL, text))
+
+    async def join(self, room):
+        '''Moves to room; a 'control' Message and the room's history follow.'''
+        await self.command(f'{JOIN} {room}')
+
+    async def leave(self):
+        '''Goes back to the lobby.'''
+        await self.command(LEAVE)
+
+    async def history(self, count=None, before=None, since=None):
+        '''The AsyncClient counterpart to Client.history.'''
+        page = asyncio.get_running_loop().create_future()
+        self.pages.append(page)
+        await self.write(self.history_frame(count, before, since))
+        return await page
+
+    async def search(self, words, before=None):
+        '''The AsyncClient counterpart to Client.search.'''
+        frame = self.search_frame(words, before)
+        page = asyncio.get_running_loop().create_future()
+        self.pages.append(page)
+        await self.write(frame)
+        return await page
+
+    async def next_message(self):
+        '''Returns the next Message, or None once the connection has closed.'''
+        while not self.inbox and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.inbox.popleft() if self.inbox else None
+
+    async def read(self):
+        '''Runs as the reader task: reads from the server until the connection closes.'''
+        try:
+            while True:
+                try:
+                    data = await self.reader.read(RECV_SIZE)
+                except ConnectionError:
+                    data = b''
+                if not data:
+                    break
+                for page in self.receive(data):
+                    waiter = self.pages.popleft()
+                    if not waiter.done(): # Cancelled, e.g. by asyncio.wait_for timing out.
+                        waiter.set_result(page)
+        finally: # However the reader stops, nothing waits on it forever.
+            self.closed = True
+            self.ready.set()
+            for waiter in self.pages: # Their replies will never come.
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError('connection closed before its reply arrived'))
+
+    def wake(self):
+        '''Rouses a task waiting in next_message.'''
+        self.ready.set()
+
+    def answer(self, frame):
+        '''Sends a frame from the reader task, without waiting for it to be written.'''
+        self.writer.write(frame)
+
+    async def close(self):
+        '''Closes the connection; iteration ends once the inbox is read.'''
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self.task:
+            await self.task
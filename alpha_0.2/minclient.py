@@ -3,14 +3,20 @@
 # MODULES ----------------------------------------------------------------------
 
 import threading
-import os, sys, argparse
+import os, sys, queue, argparse
+from collections import deque
 import socket as skt
 import tkinter as tkr
+from minproto import (
+    HELLO, CHAT, HIST as HIST_FRAME, CONTROL, ERROR, POST, CODECS,
+    FrameDecoder, FrameError, encode_text, decode_post, unpack_records, hello_version
+)
 
 # GLOBAL CONSTANTS -------------------------------------------------------------
 
 ENCODING = 'ascii'
 DEFAULT_PORT = 1060
+DEFAULT_ROOM = 'lobby' # Room every client starts in.
 SPLASH = '''
 +==+---------------------------------------------------------------------------+==+
 
@@ -33,6 +39,40 @@ EXIT_MSG = 'Quitting MinChat client .. .  .   .    .     .      .       .'
 PROMPT = lambda n: print(f"{n} -> ", end='') # 'Username: message goes here'
 HIST = '!HIST!'
 HIST_RET = '!HIST_RETURN!'
+HIST_END = '!HIST_END!' # !HIST_END! <first seq>: ends a page of history.
+SEARCH = '!SEARCH!' # !SEARCH! [before <seq>] <words>: find the room's messages holding words.
+SEARCH_RET = '!SEARCH_RETURN!'
+SEARCH_END = '!SEARCH_END!' # !SEARCH_END! <seq>: ends search results; -1 if there are no more.
+SEARCH_BEFORE = 'before'
+JOIN = '!JOIN!' # !JOIN! <room>: move to another room.
+JOINED = '!JOINED!'
+LEAVE = '!LEAVE!' # Go back to the lobby.
+ROOMS = '!ROOMS!' # List the server's rooms.
+NAME = '!NAME!' # Tells the server our username, so it can message us by name.
+COMPRESS = '!COMPRESS!' # Offers the server our compression codecs, best first.
+HEARTBEAT = '!HEARTBEAT!' # Tells the server we answer PING, so it can tell when we are gone.
+PING = '!PING!' # !PING! <token>: answered with !PONG! <token>.
+PONG = '!PONG!'
+COMMANDS = (HIST, SEARCH, JOIN, LEAVE, ROOMS) # Typed as-is; sent to the server as commands.
+HELLO_TIMEOUT = 2 # Seconds to wait for the server to accept framing.
+LEGACY_RECV_SIZE = 1024 # Older servers send one message per read.
+RECV_SIZE = 65536 # Framed data can be read in large chunks.
+DRAIN_INTERVAL = 50 # Milliseconds between showing what has arrived in the GUI...
+DRAIN_BATCH = 500 # ... up to this many received entries at a time.
+SCROLLBACK = 2000 # Lines the GUI keeps while showing the newest messages...
+SCROLLBACK_MAX = 10000 # ... and at most, while scrolled back through older ones.
+PAGE_SIZE = 200 # Older messages loaded at a time on scrolling to the top.
+SEND_LOCK = threading.Lock() # Keeps messages sent from the Tk, Send and Receive threads whole.
+
+
+def send_msg(socket, framed, msg, kind=CHAT):
+    '''
+    Sends a message to the server, framed if the server accepted framing.
+    Safe to call from any thread: one message is sent at a time.
+    '''
+    data = encode_text(kind, msg) if framed else msg.encode(ENCODING)
+    with SEND_LOCK:
+        socket.sendall(data)
 
 
 
@@ -41,10 +81,11 @@ HIST_RET = '!HIST_RETURN!'
 class Send(threading.Thread):
     '''Sends input from the client terminal to the server.'''
 
-    def __init__(self, socket, name):
+    def __init__(self, socket, name, framed):
         super().__init__()
         self.socket = socket # Connection with server
         self.name = name # Username
+        self.framed = framed # Whether the server accepted framing.
 
 
     def run(self):
@@ -55,52 +96,46 @@ class Send(threading.Thread):
             msg = sys.stdin.readline()[:-1] # Read line (not including last character)
 
             if msg == 'QUIT':
-                self.socket.sendall(f'SERVER: {self.name} has left the chatroom.'.encode(ENCODING))
+                send_msg(self.socket, self.framed, f'SERVER: {self.name} has left the chatroom.')
                 print(EXIT_MSG)
                 self.socket.close() # Close connection with server and exit program.
                 os._exit(0)
+            elif msg.split(' ')[0] in COMMANDS:
+                send_msg(self.socket, self.framed, msg, CONTROL)
             else:
                 # Send message to server for posting:
-                self.socket.sendall(f'{self.name}: {msg}'.encode(ENCODING))
+                send_msg(self.socket, self.framed, f'{self.name}: {msg}')
 
 
 # RECEIVE ----------------------------------------------------------------------
 
 class Receive(threading.Thread):
-    '''Receives input from server to display to client user.'''
+    '''
+    Receives input from server to display to client user. Nothing is shown
+    from this thread: what arrives is queued on updates, and the GUI's
+    Scrollback shows it from the Tk main loop.
+    '''
 
-    def __init__(self, socket, name):
+    def __init__(self, socket, name, framed):
         super().__init__()
         self.socket = socket  # Connection to server.
         self.name = name  # Username
-        self.msg_box = None # GUI element used to display messages.
+        self.framed = framed # Whether the server accepted framing.
+        self.decoder = FrameDecoder() # Reassembles frames from received bytes.
+        self.updates = queue.SimpleQueue() # (room, first seq or None, lines) to be shown.
+        self.room = DEFAULT_ROOM # Room the client is in; public messages are numbered per room.
+        self.page = [] # Lines of the history page being received.
 
 
     def run(self):
         while True:
             # Blocks until data received from server.
-            # Returns '' if connection closed.
-            msg = self.socket.recv(1024).decode(ENCODING)
-
-            if msg:
-                if self.msg_box:
-                    # GUI ready:
-                    if msg.split('|')[0].strip() == HIST_RET:
-                        for line in msg.split('|')[1:]:
-                            print(f'\r{line}')
-                            self.msg_box.insert(tkr.END, line) # Append message to GUI container.
-                    else:
-                        print(f'\r{msg}')
-                        self.msg_box.insert(tkr.END, msg) # Append message to GUI container.
-                    PROMPT(self.name)
-                else:
-                    # GUI not ready yet:
-                    if msg.split('|')[0].strip() == HIST_RET:
-                        for line in msg.split('|')[1:]:
-                            print(f'\r{line}')
-                    else:
-                        print(f'\r{msg}')
-                    PROMPT(self.name)
+            # Returns b'' if connection closed.
+            data = self.socket.recv(RECV_SIZE if self.framed else LEGACY_RECV_SIZE)
+
+            if data:
+                for update in self.decode(data):
+                    self.updates.put(update)
             else:
                 print('Connection lost with server:\n\tContact server admin.')
                 print(EXIT_MSG)
@@ -108,17 +143,192 @@ class Receive(threading.Thread):
                 os._exit(0)
 
 
+    def decode(self, data):
+        '''
+        Returns what to display for data received from the server, as a list of
+        (room, first, lines): first is the sequence number of lines[0] in room,
+        the rest being numbered consecutively, or None if they have none.
+        '''
+        if not self.framed:
+            msg = data.decode(ENCODING)
+            if msg.split('|')[0].strip() in (HIST_RET, SEARCH_RET):
+                return [(None, None, msg.split('|')[1:])]
+            return [(None, None, [msg])]
+
+        updates = []
+        try:
+            frames = self.decoder.feed(data)
+        except FrameError as error:
+            return [(None, None, [f'Protocol error from server: {error}'])]
+        for kind, payload in frames:
+            if kind == HIST_FRAME:
+                self.page.extend(unpack_records(payload))
+            elif kind == ERROR:
+                updates.append((None, None, [f'ERROR: {payload.decode(ENCODING)}']))
+            elif kind == CHAT:
+                updates.append((None, None, [payload.decode(ENCODING)]))
+            elif kind == POST:
+                seq, msg = decode_post(payload)
+                updates.append((self.room, seq, [msg]))
+            elif kind == CONTROL:
+                words = payload.decode(ENCODING).split()
+                if words[:1] == [HIST_END]:
+                    updates.append((self.room, int(words[1]), self.page))
+                    self.page = []
+                elif words[:1] == [SEARCH_END]:
+                    found = [f'  #{line}' for line in self.page] or ['  (no matches)']
+                    if words[1] != '-1':
+                        found.append(f'  ... more with {SEARCH} {SEARCH_BEFORE} {words[1]} <words>')
+                    updates.append((None, None, ['Search results:', *found]))
+                    self.page = []
+                elif words[:1] == [PING]:
+                    send_msg(self.socket, self.framed, ' '.join([PONG, *words[1:]]), CONTROL)
+                elif words[:1] == [JOINED]:
+                    self.room = words[1]
+                    updates.append((None, None, [f'--- You are now in #{words[1]} ---']))
+                elif words[:1] == [ROOMS]:
+                    rooms = (word.rpartition(':') for word in words[1:])
+                    updates.append((None, None, [
+                        'Rooms: ' + ', '.join(f'#{name} ({count})' for name, _, count in rooms)
+                    ]))
+        return updates
+
+
+# SCROLLBACK -------------------------------------------------------------------
+
+class Scrollback:
+    '''
+    The GUI's message box, kept to a bounded number of lines. What Receive
+    queues is shown in batches every DRAIN_INTERVAL ms on the Tk main loop,
+    the only thread that touches Tk, so a flood or a long history never
+    freezes the window. While the view follows the newest messages, lines
+    past SCROLLBACK are evicted from the top; scrolling to the top loads
+    older public messages back from the server, PAGE_SIZE at a time.
+    '''
+
+    def __init__(self, window, msg_box, scrollbar, client, updates):
+        self.window = window # Tk root; schedules drains.
+        self.msg_box = msg_box # Listbox showing the messages.
+        self.scrollbar = scrollbar # Scrollbar of msg_box.
+        self.client = client # Asks the server for older pages.
+        self.updates = updates # Queue of (room, first, lines) from Receive.
+        self.seqs = deque() # (room, seq) of each line in msg_box; seq is None if it has none.
+        self.room = DEFAULT_ROOM # Room of the newest public messages shown.
+        self.loading = False # Whether a page of older messages has been asked for.
+        self.floor = None # Oldest seq shown when the server last had nothing older.
+        msg_box.configure(yscrollcommand=self.scrolled)
+
+    def start(self):
+        '''Shows updates from now on.'''
+        self.window.after(DRAIN_INTERVAL, self.drain)
+
+    def drain(self):
+        '''Shows what has arrived since the last drain, then schedules the next.'''
+        following = self.msg_box.yview()[1] >= 1.0 # Whether the newest line is in view.
+        appended, seqs = [], []
+        for _ in range(DRAIN_BATCH):
+            try:
+                room, first, lines = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            numbered = [(room, None if first is None else first + n) for n in range(len(lines))]
+            oldest = self.oldest_seq()
+            if room is not None and room == self.room and self.loading:
+                if not lines: # The server holds nothing older.
+                    self.loading, self.floor = False, oldest
+                    continue
+                if oldest is not None and first + len(lines) <= oldest: # An older page.
+                    self.prepend(lines, numbered)
+                    continue
+            if room is not None:
+                self.room = room
+            appended.extend(lines)
+            seqs.extend(numbered)
+
+        if appended:
+            self.msg_box.insert(tkr.END, *appended)
+            self.seqs.extend(seqs)
+            sys.stdout.write(''.join(f'\r{line}\n' for line in appended))
+            PROMPT(self.client.name)
+            sys.stdout.flush()
+            limit = SCROLLBACK if following else SCROLLBACK_MAX
+            if len(self.seqs) > limit:
+                self.msg_box.delete(0, len(self.seqs) - limit - 1)
+                for _ in range(len(self.seqs) - limit):
+                    self.seqs.popleft()
+            if following:
+                self.msg_box.see(tkr.END)
+        self.window.after(DRAIN_INTERVAL, self.drain)
+
+    def prepend(self, lines, seqs):
+        '''Adds a page of older messages above the others, keeping the view where it was.'''
+        self.seqs.extendleft(reversed(seqs))
+        self.msg_box.insert(0, *lines)
+        self.msg_box.yview(len(lines))
+        self.loading = False
+
+    def oldest_seq(self):
+        '''Returns the sequence number of the oldest line shown from the current room, if any.'''
+        for room, seq in self.seqs:
+            if room == self.room and seq is not None:
+                return seq
+        return None
+
+    def scrolled(self, top, bottom):
+        '''Follows the message box as it scrolls; at the top, asks for older messages.'''
+        self.scrollbar.set(top, bottom)
+        if float(top) > 0 or float(bottom) >= 1 or self.loading:
+            return
+        if len(self.seqs) + PAGE_SIZE > SCROLLBACK_MAX:
+            return # Scroll down first; the oldest lines are evicted again.
+        oldest = self.oldest_seq()
+        if oldest and oldest != self.floor:
+            self.loading = True
+            send_msg(self.client.socket, self.client.framed, f'{HIST} {PAGE_SIZE} {oldest}', CONTROL)
+
+
 # CLIENT -----------------------------------------------------------------------
 
 class Client:
     '''Manages connection with server; instantiates Send and Receive threads.'''
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, legacy=False):
         self.host = host # Address of server hosting a chatroom.
         self.port = port # Port server is using for chatroom.
         self.socket = skt.socket(skt.AF_INET, skt.SOCK_STREAM) # Connection to server.
         self.name = None # Username
-        self.msg_box = None # GUI element used to display messages.
+        self.framed = False # Whether the server accepted framing.
+        self.legacy = legacy # Whether to speak the raw protocol without offering framing.
+        self.updates = None # Queue of what the GUI shows; Receive's, once started.
+
+
+    def negotiate(self):
+        '''
+        Offers framing to the server. Servers that predate framing never answer,
+        so after HELLO_TIMEOUT the client falls back to the raw protocol; such a
+        server takes the offer for a message, and shows it once in the room,
+        which --legacy avoids by not making it.
+        A framing server is also offered compression, for history and large messages,
+        and told the client answers heartbeats.
+        '''
+        if self.legacy:
+            return
+        self.socket.sendall(HELLO)
+        self.socket.settimeout(HELLO_TIMEOUT)
+        reply = b''
+        try:
+            while len(reply) < len(HELLO):
+                data = self.socket.recv(len(HELLO) - len(reply))
+                if not data:
+                    break
+                reply += data
+        except skt.timeout:
+            pass
+        self.socket.settimeout(None)
+        self.framed = bool(hello_version(reply))
+        if self.framed:
+            send_msg(self.socket, self.framed, f"{COMPRESS} {' '.join(CODECS)}", CONTROL)
+            send_msg(self.socket, self.framed, HEARTBEAT, CONTROL)
 
 
     def start(self):
@@ -137,6 +347,7 @@ class Client:
             self.socket.close() # If failure, close socket and terminate program.
             print(EXIT_MSG)
             os._exit(1)
+        self.negotiate()
         print(f'Connection with {self.host}:{self.port} established.')
 
         # Enter username for session:
@@ -147,14 +358,17 @@ class Client:
         )
 
         # Create and start threads for sending and receiving messages from server:
-        outbox = Send(self.socket, self.name)
-        inbox = Receive(self.socket, self.name)
+        outbox = Send(self.socket, self.name, self.framed)
+        inbox = Receive(self.socket, self.name, self.framed)
+        self.updates = inbox.updates
         outbox.start()
         inbox.start()
 
 
         # Notify chatroom that new client has joined:
-        self.socket.sendall(f'SERVER: {self.name} has entered the chatroom.'.encode(ENCODING))
+        if self.framed:
+            send_msg(self.socket, self.framed, f'{NAME} {self.name}', CONTROL)
+        send_msg(self.socket, self.framed, f'SERVER: {self.name} has entered the chatroom.')
         print("MinChat client initialized.\n\tDon't be shy.")
         PROMPT(self.name)
         
@@ -171,29 +385,28 @@ class Client:
 
         # Special commands:
         if msg == 'QUIT':
-            self.socket.sendall(f'SERVER: {self.name} has left the chatroom.'.encode(ENCODING))
+            send_msg(self.socket, self.framed, f'SERVER: {self.name} has left the chatroom.')
             print(EXIT_MSG)
             self.socket.close() # Close connection and terminate program.
             os._exit(0)
         # More can be implemented through special server behaviour upon reception
         # of certain keywords. Perhaps special rendering could be provided
         # for votes or surveys initiated within the chatroom. -Trianan
-        elif msg == HIST:
-            self.socket.sendall(msg.encode(ENCODING))
+        elif msg.split(' ')[0] in COMMANDS:
+            send_msg(self.socket, self.framed, msg, CONTROL)
         else:
             # Send message to server for posting:
-            self.socket.sendall(f'{self.name}: {msg}'.encode(ENCODING))
-            self.msg_box.insert(tkr.END, f'{self.name}: {msg}')
-            print(f'{self.name}: {msg}')
+            send_msg(self.socket, self.framed, f'{self.name}: {msg}')
+            self.updates.put((None, None, [f'{self.name}: {msg}']))
 
     
 
 # MAIN -------------------------------------------------------------------------
 
-def main(host, port):
+def main(host, port, legacy=False):
     '''Initializes and runs GUI. Takes server IP and port as arguments.'''
     # Initialize client and reference to receiving thread:
-    client = Client(host, port)
+    client = Client(host, port, legacy)
     inbox = client.start()
 
     # Create GUI window:
@@ -205,16 +418,16 @@ def main(host, port):
     scrollbar = tkr.Scrollbar(master=msg_frame)
     msg_box = tkr.Listbox(
         master=msg_frame,
-        yscrollcommand=scrollbar.set,
         fg='spring green',
         bg='black'
     )
+    scrollbar.configure(command=msg_box.yview)
     scrollbar.pack(side=tkr.RIGHT, fill=tkr.Y, expand=False)
     msg_box.pack(side=tkr.LEFT, fill=tkr.BOTH, expand=True)
 
-    # Assign GUI message frame to client's GUI outbox and inbox reference:
-    client.msg_box = msg_box
-    inbox.msg_box = msg_box
+    # Show what the client receives, in batches, from the Tk main loop:
+    scrollback = Scrollback(window, msg_box, scrollbar, client, inbox.updates)
+    scrollback.start()
 
     # Define messages spatial area, and a text input box:
     msg_frame.grid(row=0, column=0, columnspan=2, sticky='nsew')
@@ -262,8 +475,14 @@ if __name__ == '__main__':
         default=DEFAULT_PORT,
         help=f'TCP port of server. (default {DEFAULT_PORT})'
     )
+    arg_parser.add_argument(
+        '--legacy',
+        action='store_true',
+        help='Speak the original protocol, for a server that predates framing, ' +
+        'without first offering framing, which such a server would post to the room.'
+    )
     # Get arguments from command line:
     args = arg_parser.parse_args()
 
     # Start the client and GUI:
-    main(args.host, args.p)
\ No newline at end of file
+    main(args.host, args.p, args.legacy)
\ No newline at end of file
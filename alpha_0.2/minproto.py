@@ -0,0 +1,198 @@
+# MinChat - minproto - Alpha 0.2
+# Message framing shared by minserver and minclient.
+
+# MODULES ----------------------------------------------------------------------
+
+import struct, zlib
+try:
+    import zstandard # Optional; zlib is used without it.
+except ImportError:
+    zstandard = None
+
+# GLOBAL CONSTANTS -------------------------------------------------------------
+
+ENCODING = 'ascii'
+VERSION = 1 # Framing version spoken by this module.
+MAGIC = b'MCF' # MinChat Framing; first bytes a framing client sends.
+
+# A framing client opens with HELLO; the server answers with its own HELLO
+# to accept, after which both sides speak frames. A client that opens with
+# anything else is an older client, which gets the original raw protocol.
+HELLO = MAGIC + bytes([VERSION])
+
+# Every frame starts with a header: version, frame type, payload length.
+HEADER = struct.Struct('!BBI')
+MAX_PAYLOAD = 16 * 1024 * 1024 # Frames larger than this are a protocol error.
+
+# History payloads are a run of records, each prefixed by its length:
+RECORD = struct.Struct('!I')
+
+# Public messages relayed by the server are prefixed by their sequence number:
+SEQ = struct.Struct('!Q')
+
+# Frame types:
+CHAT = 1 # A chat message.
+HIST = 2 # A batch of history records.
+CONTROL = 3 # A command, e.g. a history request.
+ERROR = 4 # An error reported by the other side.
+POST = 5 # A public chat message and its sequence number, relayed by the server.
+RELAY = 6 # A public chat message passed between federated servers.
+COMPRESSED = 7 # One or more whole frames, compressed; see encode_compressed.
+FRAME_TYPES = (CHAT, HIST, CONTROL, ERROR, POST, RELAY, COMPRESSED)
+
+# Compression codecs this side can use, best first, and the id that marks each
+# in a COMPRESSED frame. Which one a connection uses is negotiated by command.
+CODECS = {'zstd': 2, 'zlib': 1} if zstandard else {'zlib': 1}
+CODEC_NAMES = {number: name for name, number in CODECS.items()}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class FrameError(Exception):
+    '''Raised when the other side breaks the framing protocol.'''
+
+
+# ENCODING ---------------------------------------------------------------------
+
+def encode_frame(kind, payload):
+    '''Returns a complete frame of the given type carrying payload (bytes).'''
+    return HEADER.pack(VERSION, kind, len(payload)) + payload
+
+
+def encode_text(kind, text):
+    '''Returns a complete frame of the given type carrying text.'''
+    return encode_frame(kind, text.encode(ENCODING))
+
+
+def encode_post(seq, text):
+    '''Returns a POST frame carrying a public message and its sequence number.'''
+    return encode_frame(POST, SEQ.pack(seq) + text.encode(ENCODING))
+
+
+def decode_post(payload):
+    '''Returns the sequence number and text carried by a POST frame.'''
+    if len(payload) < SEQ.size:
+        raise FrameError('POST frame too short for its sequence number')
+    (seq,) = SEQ.unpack_from(payload)
+    return seq, decode_text(payload[SEQ.size:])
+
+
+def decode_text(data):
+    '''Returns the text in data (bytes or a memoryview), raising FrameError if it is not text.'''
+    try:
+        return str(data, ENCODING)
+    except UnicodeDecodeError:
+        raise FrameError(f'Frame carries text that is not {ENCODING}')
+
+
+def encode_compressed(codec, frames):
+    '''
+    Returns a COMPRESSED frame carrying frames (bytes of one or more complete
+    frames), compressed with codec: its payload is the codec's id, then the
+    compressed frames. The other side decodes them as if sent uncompressed.
+    '''
+    if codec == 'zstd':
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(frames)
+    else:
+        data = zlib.compress(frames, ZLIB_LEVEL)
+    return encode_frame(COMPRESSED, bytes([CODECS[codec]]) + data)
+
+
+def decompress(payload):
+    '''Returns the frames carried by a COMPRESSED frame's payload, at most MAX_PAYLOAD bytes.'''
+    codec = CODEC_NAMES.get(payload[0]) if payload else None
+    try:
+        if codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(payload[1:], max_output_size=MAX_PAYLOAD)
+        if codec == 'zlib':
+            inflater = zlib.decompressobj()
+            frames = inflater.decompress(payload[1:], MAX_PAYLOAD)
+            if inflater.unconsumed_tail:
+                raise FrameError('Compressed frames too large')
+            return frames
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as error:
+        raise FrameError(f'Bad compressed frame: {error}')
+    raise FrameError(f'Unknown compression codec {payload[:1]!r}')
+
+
+def pack_records(lines):
+    '''Packs a list of strings into one history payload.'''
+    parts = []
+    for line in lines:
+        data = line.encode(ENCODING)
+        parts.append(RECORD.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_records(payload):
+    '''
+    Unpacks a history payload into the list of strings it carries; raises
+    FrameError if the records do not fit it exactly.
+    '''
+    lines = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < RECORD.size:
+            raise FrameError('Record length cut short')
+        (size,) = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        if len(view) - offset < size:
+            raise FrameError('Record longer than its frame')
+        lines.append(decode_text(view[offset:offset + size]))
+        offset += size
+    return lines
+
+
+# DECODING ---------------------------------------------------------------------
+
+def hello_version(data):
+    '''
+    Returns the framing version offered by a connection's first bytes,
+    0 if they come from an older client, or None if more bytes are needed.
+    '''
+    if data[:len(MAGIC)] != MAGIC[:len(data)]:
+        return 0
+    if len(data) < len(HELLO):
+        return None
+    return data[len(MAGIC)]
+
+
+class FrameDecoder:
+    '''
+    Incremental decoder: feed it bytes as they arrive from the socket, however
+    TCP happens to split or merge them, and it returns every complete frame.
+    COMPRESSED frames are returned as the frames they carry.
+    '''
+
+    def __init__(self, inflate=True):
+        self.buffer = bytearray() # Bytes received but not yet decoded.
+        self.inflate = inflate # Whether COMPRESSED frames are allowed; never within one.
+
+    def feed(self, data):
+        '''Buffers data; returns a list of (frame type, payload) for complete frames.'''
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            version, kind, size = HEADER.unpack_from(buffer, offset)
+            if version != VERSION or kind not in FRAME_TYPES or size > MAX_PAYLOAD:
+                raise FrameError(f'Bad frame header {(version, kind, size)}')
+            end = offset + HEADER.size + size
+            if len(buffer) < end:
+                break # Rest of this frame has not arrived yet.
+            payload = bytes(memoryview(buffer)[offset + HEADER.size:end])
+            offset = end
+            if kind != COMPRESSED:
+                frames.append((kind, payload))
+                continue
+            if not self.inflate:
+                raise FrameError('Compressed frame within a compressed frame')
+            inner = FrameDecoder(inflate=False)
+            frames.extend(inner.feed(decompress(payload)))
+            if inner.buffer:
+                raise FrameError('Compressed frames end part way through a frame')
+        del buffer[:offset] # Drop decoded frames in one move.
+        return frames
@@ -2,27 +2,165 @@
 
 # MODULES: ---------------------------------------------------------------------
 
-import threading
-import os, argparse
+import threading, asyncio, multiprocessing, subprocess, select, struct
+from collections import deque, OrderedDict
+from itertools import islice, count as counter
+import os, re, sys, hmac, json, time, queue, argparse
 import socket as skt
+from bisect import bisect_left
+from collections import Counter
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from minproto import (
+    HELLO, CHAT, HIST as HIST_FRAME, CONTROL, ERROR, POST, RELAY,
+    CODECS, FrameDecoder, FrameError, encode_frame, encode_text, encode_post, encode_compressed,
+    pack_records, unpack_records, hello_version
+)
+from minstore import (
+    TextStore, SegmentStore, SqliteStore, SearchIndex, SEGMENT_BYTES, SEARCH_PAGE, DEFAULT_ROOM
+)
 
 
 # GLOBAL CONSTANTS -------------------------------------------------------------
 
 ENCODING = 'ascii'
 DEFAULT_PORT = 1060
+BACKLOG = 1024 # Pending connections the listening socket will queue.
+ENGINES = ('thread', 'asyncio') # Available server engines (see --engine).
+LEGACY_RECV_SIZE = 1024 # Older clients expect each read to hold one message.
+RECV_SIZE = 65536 # Framing clients can be read in large chunks.
+WRITE_BATCH = 64 # Most queued frames written to a framing client in one call.
+COALESCE_WINDOW = 0.002 # Default seconds a framing client's writer waits for more to write at once.
+COALESCE_BYTES = 65536 # Default bytes queued for a client that are written without waiting.
+SCATTER = hasattr(skt.socket, 'sendmsg') # Whether batches can be written without joining them.
+QUEUE_LIMIT = 1000 # Default high-water mark, in messages, of each client's outbound queue.
+QUEUE_BYTES = 4 * 1024 * 1024 # Default high-water mark, in bytes, of each outbound queue.
+SLOW_POLICIES = ('drop', 'disconnect', 'summarize') # What to do when a queue passes its mark.
+FLOOD_POLICIES = ('delay', 'drop', 'disconnect') # What to do with messages over a rate limit.
+FLOOD_BURST = 2 # Default seconds of a rate limit a client may send in one burst.
+FLOOD_USERS = 10000 # Usernames whose rate is tracked before idle ones are forgotten.
+HEARTBEAT = 30 # Default seconds a client may be silent before it is pinged.
+HEARTBEAT_TIMEOUT = 10 # Default seconds a pinged client has to answer before it is reaped.
+WHEEL_TICK = 0.25 # Seconds between turns of the reaper's timer wheel; its precision.
+WHEEL_SLOTS = 512 # Slots in the timer wheel; checks further off than one turn wait for later turns.
+DEBUG, INFO, WARNING = 10, 20, 30 # Log levels; per-message detail is DEBUG.
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'quiet': WARNING + 10}
+FLUSH_INTERVAL = 0.05 # Default seconds the log writer gathers records before writing.
+FLUSH_BATCH = 256 # Default number of records that makes the log writer write at once.
+FSYNC_POLICIES = ('never', 'batch') # Whether each write of the logs is fsync'd.
 SESSION_START = datetime.today().isoformat().replace('T', '_').replace(':', '-')
 ADMIN_LOG = f"./session_{SESSION_START}_admin.txt"
 PUBLIC_LOG = f"./session_{SESSION_START}_client.txt"
+SEGMENT_DIR = f"./session_{SESSION_START}_segments" # Public log for --store segments.
+SEARCH_DIR = f"./session_{SESSION_START}_search" # Search index of the public log.
+DATABASE = './minchat.db' # Default database for --store sqlite; shared by every session.
+BUS_SOCKET = f"./session_{SESSION_START}_bus.sock" # Unix socket joining --workers to the hub.
+HANDOFF_SOCKET = f"./session_{SESSION_START}_handoff.sock" # Where the h command's successor connects.
+HANDOFF_DRAIN = 5 # Seconds queued messages have to be written before clients are handed off.
+HANDOFF_BATCH = 250 # Sockets passed in one message; Linux allows at most 253.
+# A handoff message is a header, the size of its JSON and the number of sockets
+# passed with it, then the JSON:
+HANDOFF_HEADER = struct.Struct('!QI')
+STORES = ('text', 'segments', 'sqlite') # Available public log stores (see --store).
 HIST = '!HIST!'
 HIST_RET = '!HIST_RETURN!'
+HIST_END = '!HIST_END!' # Follows a page of history sent to a framing client.
+HIST_SINCE = 'since' # !HIST! since <seq>: every public message after seq.
+POSTED = '!POSTED!' # Tells a framing client the sequence number of its own message.
+SEARCH = '!SEARCH!' # !SEARCH! [before <seq>] <words>: the room's newest messages holding every word.
+SEARCH_RET = '!SEARCH_RETURN!'
+SEARCH_END = '!SEARCH_END!' # Follows search results sent to a framing client.
+SEARCH_BEFORE = 'before'
+HISTORY_SIZE = 1000 # Default number of recent public messages kept in memory, per room.
+JOIN = '!JOIN!' # !JOIN! <room>: move to a room, creating it if needed.
+JOINED = '!JOINED!' # Tells a client which room it is now in; its history follows.
+LEAVE = '!LEAVE!' # Go back to the lobby (DEFAULT_ROOM).
+ROOMS = '!ROOMS!' # List the rooms, with the number of clients in each.
+ROOM_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}\Z') # Room names are also used in log file names.
+ROOM_LIMIT = 256 # Most rooms a server will open.
+NAME = '!NAME!' # !NAME! <username>: tells the server a framing client's username.
+PEER = '!PEER!' # !PEER! <node>: the connection is a federated server, not a client.
+COMPRESS = '!COMPRESS!' # !COMPRESS! <codec>...: codecs a framing client reads; see CODECS.
+HEARTBEAT_CMD = '!HEARTBEAT!' # Tells the server a framing client answers PING; see Reaper.
+PING = '!PING!' # !PING! <token>: asks the other side to answer PONG with the same token.
+PONG = '!PONG!'
+COMPRESS_MIN = 1024 # Default size, in bytes, from which frames to a client are compressed.
+HISTORY_CACHE = 64 # Compressed history replies kept for reuse, across every room.
+PEER_RETRY = 5 # Seconds between attempts to reach a peer (see --peer).
+RELAYED_LIMIT = 100000 # Relayed message ids each room remembers, to drop repeats.
+LATENCY_BUCKETS = ( # Upper bounds, in seconds, of the latency histograms' buckets.
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+STAGES = { # Stages of the message pipeline timed with --profile; handle includes post, and so on.
+    'decode': 'framing: bytes received -> frames (Connection.receive)',
+    'handle': 'one received message: logging, commands, posting (Server.handle_msg)',
+    'post': 'numbering, logging, fan-out and relay of a public message (Server.post_msg)',
+    'fanout': "queuing a public message for each of a room's clients (Server.deliver)",
+    'log': 'queuing a record for the log writer (Server.log_message)',
+    'log_write': 'writing a batch of records to the logs and console (LogWriter.commit)',
+    'write': 'writing queued bytes to a client socket (the drain of either connection)',
+}
+STAGE_BUCKETS = tuple( # Upper bounds, in seconds, of the stage timers' buckets: 1 us to 1 s.
+    scale * step for scale in (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1) for step in (1, 2.5, 5)
+) + (1,)
+SAMPLE_INTERVAL = 0.005 # Seconds between stack samples taken by the p command.
+PROFILE = f"./session_{SESSION_START}_profile{{}}.folded" # Stack samples; numbered per run.
+CONNECTION_COUNTERS = { # Connection attribute -> what it counts, for Metrics.
+    'received': 'messages_in', 'received_bytes': 'bytes_in',
+    'sent': 'messages_out', 'sent_bytes': 'bytes_out', 'dropped': 'messages_dropped',
+    'writes': 'socket_writes', 'throttled': 'messages_throttled',
+}
+ENTERED = re.compile(r'SERVER: (.+) has entered the chatroom\.\Z') # Clients announce themselves.
 
-def get_public_log():
-    '''Returns the public chat log as a list of messages.'''
-    with open(PUBLIC_LOG, 'r') as p_log:
-        pl = p_log.readlines()[2:] # Slice gets rid of header in file.
-        return pl
+def username_of(msg):
+    '''Returns the username a chat message was posted under ('name: message').'''
+    name, sep, _ = msg.partition(': ')
+    return name if sep else None
+
+def claimed_name(msg):
+    '''
+    Returns the username a client's chat message shows it goes by: the name
+    in its announcement on entering, or else the name it posts under.
+    '''
+    entered = ENTERED.match(msg)
+    if entered:
+        return entered.group(1)
+    name = username_of(msg)
+    return name if name != 'SERVER' else None
+
+def log_header(title, host, port):
+    '''Returns the header written at the top of a log file.'''
+    return (
+        f'MinChat {title} Log - Session Start: {SESSION_START} - ' +
+        f'Server {host}:{port}\n' +
+        HRULE
+    )
+
+def admin_time(logged):
+    '''Returns the time a record was logged, as it is shown in the admin log.'''
+    return datetime.fromtimestamp(logged).isoformat(' ', 'microseconds')
+
+def room_log(path, room):
+    '''
+    Returns where a room's public log is kept: path itself for the lobby,
+    otherwise path with the room's name added (ahead of any .txt).
+    '''
+    if room == DEFAULT_ROOM:
+        return path
+    if path.endswith('.txt'):
+        return f'{path[:-len(".txt")]}_{room}.txt'
+    return f'{path}_{room}'
+
+def peer_ips(peers):
+    '''Returns the IP addresses of peers, (host, port) pairs, where their names resolve.'''
+    ips = set()
+    for host, port in peers:
+        try:
+            ips.update(info[4][0] for info in skt.getaddrinfo(host, port, type=skt.SOCK_STREAM))
+        except OSError:
+            ips.add(host) # Unresolvable for now; matches only a literal address.
+    return ips
 
 SPLASH = '''
 +==+---------------------------------------------------------------------------+==+
@@ -49,11 +187,61 @@ HRULE = '-----------------------------------------------------------------------
 
 class Server(threading.Thread):
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, queue_limit=QUEUE_LIMIT, queue_bytes=QUEUE_BYTES,
+                 slow_policy='drop', console_level=DEBUG, flush_interval=FLUSH_INTERVAL,
+                 flush_batch=FLUSH_BATCH, fsync='never', history_size=HISTORY_SIZE,
+                 new_store=None, admin_log=ADMIN_LOG, bus_path=None, node=None, peers=(),
+                 peer_secret=None,
+                 stats_port=None, profile=False, compress_min=COMPRESS_MIN,
+                 coalesce_window=COALESCE_WINDOW, coalesce_bytes=COALESCE_BYTES,
+                 flood=None, search_dir=SEARCH_DIR, heartbeat=HEARTBEAT,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, idle_timeout=None, takeover=None):
         super().__init__()
         self.host = host # Local computer's external IP address.
         self.port = port # Unused and unreserved port on local computer.
-        self.connections = [] # Active connections with clients.
+        self.node = node or f'{skt.gethostname()}:{port}' # Name of this server among its peers.
+        self.peer_addrs = list(peers) # (host, port) of each peer this server dials.
+        self.peer_ips = peer_ips(self.peer_addrs) # Addresses a peer may link from.
+        self.peer_secret = peer_secret # Lets a peer link from any address, if it knows it.
+        self.peers = Registry() # Links with federated servers, both dialed and accepted.
+        self.admin_log = admin_log # Admin log file.
+        self.bus = Bus(self, bus_path) if bus_path else None # Link to the hub, for a worker.
+        self.connections = Registry() # Active connections with clients.
+        self.queue_limit = queue_limit # Messages a client may have waiting to be sent.
+        self.queue_bytes = queue_bytes # Bytes a client may have waiting to be sent.
+        self.slow_policy = slow_policy # One of SLOW_POLICIES.
+        self.coalesce_window = coalesce_window # Seconds a client's writes wait to be combined; 0 for none.
+        self.coalesce_bytes = coalesce_bytes # Bytes of a client's writes that are combined at most.
+        self.flood = flood # FloodControl limiting how fast clients may send, if any.
+        self.takeover = takeover # Takeover from a previous server, when starting as its successor.
+        self.handing_off = False # Set once this server starts handing off to a successor.
+        self.wake_readers = os.pipe() # Written to once, to stop every reader for a handoff.
+        self.listener = None # Listening socket; set once the server starts.
+        self.reaper = None # Closes dead and idle connections, if either is looked for.
+        if heartbeat or idle_timeout:
+            self.reaper = Reaper(self, heartbeat, heartbeat_timeout, idle_timeout)
+        self.new_store = new_store or ( # Makes a room's public log; by default a TextStore.
+            lambda room: TextStore(room_log(PUBLIC_LOG, room), log_header('Public', host, port))
+        )
+        if self.bus: # The hub keeps the public logs of a worker's rooms.
+            self.new_store = lambda room: BusStore(self.bus, room)
+        self.log_writer = LogWriter( # Writes the log files; started with the session.
+            admin_log, console_level, flush_interval, flush_batch, fsync == 'batch'
+        )
+        self.history_size = history_size # Recent public messages each room keeps in memory.
+        self.search_dir = search_dir # Where rooms' search indexes are kept; None for no search.
+        self.rooms = {} # Open rooms, by name; a room stays open once created.
+        self.rooms_lock = threading.Lock() # Guards rooms.
+        self.lobby = None # Room every client starts in; opened with the session.
+        self.compress_min = compress_min # Frames this large are compressed, for clients that asked.
+        self.history_cache = OrderedDict() # (room, codec, first, count) -> compressed history reply.
+        self.history_cache_lock = threading.Lock() # Guards history_cache.
+        self.metrics = Metrics(self) # Counters and latencies; see the s command.
+        self.stats_port = stats_port # Local port serving self.metrics over HTTP, if any.
+        self.profiler = None # Times each stage of the message pipeline, with --profile.
+        if profile:
+            self.profiler = Profiler()
+            self.profiler.install(self)
     
     def run(self):
         '''
@@ -62,193 +250,2532 @@ class Server(threading.Thread):
             this spawns a new thread which manages the connection
             to the client alongside this thread.
         '''
-        print(SPLASH)
-        print('\nStarting minserver .. .  .   .    .     .      .       .        . \n')
+        self.start_session()
 
-        # Initialize log files:
-        with open(PUBLIC_LOG, 'w') as log:
-            log.write(
-                f'MinChat Public Log - Session Start: {SESSION_START} - ' +
-                f'Server {self.host}:{self.port}\n' +
-                HRULE
-            )
-        with open(ADMIN_LOG, 'w') as log:
-            log.write(
-                f'MinChat Administrator Log - Session Start: {SESSION_START} - ' +
-                f'Server {self.host}:{self.port}\n' +
-                HRULE
-            )
+        if self.takeover: # The previous server's listening socket, already bound.
+            socket = self.takeover.listener
+            socket.setblocking(True)
+        else:
+            # Socket object created with defined address family and socket type:
+            socket = skt.socket(skt.AF_INET, skt.SOCK_STREAM)
 
-        # Socket object created with defined address family and socket type:
-        socket = skt.socket(skt.AF_INET, skt.SOCK_STREAM)
+            # This allows server to reuse same port quickly
+            # after a connection is closed on that port:
+            socket.setsockopt(skt.SOL_SOCKET, skt.SO_REUSEADDR, 1)
+            if self.bus: # Workers all listen on the same port; the kernel spreads clients.
+                socket.setsockopt(skt.SOL_SOCKET, skt.SO_REUSEPORT, 1)
 
-        # This allows server to reuse same port quickly
-        # after a connection is closed on that port:
-        socket.setsockopt(skt.SOL_SOCKET, skt.SO_REUSEADDR, 1)
+            # Bind socket to socket address on local machine:
+            socket.bind((self.host, self.port))
 
-        # Bind socket to socket address on local machine:
-        socket.bind((self.host, self.port))
-
-        # The socket is then used as a listening-socket for 
-        # establishing incoming connections in the following loop:
-        socket.listen(1)
+            # The socket is then used as a listening-socket for 
+            # establishing incoming connections in the following loop:
+            socket.listen(BACKLOG)
+        self.listener = socket
         status_msg = f'SERVER STARTED SUCCESSFULLY.\nLISTENING AT: {socket.getsockname()}'
-        print(status_msg)
-        self.log_message(status_msg, False)
+        self.log_message(status_msg, False, INFO)
+        for address in self.peer_addrs:
+            threading.Thread(target=self.dial_peer, args=(address,), daemon=True).start()
+        if self.takeover:
+            self.take_over([
+                self.adopt(client_sock, state)
+                for client_sock, state in self.takeover.clients
+            ])
 
         while True:
             # Accept a new connection; blocks thread until one is received:
             client_sock, client_addr = socket.accept()
+            if self.handing_off:
+                # Most likely hand_off waking this thread; a client would reconnect.
+                client_sock.close()
+                return # Exit thread; the successor accepts from now on.
 
             status_msg = (
                 f'NEW CONNECTION: Client {client_sock.getpeername()} -> Local {client_sock.getsockname()}'
             )
-            print(status_msg)
-            self.log_message(status_msg, False)
+            self.log_message(status_msg, False, INFO)
 
             # Create and start new thread to manage client connection; add to active connections:
+            # (Added before starting, so a reply to its first message can find it.)
             connection_sock = ConnectionSocket(client_sock, client_addr, self)
+            self.join_room(connection_sock, self.lobby, replay=False)
+            self.connections.add(connection_sock)
             connection_sock.start()
-            self.connections.append(connection_sock)
             status_msg = (
-                f'CONNECTION READY: Ready to receive data from {client_sock.getpeername()}'
+                f'CONNECTION READY: Ready to receive data from {client_addr}'
             )
-            print(status_msg)
-            self.log_message(status_msg, False)
+            self.log_message(status_msg, False, DEBUG)
 
-    def post_msg(self, msg, source):
-        '''Send message from client to all other connected clients.'''
-        for connection in self.connections:
-            if connection.client_addr != source:
-                connection.send(msg)
-        self.log_message(msg)
+    def start_session(self):
+        '''Prints the splash screen and initializes this session's log files.'''
+        if self.bus: # A worker; the hub has printed the splash screen.
+            self.bus.connect()
+        else:
+            print(SPLASH)
+            print('\nStarting minserver .. .  .   .    .     .      .       .        . \n')
 
-    def msg_client(self, msg, client_addr):
-        '''Sends a message from the server to an individual client'''
-        for connection in self.connections:
-            if connection.client_addr == client_addr:
-                connection.send(msg)
-                self.log_message(msg, False)
+        # Initialize log files, or carry on with the previous server's:
+        if not self.takeover:
+            with open(self.admin_log, 'w') as log:
+                log.write(log_header('Administrator', self.host, self.port))
+        self.lobby = self.get_room(DEFAULT_ROOM)
+        self.log_writer.start()
+        if self.reaper:
+            self.reaper.start()
+        if self.stats_port:
+            self.metrics.serve(self.stats_port)
+
+    def handle_msg(self, connection, msg, control=False):
+        '''
+        Logs a message received from a client, then acts on it.
+        Framing clients mark commands as control frames; older clients
+        send them as plain messages, and only history and search requests.
+        '''
+        logged = msg
+        if control and msg.startswith(PEER + ' '): # Keep any peer secret out of the log.
+            logged = ' '.join(msg.split()[:2])
+        status_msg = (
+            'MESSAGE RECEIVED: {} says...\n\t{!r}'.format(connection.client_addr, logged)
+        )
+        self.log_message(status_msg, False, DEBUG)
+        connection.received += 1
+        received = time.perf_counter()
+        if not (control and msg.startswith((PING, PONG))): # Heartbeats keep no one from idling.
+            connection.active = time.monotonic()
+
+        # Check for special commands:
+        if control or msg == HIST or msg.startswith(SEARCH + ' '):
+            self.run_command(connection, msg)
+
+        # Forward msg to other clients in the sender's room:
+        else:
+            if connection.username is None: # Learn older clients' usernames as they post.
+                name = claimed_name(msg)
+                if name:
+                    self.connections.rename(connection, name)
+            self.post_msg(msg, connection.client_addr, connection.room)
+            if not self.bus: # A worker's messages are delivered once back from the hub.
+                self.metrics.fanout.observe(time.perf_counter() - received)
+
+    def run_command(self, connection, cmd):
+        '''Carries out a command sent by a client.'''
+        words = cmd.split()
+        if words and words[0] == HIST and words[1:2] == [HIST_SINCE]:
+            # !HIST! since <seq>: what a reconnecting client missed.
+            try:
+                self.send_history(connection, after=int(words[2]))
+            except (IndexError, ValueError):
+                connection.send_error(f'Usage: {HIST} {HIST_SINCE} <seq>')
+        elif words and words[0] == HIST:
+            # !HIST! [count] [before]: the last count messages before seq before.
+            try:
+                count, before = (int(word) for word in (words[1:] + [-1, -1])[:2])
+            except ValueError:
+                connection.send_error(f'Usage: {HIST} [count] [before]')
+                return
+            self.send_history(
+                connection,
+                count if count >= 0 else None,
+                before if before >= 0 else None
+            )
+        elif words and words[0] == SEARCH:
+            # !SEARCH! [before <seq>] <words>: a page of matches, newest first;
+            # before -1 is no bound, so a first word "before" can be sent.
+            before, terms = -1, words[1:]
+            if terms[:1] == [SEARCH_BEFORE]:
+                try:
+                    before, terms = int(terms[1]), terms[2:]
+                except (IndexError, ValueError):
+                    terms = []
+            if not terms:
+                connection.send_error(f'Usage: {SEARCH} [{SEARCH_BEFORE} <seq>] <words>')
+                connection.send_search([], -1) # Still ends the reply, for clients waiting on it.
+                return
+            self.send_search(connection, terms, before if before >= 0 else None)
+        elif words and words[0] == JOIN:
+            # !JOIN! <room>: move to room, opening it if needed.
+            if len(words) != 2 or not ROOM_NAME.match(words[1]):
+                connection.send_error(
+                    f'Usage: {JOIN} <room>; up to 32 letters, digits, _ or -'
+                )
+                return
+            room = self.get_room(words[1])
+            if room is None:
+                connection.send_error(f'No more rooms can be opened ({ROOM_LIMIT} are open).')
+                return
+            self.join_room(connection, room)
+        elif words and words[0] == COMPRESS:
+            # !COMPRESS! <codec>...: the codecs the client reads, best first.
+            codec = next((word for word in words[1:] if word in CODECS), None)
+            connection.codec = codec if connection.framed else None
+            connection.send_control(f'{COMPRESS} {connection.codec or "none"}')
+        elif words and words[0] == PEER and len(words) in (2, 3):
+            # Only from a server this one dialed, names as a peer, or that
+            # knows the peer secret; anyone else would skip flood control
+            # and post under any origin:
+            if connection.peer is None and not self.vouch_peer(connection, words[2:]):
+                connection.send_error(f'{PEER}: not a configured peer of this server.')
+                status_msg = f'PEER REFUSED: {connection.client_addr} is not a configured peer.'
+                self.log_message(status_msg, False, WARNING)
+                return
+            self.add_peer(connection, words[1])
+        elif words == [HEARTBEAT_CMD]:
+            connection.heartbeats = connection.framed
+        elif words and words[0] == PING:
+            connection.send_control(' '.join([PONG, *words[1:]]))
+        elif words and words[0] == PONG:
+            pass # Its arrival is what counts; see Reaper.
+        elif words and words[0] == NAME:
+            # !NAME! <username>: who this client posts as, for msg_client.
+            name = cmd.split(None, 1)[1].strip() if len(words) > 1 else ''
+            if not name:
+                connection.send_error(f'Usage: {NAME} <username>')
                 return
-        print('Could not message the given client.')
+            self.connections.rename(connection, name)
+        elif words == [LEAVE]:
+            self.join_room(connection, self.lobby)
+        elif words == [ROOMS]:
+            with self.rooms_lock:
+                rooms = list(self.rooms.values())
+            connection.send_control(
+                ROOMS + ''.join(f' {room.name}:{len(room.subscribers)}' for room in rooms)
+            )
+        else:
+            connection.send_error(f'Unknown command: {cmd!r}')
+
+    def get_room(self, name):
+        '''
+        Returns the room with the given name, opening it and its public log
+        if it is not open yet; None if no more rooms may be opened.
+        '''
+        with self.rooms_lock:
+            room = self.rooms.get(name)
+            if room is None and len(self.rooms) < ROOM_LIMIT:
+                store = self.new_store(name)
+                store.open()
+                index = None
+                if self.search_dir and not self.bus: # A worker's searches go to the hub.
+                    index = SearchIndex(room_log(self.search_dir, name))
+                    index.open()
+                room = self.rooms[name] = Room(name, store, self.history_size, index)
+                self.log_message(f'ROOM OPENED: #{name}', False, INFO)
+        return room
+
+    def join_room(self, connection, room, replay=True):
+        '''
+        Moves a connection into room, out of the room it was in. Unless replay
+        is False, the client is then told it joined, and sent the room's history
+        held in memory; this happens under the room's lock, so nothing posted
+        meanwhile arrives ahead of it or goes missing.
+        '''
+        left = connection.room
+        if left is not None:
+            with left.lock:
+                left.subscribers.discard(connection)
+        with room.lock:
+            room.subscribers.add(connection)
+            connection.room = room
+            if replay:
+                connection.send_control(f'{JOINED} {room.name}')
+                connection.send_history(list(room.history), room.posted - len(room.history))
 
-    def send_history(self, client_addr):
-        with open(PUBLIC_LOG, 'r') as public_logs:
-            print('CURRENT HISTORY: ')
-            logs = f'{HIST_RET} |' + '|'.join(public_logs.readlines()[2:])
-            self.msg_client(logs, client_addr)
-            print('\tEND HISTORY')
+        status_msg = f'JOINED ROOM: {connection.client_addr} is in #{room.name}.'
+        self.log_message(status_msg, False, DEBUG)
 
-        status_msg = f'SEND HISTORY: Sent public logs to client {client_addr}.'
-        print(status_msg)
-        self.log_message(status_msg, False)
+    def close_connection(self, connection):
+        '''Logs that a client closed its connection, and forgets the connection.'''
+        status_msg = (
+            f'CONNECTION CLOSED: {connection.client_addr} has closed their connection.'
+        )
+        self.log_message(status_msg, False, INFO)
+        self.remove_connection(connection)
+
+    def post_msg(self, msg, source, room, relay_id=None, link=None):
+        '''
+        Send message from client to all other clients in its room, numbered with
+        the room's next sequence number; the sender is told the number it was given.
+        A worker hands the message to the hub, which numbers and logs it, and
+        has every worker deliver it. The message is then relayed to this
+        server's peers; relay_id names a message that came from one, over link.
+        '''
+        if self.bus:
+            self.bus.post(msg, source, room.name)
+            return
+        with room.lock:
+            if relay_id is not None:
+                if relay_id in room.relayed:
+                    return # Already came by another path.
+                room.remember(relay_id)
+            seq = room.posted
+            self.log_message(msg, seq=seq, source=source, room=room)
+            self.deliver(msg, seq, source, room)
+            if len(self.peers):
+                self.relay(msg, room, relay_id or (self.node, SESSION_START, str(seq)), link)
+
+    def deliver(self, msg, seq, source, room):
+        '''
+        Adds a numbered public message to the room's history, and sends it to
+        the room's clients but its sender, who is told its number instead.
+        Call with room.lock held.
+        '''
+        room.posted = seq + 1
+        room.history.append(msg)
+        encoded = {} # The message as each kind of client reads it; encoded once, shared by all.
+        for connection in room.subscribers:
+            if connection.client_addr != source:
+                connection.send(msg, seq, encoded)
+            else:
+                connection.send_posted(seq)
+
+    def relay(self, msg, room, relay_id, link=None):
+        '''
+        Passes a public message on to every peer but the one it came from.
+        relay_id, (origin node, its session start, seq at the origin), names it
+        on every server, so each keeps one copy however many paths it arrives
+        by, even once the origin restarts and numbers from 0 again.
+        Call with room.lock held, so peers get each room's messages in order.
+        '''
+        frame = encode_frame(RELAY, pack_records([*relay_id, room.name, msg]))
+        for peer in self.peers:
+            if peer is not link:
+                peer.write(frame)
+
+    def receive_relay(self, link, payload):
+        '''
+        Posts a public message relayed by a peer, unless this server has it
+        already. Raises FrameError if the payload is not a relay.
+        '''
+        fields = unpack_records(payload)
+        if len(fields) != 5:
+            raise FrameError(f'RELAY frame carries {len(fields)} fields, not 5')
+        origin, session, origin_seq, room_name, msg = fields
+        if origin == self.node:
+            return # Came back around a loop of peers.
+        room = self.get_room(room_name)
+        if room is not None:
+            self.post_msg(msg, None, room, (origin, session, origin_seq), link)
+
+    def vouch_peer(self, connection, secret):
+        '''
+        Whether a connection this server accepted may link as a peer: it comes
+        from an address named with --peer, or secret, the words after its
+        name, is the peer secret.
+        '''
+        if connection.client_addr[0] in self.peer_ips:
+            return True
+        return bool(self.peer_secret and secret) and hmac.compare_digest(
+            secret[0].encode(ENCODING), self.peer_secret.encode(ENCODING)
+        )
+
+    def peer_hello(self):
+        '''Returns the command a server sends a peer it dials, to link with it.'''
+        return f'{PEER} {self.node} {self.peer_secret}' if self.peer_secret else f'{PEER} {self.node}'
+
+    def add_peer(self, connection, node):
+        '''
+        Makes a connection a link with a peer server, node: it leaves its room,
+        and carries public messages both ways. A server that is dialed answers
+        with its own name.
+        '''
+        if node == self.node: # Each would drop the other's messages as its own.
+            connection.send_error(f'{PEER}: this server is also named {node}; see --node.')
+            status_msg = (
+                f'PEER REFUSED: {connection.client_addr} has the same name as ' +
+                f'this server, {node}; give one of them another --node.'
+            )
+            self.log_message(status_msg, False, WARNING)
+            connection.close()
+            return
+        if connection.peer is None: # Accepted; tell the dialer who we are.
+            connection.send_control(f'{PEER} {self.node}')
+        connection.peer = node
+        connection.heartbeats = True # Servers answer PING.
+        self.peers.add(connection)
+        with connection.room.lock:
+            connection.room.subscribers.discard(connection)
+
+        status_msg = f'PEER LINKED: {connection.client_addr} is server {node}.'
+        self.log_message(status_msg, False, INFO)
+
+    def dial_peer(self, address):
+        '''
+        Keeps a link open to the peer at address, redialing PEER_RETRY seconds
+        after it fails or drops. Runs on its own thread.
+        '''
+        while True:
+            try:
+                client_sock = skt.create_connection(address)
+                client_sock.sendall(HELLO)
+                reply = b''
+                while len(reply) < len(HELLO):
+                    data = client_sock.recv(len(HELLO) - len(reply))
+                    if not data:
+                        raise ConnectionError('peer closed the connection')
+                    reply += data
+                if reply != HELLO:
+                    raise ConnectionError('peer does not speak framing')
+                client_sock.sendall(encode_text(CONTROL, self.peer_hello()))
+            except OSError as error:
+                status_msg = f'PEER UNREACHABLE: {address}: {error}'
+                self.log_message(status_msg, False, WARNING)
+                time.sleep(PEER_RETRY)
+                continue
+            link = ConnectionSocket(client_sock, address, self)
+            link.framed, link.held, link.peer = True, None, f'{address[0]}:{address[1]}'
+            self.join_room(link, self.lobby, replay=False)
+            self.connections.add(link)
+            link.start()
+            link.join() # Until the link drops.
+            time.sleep(PEER_RETRY)
+
+    def msg_client(self, msg, client):
+        '''Sends a message from the server to an individual client, by address or username.'''
+        connection = self.connections.find(client)
+        if connection is None:
+            print('Could not message the given client.')
+            return
+        connection.send(msg)
+        self.log_message(msg, False, INFO)
+
+    def send_history(self, connection, count=None, before=None, after=None):
+        '''
+        Sends a client the last count public messages of its room before
+        seq before, or every message after seq after, or, by default, every
+        message still held in memory.
+        '''
+        first, lines = self.get_history(connection.room, count, before, after)
+        connection.send_history(lines, first)
+        self.metrics.count('history_requests')
+
+        status_msg = f'SEND HISTORY: Sent public logs to client {connection.client_addr}.'
+        self.log_message(status_msg, False, DEBUG)
+
+    def get_history(self, room, count=None, before=None, after=None):
+        '''
+        Returns the sequence number of the first message, and the list of
+        messages, for the last count public messages in room before seq before,
+        or for every message after seq after. Recent messages come from memory;
+        only pages older than that are read from the room's public log.
+        '''
+        with room.lock:
+            end = room.posted if before is None else min(before, room.posted)
+            oldest = room.posted - len(room.history) # Sequence number of history[0].
+            if after is not None:
+                start = min(max(0, after + 1), end)
+            elif count is None:
+                start = oldest
+            else:
+                start = max(0, end - count)
+            if start >= oldest:
+                return start, list(islice(room.history, start - oldest, end - oldest))
+
+        self.log_writer.flush() # Older pages are read back from the public log.
+        lines = room.store.read(start, end)
+        return end - len(lines), lines # The log may no longer hold the oldest.
+
+    def send_search(self, connection, words, before=None):
+        '''
+        Sends a client the newest SEARCH_PAGE public messages of its room,
+        before seq before if given, that hold every one of words.
+        '''
+        results = self.search(connection.room, words, before, SEARCH_PAGE + 1)
+        if results is None:
+            connection.send_error('Search is not enabled on this server.')
+            connection.send_search([], -1) # Still ends the reply, for clients waiting on it.
+            return
+        more = len(results) > SEARCH_PAGE # Whether to tell the client where the next page starts.
+        results = results[:SEARCH_PAGE]
+        connection.send_search(results, results[-1][0] if more else -1)
+        self.metrics.count('search_requests')
+
+        status_msg = f'SEND SEARCH: Sent {len(results)} matches to client {connection.client_addr}.'
+        self.log_message(status_msg, False, DEBUG)
+
+    def search(self, room, words, before=None, limit=SEARCH_PAGE):
+        '''
+        Returns a list of (seq, msg) for up to limit public messages in room,
+        newest first, before seq before if given, that hold every one of
+        words; None if the server keeps no search index. Messages are found
+        once the log writer has written them.
+        '''
+        if not self.search_dir:
+            return None
+        if self.bus:
+            return self.bus.search(room.name, words, before, limit)
+        found = room.index.search(words, before, limit)
+        with room.lock:
+            oldest = room.posted - len(room.history) # Sequence number of history[0].
+            results = [(seq, room.history[seq - oldest]) for seq in found if seq >= oldest]
+        older = found[len(results):] # Read back from the public log, all at once.
+        if older:
+            picked = room.store.pick(older)
+            results.extend((seq, picked[seq]) for seq in older if seq in picked)
+        return results
+
+    def compressed_history(self, room, codec, first, lines):
+        '''
+        Returns a history reply, the page and its HIST_END, compressed with
+        codec. Numbered messages never change, so replies are cached by room,
+        codec and range, and a burst of clients joining a room compresses its
+        history once. The least recently used past HISTORY_CACHE are dropped.
+        '''
+        key = (room.name, codec, first, len(lines))
+        with self.history_cache_lock:
+            data = self.history_cache.get(key)
+            if data is not None:
+                self.history_cache.move_to_end(key)
+        if data is not None:
+            self.metrics.count('history_cache_hits')
+            return data
+        data = encode_compressed(codec, (
+            encode_frame(HIST_FRAME, pack_records(lines)) +
+            encode_text(CONTROL, f'{HIST_END} {first}')
+        ))
+        with self.history_cache_lock:
+            self.history_cache[key] = data
+            while len(self.history_cache) > HISTORY_CACHE:
+                self.history_cache.popitem(last=False)
+        self.metrics.count('history_cache_misses')
+        return data
 
     def remove_connection(self, connection):
-        '''Remove client socket from connections.'''
-        self.connections.remove(connection)
+        '''Remove client socket from connections, and from its room.'''
+        self.connections.discard(connection)
+        self.peers.discard(connection)
+        if self.reaper:
+            self.reaper.wheel.cancel(connection)
+        with connection.room.lock:
+            connection.room.subscribers.discard(connection)
+        self.metrics.retire(connection)
 
-    def log_message(self, msg, public=True):
+    def log_message(self, msg, public=True, level=INFO, seq=None, source=None, room=None):
         '''
         Appends a message to both the public and admin log files by default,
-        with the option of appending only to the admin log.
+        with the option of appending only to the admin log. Public messages
+        are logged to their room's public log, with their sequence number and
+        the address of the client that posted them. Admin-only messages are also
+        shown on the console if level is at least the console's level.
+        Returns immediately; the log writer thread does the file I/O.
+        '''
+        self.log_writer.put(msg, public, level, seq, source, room)
+
+    def hand_off(self, channel):
+        '''
+        Hands this server over to a successor, a new minserver process at the
+        other end of channel (a Unix socket; see Takeover), which carries on
+        without clients noticing. Accepting and reading stop here, at a message
+        boundary; what clients are owed is written, for up to HANDOFF_DRAIN
+        seconds; then the listening socket, every client's socket, and each
+        room's numbering and history are passed on. Clients still being written
+        to are disconnected instead, and peer links are closed, for the peers
+        to redial. Returns once the successor is running; this server then has
+        nothing left to do but exit. Not supported with --workers.
+        '''
+        recv_handoff(channel) # The successor is ready.
+        self.handing_off = True
+        listener = self.stop_io()
+        for peer in self.peers:
+            peer.close()
+        clients = [connection for connection in self.connections if connection.peer is None]
+        deadline = time.monotonic() + HANDOFF_DRAIN
+        while time.monotonic() < deadline and not all(
+            connection.closed or connection.flushed() for connection in clients
+        ):
+            time.sleep(0.01)
+        self.log_writer.flush()
+        self.metrics.stop() # The successor serves them on the same port.
+
+        with self.rooms_lock:
+            rooms = [
+                {'name': room.name, 'posted': room.posted, 'history': list(room.history)}
+                for room in self.rooms.values()
+            ]
+        send_handoff(channel, {'session': SESSION_START, 'rooms': rooms}, [listener])
+        handed = []
+        for connection in clients:
+            if connection.closed:
+                continue
+            if not connection.flushed():
+                status_msg = f'SLOW CLIENT: Disconnecting {connection.client_addr} for the handoff.'
+                self.log_message(status_msg, False, WARNING)
+                connection.close()
+                continue
+            handed.append(connection)
+        for start in range(0, len(handed), HANDOFF_BATCH):
+            batch = handed[start:start + HANDOFF_BATCH]
+            states = [connection.detach() for connection in batch]
+            send_handoff(
+                channel, {'connections': states}, [connection.fileno() for connection in batch]
+            )
+            for connection in batch:
+                connection.release()
+        send_handoff(channel, {'done': True})
+        self.release_listener(listener)
+        recv_handoff(channel) # The successor is running.
+        status_msg = f'HANDED OFF: {len(handed)} clients are now served by the new server.'
+        self.log_message(status_msg, False, INFO)
+        self.log_writer.flush()
+
+    def stop_io(self):
+        '''
+        Stops accepting and reading from clients, for a handoff; returns the
+        listening socket's file descriptor. Readers stop between messages,
+        leaving whatever they have not handled to Connection.detach.
+        '''
+        os.write(self.wake_readers[1], b'!') # Never read, so every reader's poll returns.
+        host, port = self.listener.getsockname()
+        skt.create_connection(('127.0.0.1' if host == '0.0.0.0' else host, port)).close()
+        self.join(HANDOFF_DRAIN) # The accept loop, woken by the connection just made.
+        for connection in self.connections:
+            if connection.peer is None:
+                connection.join(HANDOFF_DRAIN)
+        return self.listener.fileno()
+
+    def release_listener(self, listener):
+        '''Closes this server's copy of the listening socket, once it is handed off.'''
+        self.listener.close()
+
+    def take_over(self, adopted):
+        '''
+        Carries on where the previous server left off (see hand_off): numbers
+        each room's messages from where it stopped, with its history, and
+        serves its clients, adopted (see adopt), then tells it to exit.
         '''
-        if public:
-            with open(PUBLIC_LOG, 'a') as p_log:
-                p_log.write(msg + '\n')
-        with open(ADMIN_LOG, 'a') as a_log:
-            a_log.write(msg + '\n')
+        for state in self.takeover.rooms:
+            room = self.get_room(state['name'])
+            if room is not None:
+                with room.lock:
+                    room.posted = state['posted']
+                    room.history.extend(state['history'])
+        # Only once every client is back in its room, or messages they left
+        # unread would reach some of the room and not the rest:
+        for connection, (client_sock, state) in zip(adopted, self.takeover.clients):
+            for data in state['unread']:
+                connection.receive(data.encode('latin-1'))
+            connection.start()
+        send_handoff(self.takeover.channel, {'running': True})
+        self.takeover.channel.close()
+        status_msg = (
+            f'TOOK OVER: {len(self.takeover.clients)} clients and ' +
+            f'{len(self.takeover.rooms)} rooms from the previous server.'
+        )
+        self.log_message(status_msg, False, INFO)
+
+    def adopt(self, client_sock, state):
+        '''Returns the connection for a client handed over by the previous server, not yet started.'''
+        client_sock.setblocking(True)
+        connection = ConnectionSocket(client_sock, tuple(state['address']), self)
+        connection.restore(state)
+        return connection
+
+
+# REGISTRY ---------------------------------------------------------------------
+
+class Registry:
+    '''
+    The server's active connections. Iterating never takes a lock: it walks
+    snapshot, a tuple that add and discard replace with a new copy instead of
+    changing, so a broadcast or admin command sees a consistent set while
+    clients come and go. Connections are also indexed by address and by
+    username, for sending to one client without a scan. Changes are serialized
+    by lock; lookups are single dict reads and need no lock either.
+    '''
+
+    def __init__(self):
+        self.snapshot = () # Every active connection; replaced, never changed.
+        self.by_address = {} # Client address -> connection.
+        self.by_username = {} # Username -> connection; the latest to claim a name has it.
+        self.lock = threading.Lock() # Serializes changes.
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def add(self, connection):
+        '''Registers a new connection.'''
+        with self.lock:
+            self.snapshot = self.snapshot + (connection,)
+            self.by_address[connection.client_addr] = connection
+
+    def discard(self, connection):
+        '''Forgets a connection, if registered.'''
+        with self.lock:
+            self.snapshot = tuple(other for other in self.snapshot if other is not connection)
+            if self.by_address.get(connection.client_addr) is connection:
+                del self.by_address[connection.client_addr]
+            if self.by_username.get(connection.username) is connection:
+                del self.by_username[connection.username]
+
+    def rename(self, connection, username):
+        '''Records the username a connection goes by.'''
+        with self.lock:
+            if self.by_username.get(connection.username) is connection:
+                del self.by_username[connection.username]
+            connection.username = username
+            if self.by_address.get(connection.client_addr) is connection: # Still registered.
+                self.by_username[username] = connection
+
+    def find(self, client):
+        '''Returns the connection with the given address or username, or None.'''
+        if isinstance(client, tuple):
+            return self.by_address.get(client)
+        return self.by_username.get(client)
+
+
+# ROOM -------------------------------------------------------------------------
+
+class Room:
+    '''
+    One chatroom on the server. Public messages are posted to the connections
+    subscribed to a room, numbered in the room's own sequence, and kept in
+    its own history and public log; a client is in exactly one room at a time.
+    '''
+
+    def __init__(self, name, store, history_size, index=None):
+        self.name = name # Room name; see ROOM_NAME.
+        self.store = store # This room's public log (see minstore).
+        self.index = index # Search index of the public log, if the server keeps one.
+        self.subscribers = set() # Connections in this room.
+        self.history = deque(maxlen=history_size) # Most recent public messages.
+        self.posted = 0 # Public messages so far; the next one's sequence number.
+        self.lock = threading.Lock() # Keeps sequence, history, log and delivery in order.
+        self.relayed = set() # Ids of messages relayed from peers (see Server.relay).
+        self.relayed_order = deque() # The same ids, oldest first, to forget the oldest.
+
+    def remember(self, relay_id):
+        '''Records a relayed message id, forgetting the oldest past RELAYED_LIMIT.'''
+        self.relayed.add(relay_id)
+        self.relayed_order.append(relay_id)
+        if len(self.relayed_order) > RELAYED_LIMIT:
+            self.relayed.discard(self.relayed_order.popleft())
     
 
+# FLOOD CONTROL ----------------------------------------------------------------
+
+class TokenBucket:
+    '''
+    Allows rate events a second on average, and bursts of up to burst at
+    once: each event takes a token, and tokens come back at rate a second.
+    Not thread-safe; FloodControl guards its buckets.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate # Tokens added a second.
+        self.burst = burst # Most tokens held; a full bucket allows this many at once.
+        self.tokens = burst # Tokens available, in part.
+        self.updated = time.monotonic() # When tokens was last brought up to date.
+
+    def refill(self, now):
+        '''Adds the tokens earned since the last refill.'''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        '''Returns the seconds until the bucket holds a whole token: 0 if it does.'''
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def full(self, now):
+        '''Whether the bucket has refilled completely, so forgetting it changes nothing.'''
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class FloodControl:
+    '''
+    Limits how fast clients may send messages (chat and commands alike), so
+    one client cannot starve the rest: a token bucket for each connection,
+    one for each username, shared by its connections, and one for the server
+    as a whole (with --workers, for each worker). A message needs a token
+    from each; one over a limit is dealt with by the flood policy:
+        delay: the message, and the rest received with it, wait until there
+            are tokens; meanwhile nothing more is read, so TCP slows the client.
+        drop: the message is discarded, and the client told once per flood.
+        disconnect: the client is disconnected.
+    Messages are checked as they are taken from the socket's bytes, before
+    they are logged, parsed or posted, so turning them away costs little.
+    '''
+
+    def __init__(self, policy='delay', rate=None, user_rate=None, global_rate=None,
+                 burst=FLOOD_BURST):
+        self.policy = policy # One of FLOOD_POLICIES.
+        self.rate = rate # Messages a second each connection may send; None for no limit.
+        self.user_rate = user_rate # Messages a second each username may send; None for no limit.
+        self.burst = burst # Seconds of each limit that may be sent at once.
+        self.everyone = self.bucket(global_rate) # Messages a second for the whole server, if limited.
+        self.users = {} # Username -> its bucket.
+        self.lock = threading.Lock() # Guards every bucket.
+
+    def bucket(self, rate):
+        '''Returns a new bucket for rate, or None if rate is not limited.'''
+        return TokenBucket(rate, max(1, rate * self.burst)) if rate else None
+
+    def buckets(self, connection, now):
+        '''Returns the buckets a message from connection takes from (call with lock held).'''
+        if connection.bucket is None and self.rate:
+            connection.bucket = self.bucket(self.rate)
+        buckets = [connection.bucket, self.everyone]
+        if connection.username is not None and self.user_rate:
+            bucket = self.users.get(connection.username)
+            if bucket is None:
+                if len(self.users) >= FLOOD_USERS: # Forget users with nothing owing.
+                    self.users = {
+                        name: bucket for name, bucket in self.users.items() if not bucket.full(now)
+                    }
+                bucket = self.users[connection.username] = self.bucket(self.user_rate)
+            buckets.append(bucket)
+        return [bucket for bucket in buckets if bucket]
+
+    def admit(self, connection):
+        '''
+        Takes a token for a message from connection from each of its buckets.
+        Returns whether every bucket had one; if not, none is taken.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets(connection, now)
+            for bucket in buckets:
+                bucket.refill(now)
+            if any(bucket.tokens < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return True
+
+    def wait(self, connection):
+        '''Returns the seconds until every one of connection's buckets has a token.'''
+        now = time.monotonic()
+        with self.lock:
+            return max((bucket.wait(now) for bucket in self.buckets(connection, now)), default=0)
+
+
+# REAPER -----------------------------------------------------------------------
+
+class TimerWheel:
+    '''
+    A hashed timer wheel: each key is due some whole number of ticks from
+    now, and is kept in the slot that tick falls in, modulo the number of
+    slots. Each turn looks at one slot only, so scheduling, cancelling and
+    turning cost the same however many keys are waiting. Keys due more
+    than one revolution away wait in their slot until their tick comes.
+    '''
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick # Seconds a turn stands for.
+        self.slots = [{} for _ in range(slots)] # Key -> tick it is due at, per slot.
+        self.where = {} # Key -> its slot, so it can be cancelled.
+        self.now = 0 # Turns so far.
+        self.lock = threading.Lock() # Guards slots, where and now.
+
+    def schedule(self, key, delay):
+        '''Makes key due in delay seconds, at least a tick from now, replacing any due time it had.'''
+        with self.lock:
+            self.remove(key)
+            due = self.now + max(1, -int(-delay // self.tick))
+            slot = self.slots[due % len(self.slots)]
+            slot[key] = due
+            self.where[key] = slot
+
+    def cancel(self, key):
+        '''Forgets key, if it is scheduled.'''
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def turn(self):
+        '''Advances the wheel a tick; returns the keys that are now due, and forgets them.'''
+        with self.lock:
+            self.now += 1
+            slot = self.slots[self.now % len(self.slots)]
+            due = [key for key, tick in slot.items() if tick <= self.now]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+        return due
+
+    def __len__(self):
+        return len(self.where)
+
+
+class Reaper(threading.Thread):
+    '''
+    Finds connections whose client has gone, or gone quiet, and closes them,
+    from one thread driving one TimerWheel, rather than a timer per socket.
+    Receiving anything from a client counts as hearing from it. A client
+    silent for heartbeat seconds is sent a PING, if it answers them (framing
+    clients say so with HEARTBEAT_CMD; peers always do); one that has not
+    been heard from heartbeat_timeout seconds later is taken for dead, as
+    when it vanished without closing its connection, and is closed. A client
+    that sends no messages or commands, heartbeats aside, for idle_timeout
+    seconds is disconnected whether or not it answers. Each connection is
+    checked only when one of these could next be due, and nothing is
+    rescheduled as messages arrive: each check finds when to look again.
+    '''
+
+    def __init__(self, server, heartbeat=HEARTBEAT, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 idle_timeout=None):
+        super().__init__(daemon=True)
+        self.server = server
+        self.heartbeat = heartbeat # Seconds of silence before a ping; 0 or None for no pings.
+        self.heartbeat_timeout = heartbeat_timeout # Seconds a ping has to be answered in.
+        self.idle_timeout = idle_timeout # Seconds without a message before a disconnect, if any.
+        self.wheel = TimerWheel() # When each connection is next checked.
+
+    def watch(self, connection):
+        '''Starts checking on a new connection.'''
+        delay = self.next_check(connection, time.monotonic())
+        if delay is not None:
+            self.wheel.schedule(connection, delay)
+
+    def run(self):
+        '''Turns the wheel every tick, checking on the connections that are due.'''
+        started = time.monotonic()
+        while True:
+            time.sleep(max(0, started + (self.wheel.now + 1) * self.wheel.tick - time.monotonic()))
+            now = time.monotonic()
+            for connection in self.wheel.turn():
+                if self.server.handing_off:
+                    return # Exit thread; the successor watches the connections.
+                if not connection.closed and not connection.closing:
+                    delay = self.check(connection, now)
+                    if delay is not None:
+                        self.wheel.schedule(connection, delay)
+
+    def check(self, connection, now):
+        '''
+        Pings, or closes, a connection that is due to be; returns the seconds
+        until it should next be checked, or None once there is no need.
+        '''
+        if connection.pending: # Its messages are held back by flood control; it is there.
+            connection.heard = now
+        if (self.idle_timeout and connection.peer is None and
+                now - connection.active >= self.idle_timeout):
+            status_msg = (
+                f'IDLE CLIENT: Disconnecting {connection.client_addr}; ' +
+                f'nothing was sent for {now - connection.active:.0f} seconds.'
+            )
+            self.server.log_message(status_msg, False, INFO)
+            connection.send_error(f'Disconnected after {self.idle_timeout:g} seconds idle.')
+            connection.finish()
+            self.server.metrics.count('connections_idle')
+            return None
+        if connection.pinged is not None and connection.heard < connection.pinged:
+            if now - connection.pinged >= self.heartbeat_timeout:
+                status_msg = (
+                    f'DEAD CLIENT: Closing {connection.client_addr}; no answer ' +
+                    f'for {now - connection.heard:.0f} seconds.'
+                )
+                self.server.log_message(status_msg, False, WARNING)
+                connection.close()
+                self.server.metrics.count('connections_reaped')
+                return None
+        elif self.pings(connection) and now - connection.heard >= self.heartbeat:
+            connection.pinged = now
+            connection.send_control(f'{PING} {int(now * 1000)}')
+            self.server.metrics.count('pings_sent')
+        return self.next_check(connection, now)
+
+    def pings(self, connection):
+        '''Whether a connection is sent heartbeats.'''
+        return bool(self.heartbeat) and connection.heartbeats
+
+    def next_check(self, connection, now):
+        '''
+        Returns the seconds until a ping or a timeout could next fall due on
+        connection, or None if none can.
+        '''
+        due = []
+        if self.idle_timeout and connection.peer is None:
+            due.append(connection.active + self.idle_timeout)
+        if connection.pinged is not None and connection.heard < connection.pinged:
+            due.append(connection.pinged + self.heartbeat_timeout)
+        elif self.heartbeat:
+            # Checked then even if it does not answer PING yet: it may say so meanwhile.
+            due.append(connection.heard + self.heartbeat)
+        return min(due) - now if due else None
+
+
+# METRICS ----------------------------------------------------------------------
+
+class Histogram:
+    '''
+    Counts of latencies in fixed buckets (see LATENCY_BUCKETS), from which
+    percentiles are estimated without keeping every sample.
+    '''
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds # Upper bound of each bucket, in seconds.
+        self.counts = [0] * (len(bounds) + 1) # Samples in each bucket; the last has no bound.
+        self.total = 0.0 # Sum of the samples, in seconds.
+        self.lock = threading.Lock() # Samples arrive from many threads.
+
+    def observe(self, seconds):
+        '''Counts one sample.'''
+        bucket = bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.total += seconds
+
+    def percentile(self, pct):
+        '''Returns the upper bound, in seconds, of the bucket holding the pct-th percentile.'''
+        rank = sum(self.counts) * pct / 100
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        '''Returns the samples' count, mean, p50 and p99 (in ms), and cumulative bucket counts.'''
+        count = sum(self.counts)
+        cumulative, seen = {}, 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            seen += n
+            cumulative['+Inf' if bound == float('inf') else f'{bound:g}'] = seen
+        p50, p99 = (self.percentile(pct) for pct in (50, 99))
+        return {
+            'count': count,
+            'mean_ms': self.total / count * 1000 if count else None,
+            'p50_ms': p50 * 1000 if p50 is not None else None,
+            'p99_ms': p99 * 1000 if p99 is not None else None,
+            'buckets': cumulative,
+        }
+
+
+class Metrics:
+    '''
+    The server's counters and latency histograms, shown by the admin console's
+    s command and served to scrapers with --stats-port. Per-message counts are
+    kept by each connection, which alone changes them, so counting takes no
+    lock; they are summed when read, and a closed connection's are added to
+    totals. Rates per second are over the time since the previous reading.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.started = time.monotonic()
+        self.totals = dict.fromkeys( # Counts of closed connections, and server-wide counts.
+            [*CONNECTION_COUNTERS.values(), 'connections_closed', 'history_requests',
+             'history_cache_hits', 'history_cache_misses', 'search_requests',
+             'connections_reaped', 'connections_idle', 'pings_sent'], 0
+        )
+        self.lock = threading.Lock() # Guards totals and previous.
+        self.fanout = Histogram() # Seconds from receiving a public message to queuing it for its room.
+        self.previous = (self.started, 0, 0) # When last read, messages in and out then.
+        self.stats_server = None # Serves snapshots over HTTP, once serve() is called.
+
+    def count(self, name, amount=1):
+        '''Adds to a server-wide counter.'''
+        with self.lock:
+            self.totals[name] += amount
+
+    def retire(self, connection):
+        '''Adds a closed connection's counts to the totals.'''
+        with self.lock:
+            for attribute, name in CONNECTION_COUNTERS.items():
+                self.totals[name] += getattr(connection, attribute)
+            self.totals['connections_closed'] += 1
+
+    def snapshot(self):
+        '''Returns every metric, and each client's send queue, as a dict.'''
+        server = self.server
+        connections = server.connections.snapshot
+        with self.lock:
+            stats = dict(self.totals)
+        for connection in connections:
+            for attribute, name in CONNECTION_COUNTERS.items():
+                stats[name] += getattr(connection, attribute)
+        now = time.monotonic()
+        with self.lock:
+            then, messages_in, messages_out = self.previous
+            self.previous = (now, stats['messages_in'], stats['messages_out'])
+        elapsed = max(now - then, 1e-6)
+        queued = [len(connection.outbox) for connection in connections]
+        stats.update(
+            uptime_seconds=now - self.started,
+            connections_active=len(connections),
+            connections_opened=stats['connections_closed'] + len(connections),
+            peers=len(server.peers),
+            rooms=len(server.rooms),
+            messages_in_per_second=(stats['messages_in'] - messages_in) / elapsed,
+            messages_out_per_second=(stats['messages_out'] - messages_out) / elapsed,
+            queued_messages=sum(queued),
+            queued_messages_max=max(queued, default=0),
+            queued_bytes=sum(connection.outbox_bytes for connection in connections),
+            log_records_waiting=server.log_writer.records.qsize(),
+            fanout_latency=self.fanout.summary(),
+            log_write_latency=server.log_writer.latency.summary(),
+            clients=[
+                {
+                    'address': f'{connection.client_addr[0]}:{connection.client_addr[1]}',
+                    'username': connection.username,
+                    'room': connection.room.name,
+                    'queued': len(connection.outbox),
+                    'queued_bytes': connection.outbox_bytes,
+                    'dropped': connection.dropped,
+                    'throttled': connection.throttled,
+                }
+                for connection in connections
+            ],
+        )
+        return stats
+
+    def stop(self):
+        '''Stops serving snapshots over HTTP, freeing the port.'''
+        if self.stats_server:
+            self.stats_server.shutdown()
+            self.stats_server.server_close()
+
+    def serve(self, port):
+        '''Serves snapshots over HTTP on the local port, from a thread of its own.'''
+        stats_server = self.stats_server = ThreadingHTTPServer(('127.0.0.1', port), StatsHandler)
+        stats_server.daemon_threads = True
+        stats_server.metrics = self
+        threading.Thread(target=stats_server.serve_forever, daemon=True).start()
+        status_msg = f'STATS: Serving metrics at http://127.0.0.1:{port}/ (and /json)'
+        self.server.log_message(status_msg, False, INFO)
+
+
+def stats_text(stats):
+    '''
+    Returns a snapshot of Metrics as plain text, one metric per line, in the
+    exposition format Prometheus and similar scrapers read.
+    '''
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, (int, float)):
+            lines.append(f'minchat_{name} {value:g}')
+    for name in ('fanout_latency', 'log_write_latency'):
+        histogram = stats[name]
+        for bound, count in histogram['buckets'].items():
+            lines.append(f'minchat_{name}_seconds_bucket{{le="{bound}"}} {count}')
+        lines.append(f'minchat_{name}_seconds_count {histogram["count"]}')
+    for client in stats['clients']:
+        labels = f'client="{client["address"]}",room="{client["room"]}"'
+        lines.append(f'minchat_client_queued{{{labels}}} {client["queued"]}')
+        lines.append(f'minchat_client_queued_bytes{{{labels}}} {client["queued_bytes"]}')
+        lines.append(f'minchat_client_dropped{{{labels}}} {client["dropped"]}')
+        lines.append(f'minchat_client_throttled{{{labels}}} {client["throttled"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    '''Answers the stats endpoint: /json as JSON, any other path as plain text.'''
+
+    def do_GET(self):
+        stats = self.server.metrics.snapshot()
+        if self.path == '/json':
+            body, kind = json.dumps(stats).encode(ENCODING), 'application/json'
+        else:
+            body, kind = stats_text(stats).encode(ENCODING), 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # A scraper's polls are not worth logging.
+
+
+# PROFILER ---------------------------------------------------------------------
+
+class Profiler:
+    '''
+    Times each stage of the message pipeline (see STAGES) when the server
+    runs with --profile; the p console command shows the totals. Stages of
+    the server and log writer are timed by wrapping those methods of the
+    running instances, and connections time decoding and socket writes
+    themselves, so a server without --profile pays nothing.
+    '''
+
+    def __init__(self):
+        self.stages = {stage: Histogram(STAGE_BUCKETS) for stage in STAGES}
+
+    def observe(self, stage, started):
+        '''Counts one pass through stage, which began at perf_counter() started.'''
+        self.stages[stage].observe(time.perf_counter() - started)
+
+    def timed(self, stage, func):
+        '''Returns func, timed as stage.'''
+        histogram = self.stages[stage]
+        def timed_func(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return timed_func
+
+    def install(self, server):
+        '''Starts timing server's stages.'''
+        for stage, owner, method in (
+            ('handle', server, 'handle_msg'),
+            ('post', server, 'post_msg'),
+            ('fanout', server, 'deliver'),
+            ('log', server, 'log_message'),
+            ('log_write', server.log_writer, 'commit'),
+        ):
+            setattr(owner, method, self.timed(stage, getattr(owner, method)))
+
+    def report(self):
+        '''Returns a line per stage: calls, mean, p50 and p99, and total time.'''
+        lines = []
+        for stage, histogram in self.stages.items():
+            summary = histogram.summary()
+            if not summary['count']:
+                lines.append(f'{stage:10} no calls')
+                continue
+            lines.append(
+                f"{stage:10} {summary['count']:>9} calls  mean {summary['mean_ms'] * 1000:9.1f} us" +
+                f"  p50 <= {summary['p50_ms'] * 1000:g} us  p99 <= {summary['p99_ms'] * 1000:g} us" +
+                f"  total {histogram.total:.3f} s"
+            )
+        return lines
+
+
+class StackSampler(threading.Thread):
+    '''
+    A wall-clock sampling profiler, started from the admin console while the
+    server runs: every SAMPLE_INTERVAL seconds, for seconds, it records the
+    stack of every thread, then writes them to path in the folded format read
+    by flamegraph.pl and speedscope, one line per distinct stack with its count.
+    Threads waiting on a socket or a lock are sampled too; each sample counts
+    where time went, not only CPU.
+    '''
+
+    def __init__(self, server, seconds, path):
+        super().__init__(daemon=True)
+        self.server = server
+        self.seconds = seconds # How long to sample for.
+        self.path = path # Folded stacks file to write.
+
+    def run(self):
+        stacks = Counter() # Folded stack -> samples.
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stacks[';'.join(reversed(calls))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+        with open(self.path, 'w') as out:
+            out.writelines(f'{stack} {count}\n' for stack, count in stacks.most_common())
+        status_msg = f'PROFILE WRITTEN: {sum(stacks.values())} stack samples in {self.path}'
+        self.server.log_message(status_msg, False, INFO)
+
+
+# LOG WRITER -------------------------------------------------------------------
+
+class LogWriter(threading.Thread):
+    '''
+    Writes the session logs, and status messages to the console, on its own
+    thread. Records are queued by Server.log_message and written in groups:
+    whatever arrives within flush_interval seconds, up to flush_batch records,
+    is written with one call per file, keeping both files open throughout.
+    Public messages go to their room's store (see minstore). Each record in
+    the admin log starts with the time it was logged (see minbench's replay).
+    '''
+
+    def __init__(self, admin_log, console_level, flush_interval, flush_batch, fsync):
+        super().__init__(daemon=True)
+        self.admin_log = admin_log # Admin log file.
+        self.console_level = console_level # Least level of status shown on the console.
+        self.flush_interval = flush_interval # Seconds to gather records for one write.
+        self.flush_batch = flush_batch # Most records gathered for one write.
+        self.fsync = fsync # Whether each write is forced to disk.
+        self.records = queue.SimpleQueue() # (msg, public, level, seq, source, room, time), or an Event.
+        self.latency = Histogram() # Seconds from queuing each batch's oldest record to writing it.
+
+    def put(self, msg, public, level, seq, source, room):
+        '''Queues a record for the logs.'''
+        self.records.put((msg, public, level, seq, source, room, time.time()))
+
+    def flush(self):
+        '''Blocks until every record queued so far has been written.'''
+        written = threading.Event()
+        self.records.put(written)
+        written.wait()
+
+    def run(self):
+        '''Starts this thread, which writes records to the logs as they are queued.'''
+        with open(self.admin_log, 'a') as a_log:
+            while True:
+                batch = [self.records.get()] # Blocks until there is something to write.
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.flush_batch and not isinstance(batch[-1], threading.Event):
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.records.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                self.commit(batch, a_log)
+
+    def commit(self, batch, a_log):
+        '''Writes a batch of records to the logs and console.'''
+        admin, console, written, stores, indexed = [], [], [], {}, []
+        oldest = None
+        for record in batch:
+            if isinstance(record, threading.Event):
+                written.append(record)
+                continue
+            msg, public, level, seq, source, room, logged = record
+            oldest = logged if oldest is None else oldest
+            if public:
+                room.store.append(seq, msg, logged, source, username_of(msg))
+                stores[id(room.store)] = room.store
+                if room.index is not None:
+                    indexed.append((room.index, seq, msg))
+            elif level >= self.console_level:
+                console.append(msg + '\n')
+            admin.append(f'[{admin_time(logged)}] {msg}\n')
+
+        for store in stores.values():
+            store.flush(self.fsync)
+        indexes = {} # Indexed once written, so a search never finds what cannot yet be read.
+        for index, seq, msg in indexed:
+            index.add(seq, msg)
+            indexes[id(index)] = index
+        for index in indexes.values():
+            index.flush(self.fsync)
+        if admin:
+            a_log.write(''.join(admin))
+            a_log.flush()
+            if self.fsync:
+                os.fsync(a_log.fileno())
+        if console:
+            sys.stdout.write(''.join(console))
+            sys.stdout.flush()
+        if oldest is not None:
+            self.latency.observe(time.time() - oldest)
+        for event in written:
+            event.set()
+
+
+# CONNECTION -------------------------------------------------------------------
+
+class Connection:
+    '''
+    Protocol handling shared by ConnectionSocket and AsyncConnection.
+    This class turns received bytes into messages, and messages into bytes,
+    for whichever protocol the client negotiated when it connected.
+
+    Outgoing bytes are never written by the thread that sends them: write()
+    puts them on this client's bounded outbox, and the subclass's writer
+    drains it. Subclasses provide wake(), to rouse that writer, and close().
+    '''
+
+    def __init__(self, client_addr, server):
+        self.client_addr = client_addr # Client address.
+        self.server = server # Reference to hosting server.
+        self.room = None # Room the client is in; set by Server.join_room.
+        self.username = None # Username the client goes by, once known; see Registry.rename.
+        self.peer = None # Name of the peer server, if this is a link with one; see Server.add_peer.
+        self.framed = None # Whether the client speaks framing; None until it first sends.
+        self.codec = None # Compression codec the client asked for (see COMPRESS), if any.
+        self.decoder = FrameDecoder() # Reassembles frames from received bytes.
+        self.greeting = b'' # First bytes received, while they could still be a HELLO.
+        self.held = [] # Messages sent before the protocol was known.
+        self.lock = threading.Lock() # Guards the switch from held to sent messages.
+        self.outbox = deque() # Bytes waiting to be written to the client.
+        self.outbox_bytes = 0 # Total size of the bytes in outbox.
+        self.outbox_ready = threading.Condition() # Guards outbox; notified when it fills.
+        self.dropped = 0 # Messages shed because this client could not keep up.
+        self.received = self.received_bytes = 0 # Messages and bytes received from the client.
+        self.sent = self.sent_bytes = 0 # Messages queued for, and bytes written to, the client.
+        self.writes = 0 # Socket writes made to the client; fewer than sent when coalesced.
+        self.bucket = None # This connection's token bucket, once flood control needs it.
+        self.throttled = 0 # Messages from the client over a rate limit (see FloodControl).
+        self.flooding = False # Set once the client is told its messages are being dropped.
+        self.delayed = False # Set while the next pending message waits for flood control.
+        self.pending = deque() # (frame type, payload) received but not yet handled.
+        self.flush_at = 0 # When what is queued must be written by, if writes are coalesced.
+        self.heartbeats = False # Whether the other side answers PING (see Reaper).
+        self.heard = self.active = time.monotonic() # When anything, and a message, last arrived.
+        self.pinged = None # When the last PING was sent, if any.
+        self.closed = False # Set once the connection is closed; stops the writer.
+        self.closing = False # Set to close the connection once the outbox is written.
+        if server.reaper:
+            server.reaper.watch(self)
+
+    def receive(self, data):
+        '''Handles bytes received from the client.'''
+        self.received_bytes += len(data)
+        self.heard = time.monotonic()
+        if self.framed is None:
+            data = self.greeting + data
+            version = hello_version(data)
+            if version is None:
+                self.greeting = data # Wait for the rest of the HELLO.
+                return
+            self.greeting = b''
+            with self.lock:
+                self.framed = bool(version)
+                if self.framed:
+                    self.write(HELLO) # Accept framing.
+                    data = data[len(HELLO):]
+                for msg, seq in self.held:
+                    self.write(self.encode(msg, seq))
+                self.held = None
+            if not data:
+                return
+
+        if not self.framed: # Each read from an older client is one message.
+            self.pending.append((CHAT, data))
+            self.handle_pending()
+            return
+
+        profiler = self.server.profiler
+        if profiler:
+            started = time.perf_counter()
+        try:
+            frames = self.decoder.feed(data)
+        except FrameError as error:
+            self.send_error(str(error))
+            self.finish()
+            return
+        if profiler:
+            profiler.observe('decode', started)
+        self.pending.extend(frames)
+        self.handle_pending()
+
+    def handle_pending(self):
+        '''
+        Handles the messages received, in order, until they run out or flood
+        control holds the rest back; the reader then waits (see throttle_delay)
+        and calls this again before reading any more.
+        '''
+        while self.pending and not self.closed:
+            kind, payload = self.pending[0]
+            if kind in (CHAT, CONTROL) and not self.admit():
+                if self.server.flood.policy == 'delay':
+                    return
+                self.pending.popleft()
+                continue
+            self.pending.popleft()
+            if kind in (CHAT, CONTROL):
+                try:
+                    msg = payload.decode(ENCODING)
+                except UnicodeDecodeError: # As for a bad frame: say why, and hang up.
+                    self.send_error(f'Messages must be {ENCODING} text.')
+                    self.finish()
+                    self.pending.clear()
+                    return
+                self.server.handle_msg(self, msg, control=kind == CONTROL)
+            elif kind == RELAY and self.peer is not None:
+                try:
+                    self.server.receive_relay(self, payload)
+                except FrameError as error: # As for any bad frame.
+                    self.send_error(str(error))
+                    self.finish()
+                    self.pending.clear()
+                    return
+        if self.closed:
+            self.pending.clear()
+
+    def admit(self):
+        '''
+        Whether a message just received from the client is to be handled,
+        given the server's flood control. Messages over a rate limit are
+        counted, and dealt with by the flood policy (see FloodControl).
+        '''
+        flood = self.server.flood
+        if flood is None or self.peer is not None: # Vetted peers (see run_command) relay many clients' messages.
+            return True
+        if flood.admit(self):
+            self.flooding = self.delayed = False
+            return True
+        if flood.policy == 'delay':
+            if not self.delayed: # Count each message once, however long it waits.
+                self.delayed = True
+                self.throttled += 1
+            return False
+        self.throttled += 1
+        if flood.policy == 'drop':
+            if not self.flooding:
+                self.flooding = True
+                self.send_error('You are sending messages too fast; some were dropped.')
+            return False
+        status_msg = (
+            f'FLOODING CLIENT: Disconnecting {self.client_addr}; ' +
+            f'{self.throttled} messages were over the rate limit.'
+        )
+        self.server.log_message(status_msg, False, WARNING)
+        self.close()
+        return False
+
+    def throttle_delay(self):
+        '''Returns the seconds to wait before handling messages held back by flood control.'''
+        return self.server.flood.wait(self)
+
+    def encode(self, msg, seq=None, encoded=None):
+        '''
+        Returns msg as bytes ready to be written to this client.
+        Public messages carry their sequence number to framing clients.
+        A message sent to many clients passes a dict, encoded, in which the
+        bytes for each protocol and codec are kept, so it is encoded once for
+        all of them, and each client's outbox holds the same bytes object.
+        '''
+        if encoded is not None:
+            key = (self.framed, self.codec)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = self.encode(msg, seq)
+            return data
+        if not self.framed:
+            return msg.encode(ENCODING)
+        frame = encode_text(CHAT, msg) if seq is None else encode_post(seq, msg)
+        if self.codec and len(frame) >= self.server.compress_min:
+            return encode_compressed(self.codec, frame)
+        return frame
+
+    def send(self, msg, seq=None, encoded=None):
+        '''
+        Sends data to the connected client. See encode for encoded.
+        '''
+        with self.lock:
+            if self.framed is None:
+                self.held.append((msg, seq))
+                if len(self.held) > self.server.queue_limit:
+                    del self.held[0]
+                    self.dropped += 1
+                return
+        self.write(self.encode(msg, seq, encoded))
+
+    def send_posted(self, seq):
+        '''Tells a framing client the sequence number its message was given.'''
+        if self.framed:
+            self.write(encode_text(CONTROL, f'{POSTED} {seq}'))
+
+    def write(self, data):
+        '''
+        Queues bytes for this client's writer. Never blocks: if the client has
+        fallen behind past its high-water marks, the server's slow policy applies.
+        '''
+        with self.outbox_ready:
+            if self.closed:
+                return
+            self.outbox.append(data)
+            self.outbox_bytes += len(data)
+            self.sent += 1
+            if len(self.outbox) == 1: # The coalescing window opens with the first message.
+                self.flush_at = time.monotonic() + self.server.coalesce_window
+            disconnect = self.overflowing() and self.shed_load()
+            # The writer waits only for an empty outbox, or to fill a coalesced write:
+            wake = len(self.outbox) == 1 or self.outbox_bytes >= self.server.coalesce_bytes
+        if disconnect:
+            status_msg = (
+                f'SLOW CLIENT: Disconnecting {self.client_addr}; ' +
+                f'{len(self.outbox)} messages were waiting.'
+            )
+            self.server.log_message(status_msg, False, WARNING)
+            self.close()
+        elif wake:
+            self.wake()
+
+    def overflowing(self):
+        '''Whether the outbox is past a high-water mark (call with outbox_ready held).'''
+        return len(self.outbox) > 1 and (
+            len(self.outbox) > self.server.queue_limit or
+            self.outbox_bytes > self.server.queue_bytes
+        )
+
+    def shed_load(self):
+        '''
+        Applies the server's slow policy to an overflowing outbox
+        (call with outbox_ready held). Returns True if the client must go.
+        The newest message is always kept.
+        '''
+        policy = self.server.slow_policy
+        if policy == 'disconnect' or self.peer is not None:
+            return True # A peer must not silently miss messages; it will redial.
+
+        newest = self.outbox.pop()
+        self.outbox_bytes -= len(newest)
+        if policy == 'drop':
+            while self.outbox and self.overflowing_with(newest):
+                self.outbox_bytes -= len(self.outbox.popleft())
+                self.dropped += 1
+        else: # summarize
+            skipped = len(self.outbox)
+            self.dropped += skipped
+            self.outbox.clear()
+            summary = self.encode(
+                f'SERVER: {skipped} messages were skipped; your connection is too slow.'
+            )
+            self.outbox.append(summary)
+            self.outbox_bytes = len(summary)
+        self.outbox.append(newest)
+        self.outbox_bytes += len(newest)
+        return False
+
+    def overflowing_with(self, data):
+        '''Whether adding data would leave the outbox past a high-water mark.'''
+        return (
+            len(self.outbox) + 1 > self.server.queue_limit or
+            self.outbox_bytes + len(data) > self.server.queue_bytes
+        )
+
+    def finish(self):
+        '''Closes the connection once everything queued for the client is written.'''
+        with self.outbox_ready:
+            self.closing = True
+        self.wake()
+
+    def coalescing(self):
+        '''
+        Whether the writer should wait before writing what is queued, to write
+        more at once (call with outbox_ready held): only for a framing client,
+        only while less than the server's coalesce_bytes is queued.
+        '''
+        return (
+            self.server.coalesce_window > 0 and self.framed and not self.closing and
+            self.outbox_bytes < self.server.coalesce_bytes
+        )
+
+    def next_writes(self):
+        '''
+        Removes and returns the oldest queued bytes, as a list to be written
+        in one call: for a framing client, everything queued, up to WRITE_BATCH
+        frames or the server's coalesce_bytes. Older clients expect each read
+        to hold one message, so they are written one at a time. The list is
+        empty if nothing is queued.
+        '''
+        with self.outbox_ready:
+            count = min(len(self.outbox), WRITE_BATCH if self.framed else 1)
+            buffers, size = [], 0
+            while len(buffers) < count and (not buffers or size < self.server.coalesce_bytes):
+                buffers.append(self.outbox.popleft())
+                size += len(buffers[-1])
+            self.outbox_bytes -= size
+            return buffers
+
+    def send_history(self, lines, first):
+        '''
+        Sends a page of logged messages to the client in one piece. Framing
+        clients are then told the sequence number of its first message, which
+        they can pass back as before to fetch the page ahead of it; the rest
+        are numbered consecutively. Pages for clients that asked for compression
+        are compressed once they reach the server's threshold.
+        '''
+        if self.framed and self.codec and (
+            sum(map(len, lines)) >= self.server.compress_min
+        ):
+            self.write(self.server.compressed_history(self.room, self.codec, first, lines))
+        elif self.framed:
+            self.write(encode_frame(HIST_FRAME, pack_records(lines)))
+            self.write(encode_text(CONTROL, f'{HIST_END} {first}'))
+        else:
+            self.write((f'{HIST_RET} |' + '|'.join(line + '\n' for line in lines)).encode(ENCODING))
+
+    def send_search(self, results, before):
+        '''
+        Sends the client search results, a list of (seq, msg), as lines of
+        '<seq> <msg>'. Framing clients are then told the seq to search before
+        for the next page of results, or -1 if there are no more.
+        '''
+        lines = [f'{seq} {msg}' for seq, msg in results]
+        if self.framed:
+            self.write(encode_frame(HIST_FRAME, pack_records(lines)))
+            self.write(encode_text(CONTROL, f'{SEARCH_END} {before}'))
+        else:
+            self.write((f'{SEARCH_RET} |' + '|'.join(line + '\n' for line in lines)).encode(ENCODING))
+
+    def send_control(self, text):
+        '''Sends the client a reply to one of its commands.'''
+        if self.framed:
+            self.write(encode_text(CONTROL, text))
+        else:
+            self.write(text.encode(ENCODING))
+
+    def send_error(self, text):
+        '''Reports an error to the client.'''
+        if self.framed:
+            self.write(encode_text(ERROR, text))
+        else:
+            self.write(f'ERROR: {text}'.encode(ENCODING))
+
+    def unread(self):
+        '''
+        Returns what was received from the client but not yet handled, as the
+        client sent it: framed bytes, or each of an older client's messages.
+        '''
+        if not self.framed:
+            return [payload for kind, payload in self.pending]
+        frames = b''.join(encode_frame(kind, payload) for kind, payload in self.pending)
+        return [frames + bytes(self.decoder.buffer)]
+
+    def detach(self):
+        '''
+        Stops serving the client, for a handoff, leaving its socket open; returns
+        what the successor needs to carry on with it (see restore). Call once
+        reading has stopped and the outbox is written.
+        '''
+        with self.outbox_ready:
+            self.closed = True # Stops the writer.
+            self.outbox_ready.notify()
+        return {
+            'address': list(self.client_addr), 'framed': self.framed, 'codec': self.codec,
+            'username': self.username, 'room': self.room.name, 'heartbeats': self.heartbeats,
+            'greeting': self.greeting.decode('latin-1'), 'held': self.held,
+            'unread': [data.decode('latin-1') for data in self.unread()],
+        }
+
+    def restore(self, state):
+        '''Picks up a client handed over by the previous server, from what detach returned.'''
+        self.framed, self.codec = state['framed'], state['codec']
+        self.heartbeats = state['heartbeats']
+        self.greeting = state['greeting'].encode('latin-1')
+        self.held = None if state['held'] is None else [tuple(held) for held in state['held']]
+        room = self.server.get_room(state['room']) or self.server.lobby
+        self.server.join_room(self, room, replay=False)
+        self.server.connections.add(self)
+        if state['username'] is not None:
+            self.server.connections.rename(self, state['username'])
+
+
 # CONNECTION SOCKET ------------------------------------------------------------
 
-class ConnectionSocket(threading.Thread):
+class ConnectionSocket(Connection, threading.Thread):
 
     def __init__(self, client_sock, client_addr, server):
-        super().__init__()
+        threading.Thread.__init__(self)
+        Connection.__init__(self, client_addr, server)
         self.client_sock = client_sock # Connected socket between client and server.
-        self.client_addr = client_addr # Client address.
-        self.server = server # Reference to hosting server.
+        self.writer = threading.Thread(target=self.drain, daemon=True) # Drains the outbox.
+        self.sending = False # Set while the writer is writing what it took from the outbox.
+
+    def start(self):
+        '''Starts this thread, and the thread that writes to the client.'''
+        threading.Thread.start(self)
+        self.writer.start()
 
     def run(self):
         '''
         Starts this thread to listen for data sent by this connections client.
         '''
+        poller = select.poll()
+        poller.register(self.client_sock, select.POLLIN)
+        poller.register(self.server.wake_readers[0], select.POLLIN)
         while True:
-            # Blocks thread until data is received from client:
-            msg = self.client_sock.recv(1024).decode(ENCODING)
-            if msg:
-                status_msg = (
-                    'MESSAGE RECEIVED: {} says...\n\t{!r}'.format(self.client_addr, msg)
-                )
-                print(status_msg)
-                self.server.log_message(status_msg, False)
-
-                # Check for special commands:
-                if msg == HIST:
-                    self.server.send_history(self.client_addr)
-
-                # Forward msg to other clients:
-                else:
-                    self.server.post_msg(msg, self.client_addr)
+            if self.server.handing_off:
+                return # Exit thread; the successor reads from now on.
+            if self.pending: # Held back by flood control; the rest stays in the socket.
+                time.sleep(self.throttle_delay())
+                self.handle_pending()
+                continue
+            # Blocks thread until data is received from client, or the server hands off:
+            poller.poll()
+            if self.server.handing_off:
+                continue
+            try:
+                data = self.client_sock.recv(RECV_SIZE if self.framed else LEGACY_RECV_SIZE)
+            except OSError:
+                data = b'' # Socket was closed from this side.
+            if data:
+                self.receive(data)
             else:
                 # Client closed connection (recv returned ''); cleanup connection:
-                status_msg = (
-                    f'CONNECTION CLOSED: {self.client_addr} has closed their connection.'
-                )
-                print(status_msg)
-                self.server.log_message(status_msg, False)
-                self.client_sock.close()
-                self.server.remove_connection(self)
+                self.close()
+                self.server.close_connection(self)
                 return # Exit thread.
-            
-    def send(self, msg):
+
+    def drain(self):
+        '''
+        Runs on the writer thread: writes queued bytes to the client as they arrive,
+        so only this thread ever waits on a slow client.
+        '''
+        while True:
+            with self.outbox_ready:
+                while not self.outbox and not self.closed and not self.closing:
+                    self.outbox_ready.wait()
+                # Give messages arriving within the window the same write:
+                while not self.closed and self.coalescing():
+                    remaining = self.flush_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.outbox_ready.wait(remaining)
+                if self.closed:
+                    return # Exit thread.
+            buffers = self.next_writes()
+            if not buffers: # Finished writing; close as asked.
+                self.close()
+                return # Exit thread.
+            profiler = self.server.profiler
+            if profiler:
+                started = time.perf_counter()
+            self.sending = True
+            try:
+                self.send_buffers(buffers)
+            except OSError:
+                self.close()
+                return # Exit thread.
+            finally:
+                self.sending = False
+            if profiler:
+                profiler.observe('write', started)
+
+    def send_buffers(self, buffers):
+        '''
+        Writes a list of bytes to the client, in one sendmsg call if the socket
+        takes them all (scatter/gather), so they are never joined into a copy.
+        '''
+        if not SCATTER:
+            buffers = [b''.join(buffers)]
+        while buffers:
+            sent = self.client_sock.sendmsg(buffers) if SCATTER else self.client_sock.send(buffers[0])
+            self.writes += 1
+            self.sent_bytes += sent
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent: # Part of a buffer was written; the rest goes next.
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+    def wake(self):
+        '''Rouses the writer thread after bytes are queued.'''
+        with self.outbox_ready:
+            self.outbox_ready.notify()
+
+    def flushed(self):
+        '''Whether everything queued for the client has been written.'''
+        return not self.outbox and not self.sending
+
+    def fileno(self):
+        return self.client_sock.fileno()
+
+    def release(self):
+        '''Closes this process's copy of the socket, once handed off; the client stays connected.'''
+        self.client_sock.close()
+
+    def close(self):
+        '''Closes the connection with the client; the reader thread then cleans up.'''
+        with self.outbox_ready:
+            self.closed = True
+            self.outbox_ready.notify()
+        try:
+            self.client_sock.shutdown(skt.SHUT_RDWR) # Wakes the reader from recv.
+        except OSError:
+            pass # Already closed.
+        self.client_sock.close()
+
+
+# ASYNC SERVER -----------------------------------------------------------------
+
+class AsyncServer(Server):
+    '''
+    Serves the same chatroom as Server, but from one asyncio event loop
+    instead of one thread per client (selected with --engine asyncio).
+    Accept, reads, fan-out and history replay all run on this thread.
+    '''
+
+    def __init__(self, host, port, **options):
+        super().__init__(host, port, **options)
+        self.loop = None # Event loop; set once the server thread starts.
+
+    def run(self):
+        '''Starts this thread and runs the event loop until the server quits.'''
+        self.start_session()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        '''Binds the listening socket and accepts connections forever.'''
+        self.loop = asyncio.get_running_loop()
+        if self.takeover: # The previous server's listening socket, already bound.
+            listener = await asyncio.start_server(self.accept, sock=self.takeover.listener)
+        else:
+            listener = await asyncio.start_server(
+                self.accept, self.host, self.port,
+                reuse_address=True, reuse_port=bool(self.bus), backlog=BACKLOG
+            )
+        self.listener = listener
+        status_msg = (
+            'SERVER STARTED SUCCESSFULLY.\n' +
+            f'LISTENING AT: {listener.sockets[0].getsockname()}'
+        )
+        self.log_message(status_msg, False, INFO)
+
+        for address in self.peer_addrs:
+            asyncio.create_task(self.dial_peer(address))
+        if self.takeover:
+            self.take_over([
+                await self.adopt(client_sock, state)
+                for client_sock, state in self.takeover.clients
+            ])
+
+        async with listener:
+            try:
+                await listener.serve_forever()
+            except asyncio.CancelledError:
+                if not self.handing_off:
+                    raise
+        if self.handing_off: # Keep the loop running while hand_off passes the clients on.
+            await self.loop.create_future()
+
+    async def dial_peer(self, address):
+        '''The AsyncServer counterpart to Server.dial_peer; a task, not a thread.'''
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*address)
+                writer.write(HELLO)
+                if await reader.readexactly(len(HELLO)) != HELLO:
+                    raise ConnectionError('peer does not speak framing')
+                writer.write(encode_text(CONTROL, self.peer_hello()))
+            except (OSError, asyncio.IncompleteReadError) as error:
+                status_msg = f'PEER UNREACHABLE: {address}: {error}'
+                self.log_message(status_msg, False, WARNING)
+                await asyncio.sleep(PEER_RETRY)
+                continue
+            link = AsyncConnection(reader, writer, self)
+            link.framed, link.held, link.peer = True, None, f'{address[0]}:{address[1]}'
+            self.join_room(link, self.lobby, replay=False)
+            self.connections.add(link)
+            await link.run() # Until the link drops.
+            await asyncio.sleep(PEER_RETRY)
+
+    async def accept(self, reader, writer):
+        '''Manages one client connection; runs as its own task on the loop.'''
+        connection = AsyncConnection(reader, writer, self)
+        status_msg = (
+            f'NEW CONNECTION: Client {connection.client_addr} -> ' +
+            f"Local {writer.get_extra_info('sockname')}"
+        )
+        self.log_message(status_msg, False, INFO)
+
+        self.join_room(connection, self.lobby, replay=False)
+        self.connections.add(connection)
+        status_msg = (
+            f'CONNECTION READY: Ready to receive data from {connection.client_addr}'
+        )
+        self.log_message(status_msg, False, DEBUG)
+        await connection.run()
+
+    def stop_io(self):
+        '''The AsyncServer counterpart to Server.stop_io; called from another thread.'''
+        return asyncio.run_coroutine_threadsafe(self.stop_tasks(), self.loop).result()
+
+    async def stop_tasks(self):
+        '''Stops accepting, and every client's reader task; returns a copy of the listening socket.'''
+        listener = os.dup(self.listener.sockets[0].fileno())
+        self.listener.close()
+        clients = [connection for connection in self.connections if connection.peer is None]
+        for connection in clients:
+            connection.writer.transport.pause_reading()
+            connection.task.cancel()
+        await asyncio.sleep(0) # Lets the cancelled tasks finish.
+        for connection in clients:
+            await connection.stop_reading()
+        return listener
+
+    def release_listener(self, listener):
+        os.close(listener) # The copy stop_tasks made; the listener itself is closed.
+
+    async def adopt(self, client_sock, state):
+        '''The AsyncServer counterpart to Server.adopt.'''
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        connection = AsyncConnection(reader, writer, self)
+        connection.restore(state)
+        return connection
+
+
+# ASYNC CONNECTION -------------------------------------------------------------
+
+class AsyncConnection(Connection):
+    '''The AsyncServer counterpart to ConnectionSocket; a task, not a thread.'''
+
+    def __init__(self, reader, writer, server):
+        super().__init__(writer.get_extra_info('peername'), server)
+        self.reader = reader # Stream of data sent by the client.
+        self.writer = writer # Buffered stream of data sent to the client.
+        self.ready = asyncio.Event() # Set when bytes are queued for the writer task.
+        self.task = None # Task reading from the client; set once run.
+
+    def start(self):
+        '''Serves a connection made outside accept, e.g. one handed over; call on the event loop.'''
+        asyncio.create_task(self.run())
+
+    async def run(self):
         '''
-        Sends data to the connected client.
+        Listens for data sent by this connections client.
         '''
-        self.client_sock.sendall(msg.encode(ENCODING)) # Sends all data in buffer.
+        self.task = asyncio.current_task()
+        writer_task = asyncio.create_task(self.drain())
+        try:
+            await self.read_loop(writer_task)
+        except asyncio.CancelledError:
+            if not self.server.handing_off:
+                raise
+            # Stopped by AsyncServer.stop_tasks; what is unread is handed off.
+
+    async def read_loop(self, writer_task):
+        '''Reads from the client until it goes away; the body of run.'''
+        while True:
+            if self.pending: # Held back by flood control; the rest stays in the socket.
+                await asyncio.sleep(self.throttle_delay())
+                self.handle_pending()
+                continue
+            # Yields to the event loop until data is received from client:
+            try:
+                data = await self.reader.read(RECV_SIZE if self.framed else LEGACY_RECV_SIZE)
+            except ConnectionError:
+                data = b''
+            if data:
+                self.receive(data)
+                await asyncio.sleep(0) # Let writer tasks run between reads.
+            else:
+                # Client closed connection (read returned ''); cleanup connection:
+                self.close()
+                writer_task.cancel()
+                self.server.close_connection(self)
+                return # Exit task.
+
+    async def drain(self):
+        '''
+        Runs as this client's writer task: writes queued bytes to the client,
+        waiting on it only when it is slow, while other tasks carry on.
+        '''
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            with self.outbox_ready:
+                delay = self.flush_at - time.monotonic() if self.coalescing() else 0
+            if delay > 0: # Give messages arriving within the window the same write:
+                timer = self.server.loop.call_later(delay, self.ready.set)
+                await self.ready.wait() # Set early if the outbox fills first.
+                timer.cancel()
+                self.ready.clear()
+            buffers = self.next_writes()
+            while buffers:
+                profiler = self.server.profiler
+                if profiler:
+                    started = time.perf_counter()
+                self.writer.writelines(buffers) # Writes what the socket takes now; buffers the rest.
+                if profiler:
+                    profiler.observe('write', started)
+                self.writes += 1
+                self.sent_bytes += sum(map(len, buffers))
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    self.close()
+                    return # Exit task.
+                buffers = self.next_writes()
+            if self.closing:
+                self.close()
+                return # Exit task.
+
+    def wake(self):
+        '''Rouses the writer task after bytes are queued.'''
+        self.call_soon(self.ready.set)
+
+    async def stop_reading(self):
+        '''
+        Takes what the stream has buffered but the reader task, now stopped,
+        has not handled, so it is handed off along with the rest (see unread).
+        '''
+        self.reader.feed_eof()
+        data = await self.reader.read()
+        if self.framed is None:
+            self.greeting += data
+        elif self.framed:
+            self.decoder.buffer += data
+        elif data:
+            self.pending.append((CHAT, data))
+
+    def flushed(self):
+        '''Whether everything queued for the client has been written.'''
+        return not self.outbox and not self.writer.transport.get_write_buffer_size()
+
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+
+    def release(self):
+        '''Closes this process's copy of the socket, once handed off; the client stays connected.'''
+        self.call_soon(self.writer.transport.abort)
+
+    def close(self):
+        '''Closes the connection with the client.'''
+        with self.outbox_ready:
+            self.closed = True
+        self.call_soon(self.writer.close)
+
+    def call_soon(self, func, *args):
+        '''Runs func on the event loop; needed when called from the command thread.'''
+        if threading.current_thread() is self.server:
+            func(*args)
+        else:
+            self.server.loop.call_soon_threadsafe(func, *args)
+
+
+# HUB --------------------------------------------------------------------------
+
+class Hub(Server):
+    '''
+    Runs the chatroom across --workers processes, so it is not limited to one
+    core. Each worker is a Server (or AsyncServer) accepting clients on the
+    same port through SO_REUSEPORT; the hub, in the parent process, accepts
+    no clients. Instead every worker's public messages come here over a Unix
+    socket (see Bus): the hub numbers them in their room's sequence, logs them,
+    and sends them back to every worker, in the same order, to deliver. So
+    every worker holds the same history, and the public logs are written once.
+    Older history pages are read from the logs here, on a worker's behalf.
+    '''
+
+    def __init__(self, host, port, listener, workers, **options):
+        super().__init__(host, port, **options)
+        self.listener = listener # Bound Unix socket the workers connect to.
+        self.worker_count = workers # Workers to wait for.
+        self.workers = [] # WorkerLinks, one per worker.
+        self.history_size = 0 # The workers serve recent history; the hub only reads logs.
+        self.reaper = None # The workers watch their own clients.
+
+    def run(self):
+        '''Starts this thread, which accepts the workers' links to the hub.'''
+        self.start_session()
+        while len(self.workers) < self.worker_count:
+            link = WorkerLink(self.listener.accept()[0], self)
+            self.workers.append(link)
+        os.unlink(self.listener.getsockname()) # Every worker is linked.
+        for link in self.workers:
+            link.start()
+        status_msg = (
+            f'SERVER STARTED SUCCESSFULLY.\nLISTENING AT: {(self.host, self.port)} ' +
+            f'with {self.worker_count} workers'
+        )
+        self.log_message(status_msg, False, INFO)
+
+    def post_msg(self, msg, source, room):
+        '''Numbers and logs a message posted to a worker, and sends it to every worker.'''
+        with room.lock:
+            seq = room.posted
+            room.posted += 1
+            self.log_message(msg, seq=seq, source=source, room=room)
+            frame = encode_frame(POST, pack_records(
+                [room.name, str(seq), source[0], str(source[1]), msg]
+            ))
+            for link in self.workers:
+                link.send(frame)
+
+
+class WorkerLink(threading.Thread):
+    '''The hub's end of one worker's bus; reads what the worker sends, on its own thread.'''
+
+    def __init__(self, socket, hub):
+        super().__init__(daemon=True)
+        self.socket = socket # Unix socket connected to the worker.
+        self.hub = hub
+        self.lock = threading.Lock() # Keeps frames sent from different threads whole.
+
+    def send(self, frame):
+        '''Sends a frame to the worker.'''
+        with self.lock:
+            self.socket.sendall(frame)
+
+    def run(self):
+        '''Carries out the worker's requests until it goes away.'''
+        decoder = FrameDecoder()
+        while True:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                self.hub.log_message('WORKER LOST: A worker has exited.', False, WARNING)
+                return # Exit thread.
+            for kind, payload in decoder.feed(data):
+                fields = unpack_records(payload)
+                if kind == POST: # msg, client host, client port, room
+                    room = self.hub.get_room(fields[3])
+                    if room is not None:
+                        self.hub.post_msg(fields[0], (fields[1], int(fields[2])), room)
+                elif kind == HIST_FRAME: # request id, room, start, end
+                    room = self.hub.get_room(fields[1])
+                    lines = []
+                    if room is not None:
+                        self.hub.log_writer.flush()
+                        lines = room.store.read(int(fields[2]), int(fields[3]))
+                    self.send(encode_frame(HIST_FRAME, pack_records([fields[0]] + lines)))
+                elif kind == CONTROL: # request id, room, before, limit, words...
+                    room = self.hub.get_room(fields[1])
+                    results = []
+                    if room is not None:
+                        before = int(fields[2]) if fields[2] != '-1' else None
+                        results = self.hub.search(room, fields[4:], before, int(fields[3])) or []
+                    lines = [f'{seq} {msg}' for seq, msg in results]
+                    self.send(encode_frame(HIST_FRAME, pack_records([fields[0]] + lines)))
+
+
+# BUS --------------------------------------------------------------------------
+
+class Bus(threading.Thread):
+    '''
+    A worker's link to the hub (see Hub), read on its own thread. Messages the
+    worker's clients post are sent to the hub; each comes back numbered, along
+    with those posted on every other worker, and is delivered to the worker's
+    clients in that order. History older than the worker holds is read through
+    the hub, as are searches. If the hub goes away, so does the worker.
+    '''
+
+    def __init__(self, server, path):
+        super().__init__(daemon=True)
+        self.server = server # The worker.
+        self.path = path # Hub's Unix socket.
+        self.socket = None # Connected by connect().
+        self.lock = threading.Lock() # Keeps frames sent from different threads whole.
+        self.requests = {} # Request id -> [Event, lines] for history reads and searches in progress.
+        self.request_ids = counter() # Numbers history reads and searches.
+
+    def connect(self):
+        '''Connects to the hub, and starts reading what it sends.'''
+        self.socket = skt.socket(skt.AF_UNIX, skt.SOCK_STREAM)
+        self.socket.connect(self.path)
+        self.start()
+
+    def send(self, kind, fields):
+        '''Sends the hub a frame carrying a list of strings.'''
+        frame = encode_frame(kind, pack_records(fields))
+        with self.lock:
+            self.socket.sendall(frame)
+
+    def post(self, msg, source, room):
+        '''Sends the hub a public message posted in room by the client at source.'''
+        self.send(POST, [msg, source[0], str(source[1]), room])
+
+    def read(self, room, start, end):
+        '''Returns the logged messages of room with sequence numbers start up to end.'''
+        return self.request(HIST_FRAME, [room, str(start), str(end)])
+
+    def search(self, room, words, before, limit):
+        '''Returns the hub's search of room; see Server.search.'''
+        before = -1 if before is None else before
+        lines = self.request(CONTROL, [room, str(before), str(limit), *words])
+        return [(int(seq), msg) for seq, _, msg in (line.partition(' ') for line in lines)]
+
+    def request(self, kind, fields):
+        '''Sends the hub a request, and returns the lines of its reply.'''
+        request_id = str(next(self.request_ids))
+        request = self.requests[request_id] = [threading.Event(), None]
+        self.send(kind, [request_id, *fields])
+        request[0].wait()
+        del self.requests[request_id]
+        return request[1]
+
+    def run(self):
+        '''Delivers messages from the hub, and answers history reads.'''
+        decoder = FrameDecoder()
+        while True:
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                os._exit(0) # The hub has shut down; so does this worker.
+            for kind, payload in decoder.feed(data):
+                fields = unpack_records(payload)
+                if kind == POST: # room, seq, client host, client port, msg
+                    room = self.server.get_room(fields[0])
+                    if room is not None:
+                        with room.lock:
+                            self.server.deliver(
+                                fields[4], int(fields[1]), (fields[2], int(fields[3])), room
+                            )
+                elif kind == HIST_FRAME: # request id, lines...
+                    request = self.requests[fields[0]]
+                    request[1] = fields[1:]
+                    request[0].set()
+
+
+class BusStore:
+    '''Stands in for a room's public log on a worker; reads go to the hub, which keeps it.'''
+
+    def __init__(self, bus, room):
+        self.bus = bus
+        self.room = room # Room name.
+
+    def open(self):
+        pass
+
+    def flush(self, fsync=False):
+        pass
+
+    def read(self, start, end):
+        '''Returns the messages with sequence numbers start up to end.'''
+        return self.bus.read(self.room, start, end)
+
+
+def run_worker(server_type, host, port, worker, options):
+    '''Runs one worker process of a --workers server (see Hub).'''
+    if options.get('stats_port'): # The hub serves the port given; workers the next ones.
+        options = dict(options, stats_port=options['stats_port'] + 1 + worker)
+    server = server_type(
+        host, port, bus_path=BUS_SOCKET,
+        admin_log=ADMIN_LOG.replace('.txt', f'_worker{worker}.txt'), **options
+    )
+    server.start()
+    server.join()
+
+
+# HANDOFF ----------------------------------------------------------------------
+
+def send_handoff(channel, message, fds=()):
+    '''Sends a handoff message, JSON, over a Unix socket, passing the file descriptors fds with it.'''
+    data = json.dumps(message).encode(ENCODING)
+    skt.send_fds(channel, [HANDOFF_HEADER.pack(len(data), len(fds))], list(fds))
+    channel.sendall(data)
+
+
+def recv_handoff(channel):
+    '''Returns the next handoff message from a Unix socket, and the file descriptors passed with it.'''
+    header, fds, _, _ = skt.recv_fds(channel, HANDOFF_HEADER.size, HANDOFF_BATCH)
+    if len(header) < HANDOFF_HEADER.size:
+        raise ConnectionError('the other server went away during the handoff')
+    size, count = HANDOFF_HEADER.unpack(header)
+    if len(fds) != count:
+        raise ConnectionError(f'{count} sockets were handed off, but {len(fds)} arrived')
+    data = bytearray()
+    while len(data) < size:
+        chunk = channel.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('the other server went away during the handoff')
+        data += chunk
+    return json.loads(data), fds
+
+
+class Takeover:
+    '''
+    A new server's end of a handoff (see Server.hand_off): connects to the
+    running server at path, and receives its session, its rooms, its
+    listening socket and its clients' sockets, before the new server starts.
+    '''
+
+    def __init__(self, path):
+        self.channel = skt.socket(skt.AF_UNIX, skt.SOCK_STREAM) # Link with the running server.
+        self.channel.connect(path)
+        send_handoff(self.channel, {'ready': os.getpid()})
+        message, fds = recv_handoff(self.channel)
+        self.session = message['session'] # SESSION_START of the server taken over.
+        self.rooms = message['rooms'] # Each room's name, next sequence number and history.
+        self.listener = skt.socket(fileno=fds[0]) # Listening socket, bound and listening.
+        self.clients = [] # (socket, state) of each client; see Connection.detach.
+        while True:
+            message, fds = recv_handoff(self.channel)
+            if message.get('done'):
+                break
+            self.clients.extend(
+                (skt.socket(fileno=fd), state) for fd, state in zip(fds, message['connections'])
+            )
+
+
+def adopt_session(session):
+    '''Carries on the session of a server taken over, and its log files with it.'''
+    global SESSION_START, ADMIN_LOG, PUBLIC_LOG, SEGMENT_DIR, SEARCH_DIR, HANDOFF_SOCKET, PROFILE
+    ADMIN_LOG, PUBLIC_LOG, SEGMENT_DIR, SEARCH_DIR, HANDOFF_SOCKET, PROFILE = (
+        path.replace(SESSION_START, session)
+        for path in (ADMIN_LOG, PUBLIC_LOG, SEGMENT_DIR, SEARCH_DIR, HANDOFF_SOCKET, PROFILE)
+    )
+    SESSION_START = session
+
+
+def handoff_listener(path):
+    '''Returns a Unix socket listening at path for a successor, replacing any stale one.'''
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = skt.socket(skt.AF_UNIX, skt.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    return listener
+
+
+def await_successor(server, path):
+    '''
+    Waits, on its own thread, for a new server started with --takeover path
+    to connect (see --handoff); hands off to it, then exits.
+    '''
+    listener = handoff_listener(path)
+    channel = listener.accept()[0]
+    listener.close()
+    os.unlink(path)
+    server.hand_off(channel)
+    os._exit(0)
+
+
+def start_successor(server):
+    '''
+    Starts a new server process with this one's arguments, and hands off to
+    it (the h command). Returns the process, or None if it exited instead.
+    '''
+    listener = handoff_listener(HANDOFF_SOCKET)
+    args, skip = [], False
+    for arg in sys.argv[1:]: # Drop any earlier --takeover.
+        if not skip and not arg.startswith('--takeover'):
+            args.append(arg)
+        skip = arg == '--takeover'
+    successor = subprocess.Popen(
+        [sys.executable, sys.argv[0], *args, '--takeover', HANDOFF_SOCKET]
+    )
+    listener.settimeout(1)
+    while True:
+        try:
+            channel = listener.accept()[0]
+            break
+        except skt.timeout:
+            if successor.poll() is not None:
+                listener.close()
+                os.unlink(HANDOFF_SOCKET)
+                return None
+    listener.close()
+    os.unlink(HANDOFF_SOCKET)
+    channel.settimeout(None)
+    server.hand_off(channel)
+    return successor
 
 
 # COMMAND ----------------------------------------------------------------------
 
+def latency_summary(histogram):
+    '''Returns a Histogram summary as one line for the console.'''
+    if not histogram['count']:
+        return 'no samples'
+    return (
+        f"p50 <= {histogram['p50_ms']:g} ms  p99 <= {histogram['p99_ms']:g} ms" +
+        f"  mean {histogram['mean_ms']:.3f} ms  ({histogram['count']} samples)"
+    )
+
 def command(server):
     '''
     Sends commands to the server from the keyboard.
     '''
+    profiles = counter() # Numbers the stack sample files written by p.
     while True:
         cmd = input('')
 
         if cmd == 'q': # quit
 
             # Close all connections:
+            connections = server.connections.snapshot
             print(
                 'COMMAND: quit (q)\n\t' + 
-                f"Closing {len(server.connections)} active" + 
-                f" connection{'s' if len(server.connections) != 1 else ''}..."
+                f"Closing {len(connections)} active" + 
+                f" connection{'s' if len(connections) != 1 else ''}..."
             )
-            for connection in server.connections:
-                connection.client_sock.close()
+            for connection in connections:
+                connection.close()
 
             # Shut down server:
             print('SHUTDOWN: Shutting down server...')
+            server.log_writer.flush()
             os._exit(0)
 
+        elif cmd == 'h': # hand off
+            # Start a new server process, e.g. with updated code, and pass it every client:
+            print('COMMAND: hand off (h)')
+            if isinstance(server, Hub):
+                print('\tHandoff is not supported with --workers.')
+                continue
+            print('\tStarting a new server to take over...')
+            successor = start_successor(server)
+            if successor is None:
+                print('\tThe new server exited before taking over; carrying on.')
+                continue
+            print('\tHanded off; this console now belongs to the new server.')
+            os._exit(successor.wait())
+
         elif cmd == 'c': # clients
             # Show the addresses of all connected clients:
+            connections = server.connections.snapshot
             print(
                 'COMMAND: clients (c)\n\t' + 
-                f"Displaying {len(server.connections)} active" + 
-                f" connection{'s' if len(server.connections) != 1 else ''}..."
+                f"Displaying {len(connections)} active" + 
+                f" connection{'s' if len(connections) != 1 else ''}..."
+            )
+            for connection in connections:
+                name = f'peer {connection.peer}' if connection.peer else connection.username
+                print(
+                    f"\t{connection.client_addr}  {name or '(unnamed)'}" +
+                    f"  room: #{connection.room.name}" +
+                    f"  queued: {len(connection.outbox)}" +
+                    f" ({connection.outbox_bytes} bytes)  dropped: {connection.dropped}" +
+                    f"  throttled: {connection.throttled}"
+                )
+
+        elif cmd == 'r': # rooms
+            # Show every open room, and how many clients are in it:
+            with server.rooms_lock:
+                rooms = list(server.rooms.values())
+            print(
+                'COMMAND: rooms (r)\n\t' +
+                f"Displaying {len(rooms)} open room{'s' if len(rooms) != 1 else ''}..."
             )
-            for connection in server.connections:
-                print(f"\t{connection.client_addr}")
+            for room in rooms:
+                print(
+                    f"\t#{room.name}  clients: {len(room.subscribers)}" +
+                    f"  posted: {room.posted}"
+                )
+
+        elif cmd == 's': # stats
+            # Show the server's counters and latencies (see Metrics):
+            stats = server.metrics.snapshot()
+            fanout, log_write = stats['fanout_latency'], stats['log_write_latency']
+            print(
+                'COMMAND: stats (s)\n\t' +
+                f"Up {stats['uptime_seconds']:.0f} s; rates are since the last reading.\n\t" +
+                f"connections: {stats['connections_active']} active" +
+                f" ({stats['connections_opened']} opened)  peers: {stats['peers']}" +
+                f"  rooms: {stats['rooms']}" +
+                f"  reaped: {stats['connections_reaped']} dead," +
+                f" {stats['connections_idle']} idle ({stats['pings_sent']} pings)\n\t" +
+                f"messages in: {stats['messages_in']} ({stats['messages_in_per_second']:.1f}/s)" +
+                f"  out: {stats['messages_out']} ({stats['messages_out_per_second']:.1f}/s)" +
+                f"  dropped: {stats['messages_dropped']}" +
+                f"  throttled: {stats['messages_throttled']}\n\t" +
+                f"bytes in: {stats['bytes_in']}  out: {stats['bytes_out']}" +
+                f" in {stats['socket_writes']} writes" +
+                f"  history requests: {stats['history_requests']}" +
+                f" (compressed: {stats['history_cache_misses']}," +
+                f" from cache: {stats['history_cache_hits']})" +
+                f"  searches: {stats['search_requests']}\n\t" +
+                f"send queues: {stats['queued_messages']} messages" +
+                f" ({stats['queued_bytes']} bytes), longest {stats['queued_messages_max']}" +
+                f"  log records waiting: {stats['log_records_waiting']}\n\t" +
+                f"fan-out latency: {latency_summary(fanout)}\n\t" +
+                f"log write latency: {latency_summary(log_write)}"
+            )
+
+        elif cmd == 'p': # profile
+            # Show the stage timers, and sample every thread's stack if asked:
+            print('COMMAND: profile (p)')
+            if server.profiler:
+                for line in server.profiler.report():
+                    print('\t' + line)
+            else:
+                print('\tStage timers are off; start the server with --profile to time each stage.')
+            print('\tSample stacks for how many seconds? (blank for none) > ', end='')
+            seconds = input()
+            try:
+                seconds = float(seconds) if seconds else None
+            except ValueError:
+                print(f'\tNot a number of seconds: {seconds!r}')
+                seconds = None
+            if seconds:
+                path = PROFILE.format(next(profiles))
+                StackSampler(server, seconds, path).start()
+                print(f'\tSampling for {seconds:g} s; stacks go to {path}.')
 
         elif cmd == 'm': # message client
-            print('COMMAND: message client (m)\n\tEnter client IP > ', end='')
-            client_ip = input()
-            client_port = int(input('Enter client port > '))
-            print(f'Enter your message to client {(client_ip, client_port)}\n\t > ', end='')
+            print('COMMAND: message client (m)\n\tEnter client IP or username > ', end='')
+            client = input()
+            if server.connections.find(client) is None: # Not a username; an IP.
+                client = (client, int(input('Enter client port > ')))
+            print(f'Enter your message to client {client}\n\t > ', end='')
             msg = 'SERVER: ' + input()
-            server.msg_client(msg, (client_ip, client_port))
+            server.msg_client(msg, client)
 
             
 
@@ -261,11 +2788,186 @@ if __name__ == '__main__':
     parser.add_argument('host', help='Interface the server listens at')
     parser.add_argument('-p', metavar='PORT', type=int, default=DEFAULT_PORT,
                         help=f'TCP port (default {DEFAULT_PORT})')
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help='thread: one thread per client (default); ' +
+                        'asyncio: one event loop for every client')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Worker processes sharing the port, to use N cores; ' +
+                        'each runs the chosen engine (default 1)')
+    parser.add_argument('--peer', metavar='HOST:PORT', action='append', default=[],
+                        help='Another minserver to federate with: public messages are ' +
+                        'relayed both ways (may be given more than once)')
+    parser.add_argument('--node', metavar='NAME',
+                        help='Name of this server among its peers, unique to each ' +
+                        '(default HOSTNAME:PORT)')
+    parser.add_argument('--peer-secret', metavar='SECRET',
+                        help='Shared by federated servers: a server that knows it may ' +
+                        'link from any address, not only one named with --peer')
+    parser.add_argument('--stats-port', metavar='PORT', type=int,
+                        help='Serve metrics at http://127.0.0.1:PORT/ as plain text, ' +
+                        'and at /json as JSON; with --workers, worker n serves ' +
+                        'PORT+1+n (default off)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each stage of the message pipeline, shown by the ' +
+                        'p console command (costs a little per message)')
+    parser.add_argument('--compress-min', metavar='BYTES', type=int, default=COMPRESS_MIN,
+                        help='Size from which history and messages are compressed, for ' +
+                        f'clients that support it (default {COMPRESS_MIN})')
+    parser.add_argument('--coalesce-ms', metavar='MS', type=float, default=COALESCE_WINDOW * 1000,
+                        help="How long a framing client's messages are gathered into " +
+                        f'one write (default {COALESCE_WINDOW * 1000:g})')
+    parser.add_argument('--coalesce-bytes', metavar='BYTES', type=int, default=COALESCE_BYTES,
+                        help="Bytes of a client's messages written at once, without " +
+                        f'waiting out --coalesce-ms (default {COALESCE_BYTES})')
+    parser.add_argument('--latency-first', action='store_true',
+                        help='Write every message as soon as it is queued: no ' +
+                        'coalescing, at the cost of more writes (same as --coalesce-ms 0)')
+    parser.add_argument('--rate-limit', metavar='RATE', type=float,
+                        help='Messages a second each connection may send (default no limit)')
+    parser.add_argument('--user-rate-limit', metavar='RATE', type=float,
+                        help="Messages a second each username may send, across its " +
+                        'connections (default no limit)')
+    parser.add_argument('--global-rate-limit', metavar='RATE', type=float,
+                        help='Messages a second the server takes from all clients; with ' +
+                        '--workers, each worker (default no limit)')
+    parser.add_argument('--flood-burst', metavar='SECONDS', type=float, default=FLOOD_BURST,
+                        help='Seconds of each rate limit that may be sent at once ' +
+                        f'(default {FLOOD_BURST})')
+    parser.add_argument('--flood-policy', choices=FLOOD_POLICIES, default='delay',
+                        help='For messages over a rate limit: delay reading more from the ' +
+                        'client (default), drop them with a notice, or disconnect')
+    parser.add_argument('--heartbeat', metavar='SECONDS', type=float, default=HEARTBEAT,
+                        help='Seconds a client may be silent before it is pinged; 0 for no ' +
+                        f'pings (default {HEARTBEAT})')
+    parser.add_argument('--heartbeat-timeout', metavar='SECONDS', type=float,
+                        default=HEARTBEAT_TIMEOUT,
+                        help='Seconds a pinged client has to answer before it is disconnected ' +
+                        f'(default {HEARTBEAT_TIMEOUT})')
+    parser.add_argument('--idle-timeout', metavar='SECONDS', type=float,
+                        help='Disconnect clients that send nothing for this long (default never)')
+    parser.add_argument('--queue-size', metavar='MESSAGES', type=int, default=QUEUE_LIMIT,
+                        help='Messages that may wait to be sent to one client ' +
+                        f'(default {QUEUE_LIMIT})')
+    parser.add_argument('--queue-bytes', metavar='BYTES', type=int, default=QUEUE_BYTES,
+                        help='Bytes that may wait to be sent to one client ' +
+                        f'(default {QUEUE_BYTES})')
+    parser.add_argument('--slow-policy', choices=SLOW_POLICIES, default='drop',
+                        help='When a client falls behind: drop its oldest messages ' +
+                        '(default), disconnect it, or summarize what it missed')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='debug',
+                        help='Least level of status message shown on the console; ' +
+                        "'info' hides per-message detail (default debug)")
+    parser.add_argument('--flush-interval', metavar='SECONDS', type=float,
+                        default=FLUSH_INTERVAL,
+                        help=f'Seconds log records gather before a write (default {FLUSH_INTERVAL})')
+    parser.add_argument('--flush-batch', metavar='RECORDS', type=int, default=FLUSH_BATCH,
+                        help=f'Log records that trigger a write at once (default {FLUSH_BATCH})')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='never',
+                        help="'batch' forces every log write to disk (default never)")
+    parser.add_argument('--history', metavar='MESSAGES', type=int, default=HISTORY_SIZE,
+                        help='Recent public messages kept in memory for history requests ' +
+                        f'(default {HISTORY_SIZE})')
+    parser.add_argument('--store', choices=STORES, default='text',
+                        help='text: one plain-text public log (default); ' +
+                        'segments: a directory of indexed, compressed segments; ' +
+                        'sqlite: a queryable SQLite database (see --db)')
+    parser.add_argument('--db', metavar='FILE', default=DATABASE,
+                        help=f'SQLite database for --store sqlite (default {DATABASE})')
+    parser.add_argument('--handoff', metavar='SOCKET',
+                        help='Listen at this Unix socket for a new server, started with ' +
+                        '--takeover SOCKET, to hand every client to before exiting')
+    parser.add_argument('--takeover', metavar='SOCKET',
+                        help='Start by taking over the clients of the server listening ' +
+                        'at this Unix socket (see --handoff)')
+    parser.add_argument('--no-search', action='store_true',
+                        help='Keep no search index of the public log; !SEARCH! is refused')
+    parser.add_argument('--segment-bytes', metavar='BYTES', type=int, default=SEGMENT_BYTES,
+                        help=f'Size at which a segment is sealed (default {SEGMENT_BYTES})')
+    parser.add_argument('--segment-seconds', metavar='SECONDS', type=float,
+                        help='Age at which a segment is sealed (default no limit)')
+    parser.add_argument('--retention-segments', metavar='SEGMENTS', type=int,
+                        help='Sealed segments kept; older ones are deleted (default all)')
+    parser.add_argument('--retention-seconds', metavar='SECONDS', type=float,
+                        help='Age after which sealed segments are deleted (default never)')
     args = parser.parse_args()
+    if args.peer and args.workers > 1:
+        parser.error('--peer cannot be combined with --workers')
+    if args.peer_secret is not None and not re.fullmatch(r'[!-~]+', args.peer_secret):
+        parser.error('--peer-secret must be printable ASCII with no spaces')
+    if (args.handoff or args.takeover) and args.workers > 1:
+        parser.error('--handoff and --takeover cannot be combined with --workers')
+    takeover = None
+    if args.takeover: # Before anything is named after the session, which carries on.
+        takeover = Takeover(args.takeover)
+        adopt_session(takeover.session)
+    peers = []
+    for peer in args.peer:
+        peer_host, _, peer_port = peer.rpartition(':')
+        if not peer_host or not peer_port.isdigit():
+            parser.error(f'--peer expects HOST:PORT, not {peer!r}')
+        peers.append((peer_host, int(peer_port)))
 
     # Instantiate with external ip and port, and run server:
-    server = Server(args.host, args.p) 
+    server_type = AsyncServer if args.engine == 'asyncio' else Server
+    new_store = None # Defaults to a TextStore per room, writing PUBLIC_LOG for the lobby.
+    if args.store == 'segments':
+        new_store = lambda room: SegmentStore(
+            room_log(SEGMENT_DIR, room), log_header('Public', args.host, args.p),
+            segment_bytes=args.segment_bytes,
+            segment_seconds=args.segment_seconds,
+            retention_segments=args.retention_segments,
+            retention_seconds=args.retention_seconds,
+        )
+    elif args.store == 'sqlite':
+        new_store = lambda room: SqliteStore(
+            args.db, SESSION_START, log_header('Public', args.host, args.p), room
+        )
+    options = dict(
+        queue_limit=args.queue_size,
+        queue_bytes=args.queue_bytes,
+        slow_policy=args.slow_policy,
+        console_level=LOG_LEVELS[args.log_level],
+        flush_interval=args.flush_interval,
+        flush_batch=args.flush_batch,
+        fsync=args.fsync,
+        history_size=args.history,
+        new_store=new_store,
+        stats_port=args.stats_port,
+        profile=args.profile,
+        compress_min=args.compress_min,
+        coalesce_window=0 if args.latency_first else args.coalesce_ms / 1000,
+        coalesce_bytes=args.coalesce_bytes,
+        search_dir=None if args.no_search else SEARCH_DIR,
+        heartbeat=args.heartbeat,
+        heartbeat_timeout=args.heartbeat_timeout,
+        idle_timeout=args.idle_timeout,
+    )
+    if args.rate_limit or args.user_rate_limit or args.global_rate_limit:
+        options['flood'] = FloodControl(
+            args.flood_policy, args.rate_limit, args.user_rate_limit, args.global_rate_limit,
+            args.flood_burst
+        )
+    if args.workers > 1:
+        # Bind the hub's socket, then fork the workers before any thread starts:
+        listener = skt.socket(skt.AF_UNIX, skt.SOCK_STREAM)
+        listener.bind(BUS_SOCKET)
+        listener.listen(args.workers)
+        fork = multiprocessing.get_context('fork')
+        for worker in range(args.workers):
+            fork.Process(
+                target=run_worker, daemon=True,
+                args=(server_type, args.host, args.p, worker, options)
+            ).start()
+        server = Hub(args.host, args.p, listener, args.workers, **options)
+    else:
+        server = server_type(
+            args.host, args.p, node=args.node, peers=peers, peer_secret=args.peer_secret,
+            admin_log=ADMIN_LOG,
+            takeover=takeover, **options
+        )
     server.start()
+    if args.handoff:
+        threading.Thread(target=await_successor, args=(server, args.handoff), daemon=True).start()
 
     # Create thread for command loop, and start it:
     command = threading.Thread(target=command, args=(server,))
@@ -0,0 +1,762 @@
+# MinChat - minstore - Alpha 0.2
+# Public message stores used by minserver's log writer.
+
+# MODULES ----------------------------------------------------------------------
+
+import os, re, sys, time, mmap, zlib, struct, sqlite3, argparse, threading
+from array import array
+from itertools import islice
+from bisect import bisect_left, bisect_right
+
+# GLOBAL CONSTANTS -------------------------------------------------------------
+
+ENCODING = 'ascii'
+SEGMENT_BYTES = 16 * 1024 * 1024 # Default size at which a segment is sealed.
+INDEX_INTERVAL = 64 # Records between entries of a segment's sparse index.
+
+# Each stored message is a record: sequence number, time logged, length, then text.
+RECORD = struct.Struct('!QdI')
+# Each index entry: sequence number of a record, and its offset in the segment.
+INDEX_ENTRY = struct.Struct('!QQ')
+
+ACTIVE = '.seg' # Segment being appended to; raw records.
+ACTIVE_INDEX = '.idx'
+SEALED = '.segz' # Sealed segment; one zlib block per index entry.
+SEALED_INDEX = '.zidx' # Ends with an entry for the end of the segment.
+HEADER_FILE = 'header.txt' # Header of the text log that export() produces.
+DEFAULT_ROOM = 'lobby' # Room every client starts in.
+
+# Search indexes (see SearchIndex):
+TERM = re.compile(r'[a-z0-9]{1,64}') # Words are indexed lowercased; longer runs are split.
+SEARCH_SEGMENT = 65536 # Messages indexed in memory before they are written out, sealed.
+SEARCH_PAGE = 20 # Default matches returned by one search.
+SEARCH_INTERSECT = 4096 # Postings, per part, short enough to intersect as sets rather than walk.
+JOURNAL = '.jnl' # Terms of the messages indexed since the last seal, a line per message.
+POSTINGS = '.six' # Sealed index segment.
+# A sealed index segment starts with: magic, base sequence number, messages, terms;
+POSTINGS_HEADER = struct.Struct('!4sQQI')
+POSTINGS_MAGIC = b'MCSI'
+# then an entry per term, in term order: postings offset, postings count, term length,
+# then the term; then the postings: every term's message numbers, less base, as
+# 32-bit integers in this machine's byte order, to be read straight from an mmap.
+TERM_ENTRY = struct.Struct('!QIB')
+
+
+# TEXT STORE -------------------------------------------------------------------
+
+class TextStore:
+    '''
+    The original public log: one plain-text file, one message per line,
+    after a two-line header. Reading it back means reading the whole file.
+    '''
+
+    def __init__(self, path, header):
+        self.path = path # Public log file.
+        self.header = header # Text written at the top of the file.
+        self.file = None # Open for appending once open() is called.
+        self.pending = [] # Lines appended since the last flush.
+
+    def open(self):
+        '''Creates the log file, unless an earlier run left it (see minserver's --takeover).'''
+        if not os.path.exists(self.path):
+            with open(self.path, 'w') as log:
+                log.write(self.header)
+        self.file = open(self.path, 'a')
+
+    def append(self, seq, msg, logged, address=None, username=None):
+        '''Adds a message to the store; written out at the next flush.'''
+        self.pending.append(msg + '\n')
+
+    def flush(self, fsync=False):
+        '''Writes out every appended message.'''
+        if self.pending:
+            self.file.write(''.join(self.pending))
+            self.pending.clear()
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+
+    def read(self, start, end):
+        '''Returns the messages with sequence numbers start up to end.'''
+        with open(self.path, 'r') as p_log:
+            lines = p_log.readlines()[2:] # Slice gets rid of header in file.
+        return [line.rstrip('\n') for line in lines[start:end]]
+
+    def pick(self, seqs):
+        '''Returns {seq: msg} for the messages numbered seqs, in one pass over the file.'''
+        wanted = set(seqs)
+        last = max(wanted, default=-1)
+        picked = {}
+        with open(self.path, 'r') as p_log:
+            for seq, line in enumerate(islice(p_log, 2, None)): # Past the header.
+                if seq > last:
+                    break
+                if seq in wanted:
+                    picked[seq] = line.rstrip('\n')
+        return picked
+
+    def close(self):
+        '''Flushes and closes the store.'''
+        self.flush()
+        self.file.close()
+
+
+# SEGMENT ----------------------------------------------------------------------
+
+class Segment:
+    '''
+    One file of consecutive records, starting at sequence number base, with a
+    sparse index of every INDEX_INTERVAL-th record. An active segment holds raw
+    records and is appended to; a sealed segment is read-only and compressed,
+    one zlib block per index entry, so any entry can be decompressed alone.
+    '''
+
+    def __init__(self, directory, base, sealed):
+        self.directory = directory
+        self.base = base # Sequence number of the first record.
+        self.sealed = sealed
+        self.index = [] # [(seq, offset)] of every INDEX_INTERVAL-th record.
+        self.count = 0 # Records in the segment.
+        self.size = 0 # Bytes in the segment file.
+        self.flushed = 0 # Bytes of the segment file that readers can see.
+        self.created = time.time() # When the segment was started.
+        self.file = None # Open for appending while active.
+        self.index_file = None
+
+    def path(self, suffix):
+        return os.path.join(self.directory, f'{self.base:020d}{suffix}')
+
+    # Active segments:
+
+    def create(self):
+        '''Starts a new, empty active segment.'''
+        self.file = open(self.path(ACTIVE), 'wb')
+        self.index_file = open(self.path(ACTIVE_INDEX), 'wb')
+
+    def recover(self, readonly=False):
+        '''
+        Reopens an active segment left by an earlier run, rebuilding its index
+        and dropping any record that was only partly written.
+        A read-only store rebuilds the index in memory and leaves the files be.
+        '''
+        with open(self.path(ACTIVE), 'rb') as seg:
+            data = seg.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            seq, logged, length = RECORD.unpack_from(data, offset)
+            if offset + RECORD.size + length > len(data):
+                break
+            if self.count % INDEX_INTERVAL == 0:
+                self.index.append((seq, offset))
+            self.count += 1
+            offset += RECORD.size + length
+        self.size = self.flushed = offset
+        self.created = os.path.getmtime(self.path(ACTIVE))
+        if readonly:
+            return
+        self.file = open(self.path(ACTIVE), 'r+b')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        with open(self.path(ACTIVE_INDEX), 'wb') as idx:
+            idx.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        self.index_file = open(self.path(ACTIVE_INDEX), 'ab')
+
+    def append(self, seq, msg, logged):
+        '''Appends a record to this active segment.'''
+        data = msg.encode(ENCODING)
+        if self.count % INDEX_INTERVAL == 0:
+            self.index.append((seq, self.size))
+            self.index_file.write(INDEX_ENTRY.pack(seq, self.size))
+        self.file.write(RECORD.pack(seq, logged, len(data)) + data)
+        self.size += RECORD.size + len(data)
+        self.count += 1
+
+    def flush(self, fsync=False):
+        for file in (self.file, self.index_file):
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+        self.flushed = self.size
+
+    def seal(self):
+        '''
+        Compresses this active segment, one block per index entry, and
+        replaces it with the sealed segment and its index.
+        '''
+        self.flush()
+        self.file.close()
+        self.index_file.close()
+        with open(self.path(ACTIVE), 'rb') as seg:
+            data = seg.read()
+
+        sealed_index, offset = [], 0
+        with open(self.path(SEALED) + '.tmp', 'wb') as segz:
+            bounds = [start for _, start in self.index] + [len(data)]
+            for (seq, _), start, end in zip(self.index, bounds, bounds[1:]):
+                block = zlib.compress(data[start:end])
+                segz.write(block)
+                sealed_index.append((seq, offset))
+                offset += len(block)
+        sealed_index.append((self.base + self.count, offset)) # End of the segment.
+        with open(self.path(SEALED_INDEX) + '.tmp', 'wb') as zidx:
+            zidx.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in sealed_index))
+
+        os.replace(self.path(SEALED) + '.tmp', self.path(SEALED))
+        os.replace(self.path(SEALED_INDEX) + '.tmp', self.path(SEALED_INDEX))
+        os.remove(self.path(ACTIVE))
+        os.remove(self.path(ACTIVE_INDEX))
+        self.sealed = True
+        self.index = sealed_index
+        self.size = self.flushed = offset
+        self.file = self.index_file = None
+
+    # Sealed segments:
+
+    def load(self):
+        '''Loads the index of a sealed segment left by an earlier run.'''
+        with open(self.path(SEALED_INDEX), 'rb') as zidx:
+            data = zidx.read()
+        self.index = [entry for entry in INDEX_ENTRY.iter_unpack(data)]
+        self.count = self.index[-1][0] - self.base
+        self.size = self.flushed = self.index[-1][1]
+        self.created = os.path.getmtime(self.path(SEALED))
+
+    def remove(self):
+        '''Deletes a sealed segment's files.'''
+        os.remove(self.path(SEALED))
+        os.remove(self.path(SEALED_INDEX))
+
+    # Both:
+
+    def read(self, start, end):
+        '''
+        Returns [(seq, logged, msg)] for the records of this segment with
+        sequence numbers start up to end: a seek, via the sparse index, to the
+        entry at or before start, then one pass over an mmap of the file.
+        '''
+        size = self.flushed # Appends after this may still be buffered.
+        entries = self.index[:-1] if self.sealed else list(self.index)
+        first = max(0, bisect_right(entries, (start, float('inf'))) - 1)
+        records = []
+        if size == 0:
+            return records
+        with open(self.path(SEALED if self.sealed else ACTIVE), 'rb') as seg:
+            with mmap.mmap(seg.fileno(), size, access=mmap.ACCESS_READ) as view:
+                if not self.sealed:
+                    self.scan(view, entries[first][1], size, start, end, records)
+                    return records
+                for (seq, offset), (_, next_offset) in zip(self.index[first:], self.index[first + 1:]):
+                    if seq >= end:
+                        break
+                    block = zlib.decompress(view[offset:next_offset])
+                    self.scan(block, 0, len(block), start, end, records)
+        return records
+
+    @staticmethod
+    def scan(data, offset, limit, start, end, records):
+        '''Collects records from data[offset:limit] with sequence numbers in range.'''
+        while offset < limit:
+            seq, logged, length = RECORD.unpack_from(data, offset)
+            if seq >= end:
+                return
+            offset += RECORD.size
+            if seq >= start:
+                records.append((seq, logged, str(data[offset:offset + length], ENCODING)))
+            offset += length
+
+
+# SEGMENT STORE ----------------------------------------------------------------
+
+class SegmentStore:
+    '''
+    Append-only public log kept as a directory of segments. The active segment
+    is sealed, compressed, and a new one started once it reaches segment_bytes
+    or segment_seconds; sealed segments are deleted once there are more than
+    retention_segments of them, or they are older than retention_seconds.
+    Any range of sequence numbers is read with a seek and an mmap per segment.
+    Only one thread may append; any thread may read.
+    '''
+
+    def __init__(self, directory, header='', segment_bytes=SEGMENT_BYTES,
+                 segment_seconds=None, retention_segments=None, retention_seconds=None):
+        self.directory = directory
+        self.header = header # Header of the text log that export() produces.
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention_segments = retention_segments
+        self.retention_seconds = retention_seconds
+        self.segments = [] # Oldest first; only the last may be active.
+        self.lock = threading.Lock() # Guards segments between the writer and readers.
+
+    def open(self, readonly=False):
+        '''
+        Opens the store directory, picking up segments left by an earlier run.
+        A read-only store, e.g. for exporting a live server's log, changes nothing.
+        '''
+        if not readonly:
+            os.makedirs(self.directory, exist_ok=True)
+        header_path = os.path.join(self.directory, HEADER_FILE)
+        if not readonly and (self.header or not os.path.exists(header_path)):
+            with open(header_path, 'w') as header:
+                header.write(self.header)
+
+        names = os.listdir(self.directory)
+        for name in sorted(names):
+            base, suffix = os.path.splitext(name)
+            if suffix == ACTIVE:
+                segment = Segment(self.directory, int(base), False)
+                segment.recover(readonly)
+            elif suffix == SEALED and base + ACTIVE not in names:
+                segment = Segment(self.directory, int(base), True)
+                segment.load()
+            else:
+                continue
+            self.segments.append(segment)
+
+    def next_seq(self):
+        '''Returns the sequence number the next message will be given.'''
+        if not self.segments:
+            return 0
+        return self.segments[-1].base + self.segments[-1].count
+
+    def append(self, seq, msg, logged, address=None, username=None):
+        '''Appends a message to the active segment, starting one if needed.'''
+        active = self.segments[-1] if self.segments else None
+        if active is None or active.sealed or self.due_to_roll(active):
+            with self.lock:
+                if active is not None and not active.sealed:
+                    active.seal()
+                active = Segment(self.directory, seq, False)
+                active.create()
+                self.segments.append(active)
+                self.apply_retention()
+        active.append(seq, msg, logged)
+
+    def due_to_roll(self, segment):
+        return segment.size >= self.segment_bytes or (
+            self.segment_seconds is not None and
+            time.time() - segment.created >= self.segment_seconds
+        )
+
+    def apply_retention(self):
+        '''Deletes the oldest sealed segments beyond the retention limits.'''
+        sealed = [segment for segment in self.segments if segment.sealed]
+        now = time.time()
+        for segment in list(sealed):
+            too_many = (
+                self.retention_segments is not None and
+                len(sealed) > self.retention_segments
+            )
+            too_old = (
+                self.retention_seconds is not None and
+                now - segment.created > self.retention_seconds
+            )
+            if not (too_many or too_old):
+                break
+            segment.remove()
+            self.segments.remove(segment)
+            sealed.remove(segment)
+
+    def flush(self, fsync=False):
+        '''Writes out the active segment.'''
+        if self.segments and not self.segments[-1].sealed:
+            self.segments[-1].flush(fsync)
+
+    def records(self, start, end):
+        '''Returns [(seq, logged, msg)] for retained messages start up to end.'''
+        records = []
+        with self.lock: # Held so no segment is sealed or deleted mid-read.
+            bases = [segment.base for segment in self.segments] + [end]
+            for segment, next_base in zip(self.segments, bases[1:]):
+                if next_base > start and segment.base < end:
+                    records.extend(segment.read(start, end))
+        return records
+
+    def read(self, start, end):
+        '''Returns the retained messages with sequence numbers start up to end.'''
+        return [msg for _, _, msg in self.records(start, end)]
+
+    def pick(self, seqs):
+        '''Returns {seq: msg} for the retained messages numbered seqs.'''
+        # Each is an index lookup and one block read, not a scan:
+        return {
+            seq: msg for wanted in seqs
+            for seq, _, msg in self.records(wanted, wanted + 1)
+        }
+
+    def export(self, out):
+        '''Writes the store out to file object out as a plain-text public log.'''
+        with open(os.path.join(self.directory, HEADER_FILE)) as header:
+            out.write(header.read())
+        for _, _, msg in self.records(0, self.next_seq()):
+            out.write(msg + '\n')
+
+    def close(self):
+        '''Flushes and closes the active segment.'''
+        if self.segments and self.segments[-1].file is not None:
+            active = self.segments[-1]
+            active.flush()
+            active.file.close()
+            active.index_file.close()
+
+
+# SQLITE STORE -----------------------------------------------------------------
+
+class SqliteStore:
+    '''
+    Public log kept in an SQLite database in WAL mode, for deployments that
+    need to query chat history. One database holds every session; each message
+    is stored with its session, room, sequence number, time, sender address and
+    username; each room's messages are appended and read by their own store
+    on the same database. Appends are inserted in one transaction per flush, on the log
+    writer's thread, and reads are indexed queries on their own connections.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS messages (
+            session TEXT NOT NULL,
+            room TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            logged REAL NOT NULL,
+            address TEXT,
+            username TEXT,
+            text TEXT NOT NULL,
+            PRIMARY KEY (session, room, seq)
+        );
+        CREATE INDEX IF NOT EXISTS messages_by_username ON messages (username, logged);
+        CREATE INDEX IF NOT EXISTS messages_by_time ON messages (logged);
+        CREATE TABLE IF NOT EXISTS sessions (
+            session TEXT PRIMARY KEY,
+            header TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, session, header='', room=DEFAULT_ROOM):
+        self.path = path # Database file.
+        self.session = session # Messages are stored and read under this session.
+        self.room = room # ... and this room.
+        self.header = header # Header of the text log that export() produces.
+        self.db = None # Connection used by the log writer.
+        self.readers = threading.local() # A connection per reading thread.
+        self.pending = [] # Rows appended since the last flush.
+        self.synchronous = None # Current synchronous pragma; FULL when fsync'ing.
+
+    def open(self):
+        '''Opens the database, creating its tables if needed.'''
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sessions (session, header) VALUES (?, ?)',
+                (self.session, self.header)
+            )
+
+    def append(self, seq, msg, logged, address=None, username=None):
+        '''Adds a message to the store; inserted at the next flush.'''
+        self.pending.append((
+            self.session, self.room, seq, logged,
+            None if address is None else f'{address[0]}:{address[1]}',
+            username, msg
+        ))
+
+    def flush(self, fsync=False):
+        '''Inserts every appended message in one transaction.'''
+        synchronous = 'FULL' if fsync else 'NORMAL'
+        if synchronous != self.synchronous:
+            self.db.execute(f'PRAGMA synchronous={synchronous}')
+            self.synchronous = synchronous
+        if self.pending:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    self.pending
+                )
+            self.pending.clear()
+
+    def reader(self):
+        '''Returns this thread's read connection.'''
+        db = getattr(self.readers, 'db', None)
+        if db is None:
+            db = self.readers.db = sqlite3.connect(self.path)
+        return db
+
+    def read(self, start, end):
+        '''Returns the messages with sequence numbers start up to end.'''
+        rows = self.reader().execute(
+            'SELECT text FROM messages WHERE session = ? AND room = ? ' +
+            'AND seq >= ? AND seq < ? ORDER BY seq',
+            (self.session, self.room, start, end)
+        )
+        return [text for (text,) in rows]
+
+    def pick(self, seqs):
+        '''Returns {seq: msg} for the messages numbered seqs, in one query.'''
+        seqs = list(seqs)
+        rows = self.reader().execute(
+            'SELECT seq, text FROM messages WHERE session = ? AND room = ? ' +
+            f"AND seq IN ({', '.join('?' * len(seqs))})",
+            (self.session, self.room, *seqs)
+        )
+        return dict(rows)
+
+    def export(self, out):
+        '''Writes this room's session out to file object out as a plain-text public log.'''
+        row = self.reader().execute(
+            'SELECT header FROM sessions WHERE session = ?', (self.session,)
+        ).fetchone()
+        out.write(row[0] if row else '')
+        rows = self.reader().execute(
+            'SELECT text FROM messages WHERE session = ? AND room = ? ORDER BY seq',
+            (self.session, self.room)
+        )
+        for (text,) in rows:
+            out.write(text + '\n')
+
+    def close(self):
+        '''Flushes and closes the database.'''
+        self.flush()
+        self.db.close()
+
+
+# SEARCH INDEX -----------------------------------------------------------------
+
+def search_terms(text):
+    '''Returns the distinct words of text as the index keeps them, in order of appearance.'''
+    return list(dict.fromkeys(TERM.findall(text.lower())))
+
+
+class PostingsSegment:
+    '''
+    A sealed part of a SearchIndex: for each term, the sequence numbers of
+    the messages holding it, for SEARCH_SEGMENT messages from base. Only the
+    terms are read into memory; postings are read from an mmap of the file.
+    '''
+
+    def __init__(self, directory, base):
+        self.directory = directory
+        self.base = base # Sequence number postings are counted from.
+        self.count = 0 # Messages indexed.
+        self.terms = [] # Every term, sorted.
+        self.entries = array('Q') # (offset << 32 | count) of each term's postings, in term order.
+        self.map = None # The file, mmapped.
+
+    def path(self):
+        return os.path.join(self.directory, f'{self.base:020d}{POSTINGS}')
+
+    def write(self, count, postings):
+        '''Writes out the postings, {term: array of seq - base}, of count messages.'''
+        terms = sorted(postings)
+        table_size = sum(TERM_ENTRY.size + len(term) for term in terms)
+        offset = -(-(POSTINGS_HEADER.size + table_size) // 8) * 8 # Postings start aligned.
+        parts = [POSTINGS_HEADER.pack(POSTINGS_MAGIC, self.base, count, len(terms))]
+        for term in terms:
+            parts.append(TERM_ENTRY.pack(offset, len(postings[term]), len(term)) + term.encode(ENCODING))
+            offset += 4 * len(postings[term])
+        parts.append(bytes(-(POSTINGS_HEADER.size + table_size) % 8))
+        parts.extend(postings[term].tobytes() for term in terms)
+        with open(self.path() + '.tmp', 'wb') as six:
+            six.write(b''.join(parts))
+        os.replace(self.path() + '.tmp', self.path())
+
+    def load(self):
+        '''Maps the file in and reads its terms.'''
+        with open(self.path(), 'rb') as six:
+            self.map = mmap.mmap(six.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, base, self.count, terms = POSTINGS_HEADER.unpack_from(self.map)
+        if magic != POSTINGS_MAGIC or base != self.base:
+            raise ValueError(f'{self.path()} is not a search index segment')
+        offset = POSTINGS_HEADER.size
+        for _ in range(terms):
+            postings, count, length = TERM_ENTRY.unpack_from(self.map, offset)
+            offset += TERM_ENTRY.size
+            self.terms.append(str(self.map[offset:offset + length], ENCODING))
+            self.entries.append(postings << 32 | count)
+            offset += length
+
+    def postings(self, term):
+        '''Returns the sorted seq - base of the messages holding term, or None.'''
+        n = bisect_left(self.terms, term)
+        if n == len(self.terms) or self.terms[n] != term:
+            return None
+        offset, count = self.entries[n] >> 32, self.entries[n] & 0xffffffff
+        return memoryview(self.map)[offset:offset + 4 * count].cast('I')
+
+
+class SearchIndex:
+    '''
+    Inverted index of a room's public messages, kept up to date as they are
+    logged: for each word, the sequence numbers of the messages holding it.
+    The newest messages are indexed in memory, and their terms journaled to
+    disk at each flush; every SEARCH_SEGMENT messages, they are written out as
+    a sealed PostingsSegment. Opening the index picks up its segments and
+    replays the journal, so nothing is reindexed from the log at startup.
+    Only one thread may add; any thread may search.
+    '''
+
+    def __init__(self, directory, segment_messages=SEARCH_SEGMENT):
+        self.directory = directory
+        self.segment_messages = segment_messages # Messages indexed before a seal.
+        self.sealed = [] # PostingsSegments, oldest first.
+        self.base = 0 # Sequence number the in-memory postings are counted from.
+        self.active = {} # Term -> array of seq - base, for messages since the last seal.
+        self.indexed = 0 # Sequence number of the next message to index.
+        self.journal = None # Open for appending once open() is called.
+        self.pending = [] # Journal lines added since the last flush.
+        self.lock = threading.Lock() # Guards sealed, base and active between adds and searches.
+
+    def journal_path(self):
+        return os.path.join(self.directory, f'{self.base:020d}{JOURNAL}')
+
+    def open(self):
+        '''Opens the index directory, picking up what an earlier run left there.'''
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(os.listdir(self.directory))
+        for name in names:
+            base, suffix = os.path.splitext(name)
+            if suffix == POSTINGS:
+                segment = PostingsSegment(self.directory, int(base))
+                segment.load()
+                self.sealed.append(segment)
+                self.base = self.indexed = segment.base + segment.count
+        for name in names:
+            base, suffix = os.path.splitext(name)
+            if suffix == JOURNAL and int(base) < self.base:
+                os.remove(os.path.join(self.directory, name)) # Sealed before it was removed.
+            elif suffix == JOURNAL:
+                self.base = self.indexed = int(base)
+                self.replay()
+        self.journal = open(self.journal_path(), 'a')
+
+    def replay(self):
+        '''Indexes the messages in the journal, dropping a last line only partly written.'''
+        with open(self.journal_path()) as journal:
+            lines = journal.read().split('\n')
+        for line in lines[:-1]:
+            seq, *terms = line.split(' ')
+            self.index(int(seq), terms)
+        with open(self.journal_path(), 'r+') as journal:
+            journal.truncate(sum(len(line) + 1 for line in lines[:-1]))
+
+    def index(self, seq, terms):
+        '''Adds the terms of message seq to the in-memory postings.'''
+        for term in terms:
+            postings = self.active.get(term)
+            if postings is None:
+                postings = self.active[term] = array('I')
+            postings.append(seq - self.base)
+        self.indexed = seq + 1
+
+    def add(self, seq, msg):
+        '''Indexes a public message; it is journaled at the next flush.'''
+        if seq < self.indexed:
+            return # Already indexed, before a restart.
+        if seq - self.base >= self.segment_messages:
+            self.seal()
+        terms = search_terms(msg)
+        self.index(seq, terms)
+        self.pending.append(f"{seq} {' '.join(terms)}\n")
+
+    def seal(self):
+        '''Writes the in-memory postings out as a sealed segment, and starts afresh.'''
+        self.flush()
+        segment = PostingsSegment(self.directory, self.base)
+        segment.write(self.indexed - self.base, self.active)
+        segment.load()
+        self.journal.close()
+        journal = self.journal_path()
+        with self.lock:
+            self.sealed.append(segment)
+            self.base, self.active = self.indexed, {}
+        os.remove(journal)
+        self.journal = open(self.journal_path(), 'a')
+
+    def flush(self, fsync=False):
+        '''Journals every message added since the last flush.'''
+        if self.pending:
+            self.journal.write(''.join(self.pending))
+            self.pending.clear()
+            self.journal.flush()
+            if fsync:
+                os.fsync(self.journal.fileno())
+
+    def search(self, words, before=None, limit=SEARCH_PAGE):
+        '''
+        Returns the sequence numbers of up to limit messages holding every
+        word in words, newest first, from before seq before if given. Each
+        part of the index is searched from its newest match back: the rarest
+        term's postings are walked, and the others bisected, so a search
+        stops as soon as it has limit matches, however common its terms.
+        Postings of only rare terms are intersected as sets instead.
+        '''
+        terms = sorted(set(search_terms(' '.join(words))))
+        if not terms or limit <= 0:
+            return []
+        with self.lock:
+            parts = [(self.base, self.active.get)]
+            parts += [(segment.base, segment.postings) for segment in reversed(self.sealed)]
+        matches = []
+        for base, postings_of in parts:
+            if before is not None and before <= base:
+                continue
+            postings = [postings_of(term) for term in terms]
+            if not all(postings):
+                continue
+            postings.sort(key=len)
+            rarest, others = postings[0], postings[1:]
+            n = len(rarest) if before is None else bisect_left(rarest, before - base)
+            if others and len(postings[-1]) <= SEARCH_INTERSECT:
+                # Few enough to intersect whole, which is quicker than bisecting each.
+                found = sorted(set(rarest[:n]).intersection(*others), reverse=True)
+                matches.extend(base + offset for offset in found[:limit - len(matches)])
+                if len(matches) == limit:
+                    return matches
+                continue
+            while n > 0:
+                n -= 1
+                offset = rarest[n]
+                for other in others:
+                    found = bisect_left(other, offset)
+                    if found == len(other) or other[found] != offset:
+                        break
+                else:
+                    matches.append(base + offset)
+                    if len(matches) == limit:
+                        return matches
+        return matches
+
+    def close(self):
+        '''Flushes and closes the index.'''
+        self.flush()
+        self.journal.close()
+
+
+# MAIN -------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MinChat Message Store')
+    parser.add_argument('command', choices=('export',),
+                        help='export: write a store out as a text public log')
+    parser.add_argument('store', help='Segment store directory, or SQLite database file')
+    parser.add_argument('--session', help='Session to export from a database ' +
+                        '(its start time, as in the log file names; default the latest)')
+    parser.add_argument('--room', default=DEFAULT_ROOM,
+                        help=f'Room to export from a database (default {DEFAULT_ROOM}); ' +
+                        'a segment store directory holds one room')
+    parser.add_argument('-o', metavar='FILE', help='Output file (default stdout)')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.store):
+        store = SegmentStore(args.store)
+        store.open(readonly=True)
+    else:
+        session = args.session
+        if session is None:
+            with sqlite3.connect(args.store) as db:
+                session = db.execute('SELECT MAX(session) FROM sessions').fetchone()[0]
+        store = SqliteStore(args.store, session, room=args.room)
+    if args.o:
+        with open(args.o, 'w') as out:
+            store.export(out)
+    else:
+        store.export(sys.stdout)